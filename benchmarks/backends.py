@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+"""
+benchmarks.backends
+~~~~~~~~~~~~~~~~~~~
+
+Compares the latency of storing events and fetching pages of groups and
+events across backends. The in-memory backend gives a baseline without
+the network hop.
+
+The Redis backend requires a local redis-server, and the selected database
+is flushed.
+
+:copyright: (c) 2010 by the Sentry Team, see AUTHORS for more details.
+:license: BSD, see LICENSE for more details.
+"""
+
+import datetime
+import os
+import time
+import uuid
+from optparse import OptionParser
+
+from sentry import app
+from sentry.db.backends.memory import MemoryBackend
+from sentry.db.backends.redis import RedisBackend
+from sentry.models import Event, Group
+
+def get_backends(options):
+    backends = [('memory', lambda: MemoryBackend())]
+    if not options.no_redis:
+        def redis_backend():
+            backend = RedisBackend(host=options.host, port=options.port, db=options.db, key_prefix='benchmark')
+            backend.conn.flushdb()
+            return backend
+        backends.append(('redis', redis_backend))
+    if options.sqlalchemy:
+        from sentry.db.backends.sqlalchemy import SQLAlchemyBackend
+        backends.append(('sqlalchemy', lambda: SQLAlchemyBackend(options.sqlalchemy)))
+    if options.sqlite:
+        from sentry.db.backends.sqlite import SQLiteBackend
+        def sqlite_backend():
+            if os.path.exists(options.sqlite):
+                os.unlink(options.sqlite)
+            return SQLiteBackend(options.sqlite)
+        backends.append(('sqlite', sqlite_backend))
+    return backends
+
+def store(n, num_groups):
+    return app.client.store(
+        'sentry.events.Message',
+        tags=[('server', 'web%d' % (n % 4))],
+        date=datetime.datetime.now(),
+        time_spent=n,
+        data={
+            'sentry.interfaces.Message': {
+                'message': 'message %d' % (n % num_groups),
+            }
+        },
+        event_id=uuid.uuid4().hex,
+    )
+
+def measure(func, iterations):
+    start = time.time()
+    for n in xrange(iterations):
+        func(n)
+    return (time.time() - start) / iterations * 1000
+
+def main():
+    parser = OptionParser()
+    parser.add_option('--host', default='localhost')
+    parser.add_option('--port', default=6379, type=int)
+    parser.add_option('--db', default=15, type=int)
+    parser.add_option('--no-redis', action='store_true', dest='no_redis')
+    parser.add_option('--sqlalchemy', metavar='URI',
+                      help='Also measure the SQLAlchemy backend against the given database.')
+    parser.add_option('--sqlite', metavar='PATH',
+                      help='Also measure the SQLite backend, replacing the database at the given path.')
+    parser.add_option('--num', default=1000, type=int,
+                      help='Number of events to store.')
+    parser.add_option('--groups', default=100, type=int,
+                      help='Number of distinct groups.')
+    parser.add_option('--iterations', default=200, type=int)
+    parser.add_option('--page-size', default=15, type=int, dest='page_size')
+    (options, args) = parser.parse_args()
+
+    limit = options.page_size
+
+    print '%-12s %14s %14s %14s %14s' % ('backend', 'store (ms)', 'list (ms)', 'filter (ms)', 'events (ms)')
+    for name, get_backend in get_backends(options):
+        app.db = get_backend()
+
+        store_ms = measure(lambda n: store(n, options.groups), options.num)
+        group = Group.objects.all()[0]
+
+        list_ms = measure(lambda n: Group.objects.order_by('-score')[0:limit], options.iterations)
+        filter_ms = measure(lambda n: Group.objects.order_by('-score').filter_tags(server='web1')[0:limit], options.iterations)
+        events_ms = measure(lambda n: group.get_relations(Event, limit=limit), options.iterations)
+
+        print '%-12s %14.3f %14.3f %14.3f %14.3f' % (name, store_ms, list_ms, filter_ms, events_ms)
+
+        if name == 'redis':
+            app.db.conn.flushdb()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+"""
+benchmarks.encoding
+~~~~~~~~~~~~~~~~~~~
+
+Compares the size and decoding time of the data of an exception event when
+stored as JSON, as the original ``to_db`` did, and in each of the formats of
+``sentry.db.encoding``.
+
+:copyright: (c) 2010 by the Sentry Team, see AUTHORS for more details.
+:license: BSD, see LICENSE for more details.
+"""
+
+import sys
+import timeit
+from optparse import OptionParser
+
+import simplejson
+
+from sentry import app
+from sentry.db.backends.memory import MemoryBackend
+from sentry.db.encoding import encode, decode, to_json_types
+from sentry.models import Event
+
+def recurse(depth, **kwargs):
+    if depth:
+        return recurse(depth - 1, previous=kwargs)
+    raise ValueError('depth exceeded')
+
+def get_event_data(depth):
+    app.db = MemoryBackend()
+    try:
+        recurse(depth, user={'id': 1, 'name': 'foo'}, values=range(20))
+    except ValueError:
+        event_id = app.client.capture('Exception', exc_info=sys.exc_info(), data={
+            'extra': {'url': 'http://example.com/foo/', 'user': 'foo'},
+        })
+    return dict(Event.objects.get(event_id).data)
+
+def main():
+    parser = OptionParser()
+    parser.add_option('--iterations', default=1000, type=int)
+    parser.add_option('--depth', default=10, type=int,
+                      help='Number of frames in the stacktrace.')
+    (options, args) = parser.parse_args()
+
+    data = get_event_data(options.depth)
+    formats = [('json', lambda v: simplejson.dumps(v), simplejson.loads)]
+    for compression in (None, 'zlib', 'dictionary'):
+        formats.append(('marshal/%s' % (compression or 'none'),
+                        lambda v, c=compression: encode(to_json_types(v), c), decode))
+
+    print '%-20s %12s %16s' % ('format', 'size (bytes)', 'decode (us)')
+    for name, dumps, loads in formats:
+        encoded = [dumps(v) for v in data.itervalues()]
+        size = sum(len(v) for v in encoded)
+        timer = timeit.Timer(lambda: [loads(v) for v in encoded])
+        print '%-20s %12d %16.1f' % (name, size, timer.timeit(options.iterations) / options.iterations * 1000000)
+
+if __name__ == '__main__':
+    main()
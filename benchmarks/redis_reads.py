@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+"""
+benchmarks.redis_reads
+~~~~~~~~~~~~~~~~~~~~~~
+
+Measures the number of network round trips and the latency needed to fetch
+a page of results from the Redis backend, comparing the original
+``ZRANGE`` + ``HGETALL``-per-key access pattern against the pipelined
+``RedisBackend.list`` and ``RedisBackend.list_relations``.
+
+Requires a local redis-server. The selected database is flushed.
+
+:copyright: (c) 2010 by the Sentry Team, see AUTHORS for more details.
+:license: BSD, see LICENSE for more details.
+"""
+
+import time
+from optparse import OptionParser
+
+from sentry.db.backends.redis import RedisBackend
+
+class Schema(object):
+    __name__ = 'benchmark'
+
+class Parent(object):
+    __name__ = 'benchmark_parent'
+
+class RoundTripCounter(object):
+    """
+    Counts every connection checkout from the pool, which maps to exactly one
+    request/response cycle for both single commands and pipelines.
+    """
+    def __init__(self, conn):
+        self.count = 0
+        pool = conn.connection_pool
+        get_connection = pool.get_connection
+        def counted(*args, **kwargs):
+            self.count += 1
+            return get_connection(*args, **kwargs)
+        pool.get_connection = counted
+
+def naive_list(backend, schema, index, offset, limit, desc):
+    # the access pattern RedisBackend.list used before pipelining
+    pk_set = backend.conn.zrange(backend._get_index_key(schema, index), start=offset, end=offset + limit - 1, desc=desc)
+    return [(pk, backend.conn.hgetall(backend._get_data_key(schema, pk))) for pk in pk_set]
+
+def naive_list_relations(backend, from_schema, from_pk, to_schema, offset, limit, desc):
+    pk_set = backend.conn.zrange(backend._get_relation_key(from_schema, from_pk, to_schema), start=offset, end=offset + limit - 1, desc=desc)
+    return [(pk, backend.conn.hgetall(backend._get_data_key(to_schema, pk))) for pk in pk_set]
+
+def populate(backend, num):
+    schema, parent = Schema(), Parent()
+    pipe = backend.conn.pipeline(transaction=False)
+    for n in xrange(num):
+        pk = backend.generate_key(schema)
+        pipe.hmset(backend._get_data_key(schema, pk), {
+            'type': 'sentry.events.Exception',
+            'hash': pk,
+            'date': '2011-06-18T22:31:45.%06d' % n,
+            'time_spent': n,
+        })
+        pipe.zadd(backend._get_index_key(schema, 'default'), **{pk: n})
+        pipe.zadd(backend._get_relation_key(parent, 'parent', schema), **{pk: n})
+    pipe.execute()
+
+def measure(counter, func, iterations):
+    counter.count = 0
+    start = time.time()
+    for n in xrange(iterations):
+        func()
+    elapsed = time.time() - start
+    return float(counter.count) / iterations, elapsed / iterations * 1000
+
+def main():
+    parser = OptionParser()
+    parser.add_option('--host', default='localhost')
+    parser.add_option('--port', default=6379, type=int)
+    parser.add_option('--db', default=15, type=int)
+    parser.add_option('--num', default=1000, type=int,
+                      help='Number of hashes to populate.')
+    parser.add_option('--iterations', default=200, type=int)
+    parser.add_option('--page-sizes', default='15,50,100', dest='page_sizes')
+    (options, args) = parser.parse_args()
+
+    backend = RedisBackend(host=options.host, port=options.port, db=options.db, key_prefix='benchmark')
+    backend.conn.flushdb()
+    populate(backend, options.num)
+
+    schema, parent = Schema(), Parent()
+    counter = RoundTripCounter(backend.conn)
+
+    print '%-16s %6s %14s %14s %14s %14s' % ('operation', 'page', 'before (rt)', 'before (ms)', 'after (rt)', 'after (ms)')
+    for limit in map(int, options.page_sizes.split(',')):
+        rows = (
+            ('list',
+                lambda: naive_list(backend, schema, 'default', 0, limit, True),
+                lambda: backend.list(schema, 'default', 0, limit, True)),
+            ('list_relations',
+                lambda: naive_list_relations(backend, parent, 'parent', schema, 0, limit, True),
+                lambda: backend.list_relations(parent, 'parent', schema, 0, limit, True)),
+        )
+        for name, before, after in rows:
+            assert before() == after()
+            b_rt, b_ms = measure(counter, before, options.iterations)
+            a_rt, a_ms = measure(counter, after, options.iterations)
+            print '%-16s %6d %14.1f %14.3f %14.1f %14.3f' % (name, limit, b_rt, b_ms, a_rt, a_ms)
+
+    backend.conn.flushdb()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+"""
+benchmarks.transform
+~~~~~~~~~~~~~~~~~~~~
+
+Measures ``sentry.utils.transform`` against the previous recursive
+implementation on wide dicts, deeply nested lists and cyclic graphs.
+
+:copyright: (c) 2010 by the Sentry Team, see AUTHORS for more details.
+:license: BSD, see LICENSE for more details.
+"""
+
+import datetime
+import sys
+import timeit
+import uuid
+from optparse import OptionParser
+from types import ClassType, TypeType
+
+from sentry.utils import has_sentry_metadata, to_unicode, transform
+
+def recursive_transform(value, stack=[], context=None):
+    # the implementation transform replaced
+    if context is None:
+        context = {}
+    objid = id(value)
+    if objid in context:
+        return '<...>'
+    context[objid] = 1
+    if any(value is s for s in stack):
+        ret = 'cycle'
+    transform_rec = lambda o: recursive_transform(o, stack + [value], context)
+    if isinstance(value, (tuple, list, set, frozenset)):
+        try:
+            ret = type(value)(transform_rec(o) for o in value[:])
+        except:
+            ret = tuple(transform_rec(o) for o in value)
+    elif isinstance(value, uuid.UUID):
+        ret = repr(value)
+    elif isinstance(value, datetime.datetime):
+        ret = value.strftime('%Y-%m-%dT%H:%M:%S.%f')
+    elif isinstance(value, datetime.date):
+        ret = value.strftime('%Y-%m-%d')
+    elif isinstance(value, dict):
+        ret = dict((k, transform_rec(v)) for k, v in value.iteritems())
+    elif isinstance(value, unicode):
+        ret = to_unicode(value)
+    elif isinstance(value, str):
+        try:
+            ret = str(value)
+        except:
+            ret = to_unicode(value)
+    elif not isinstance(value, (ClassType, TypeType)) and \
+            has_sentry_metadata(value):
+        ret = transform_rec(value.__sentry__())
+    elif not isinstance(value, (int, bool)) and value is not None:
+        ret = to_unicode(value)
+    else:
+        ret = value
+    del context[objid]
+    return ret
+
+def wide_dict(size):
+    return dict(('key%d' % n, {'id': n, 'name': u'value %d' % n, 'tags': ['a', 'b'], 'score': 1.5})
+                for n in xrange(size))
+
+def deep_list(depth):
+    value = leaf = []
+    for n in xrange(depth):
+        leaf.append(['item', n, []])
+        leaf = leaf[0][2]
+    return value
+
+def get_depth(value):
+    depth = 0
+    while isinstance(value, list) and value and isinstance(value[0], list):
+        value = value[0][2]
+        depth += 1
+    return depth
+
+def cyclic_graph(size):
+    nodes = [{'id': n, 'edges': []} for n in xrange(size)]
+    for n, node in enumerate(nodes):
+        node['edges'].extend([nodes[(n + 1) % size], nodes[(n * 7) % size]])
+        node['parent'] = nodes[n // 2]
+    return nodes[0]
+
+def main():
+    parser = OptionParser()
+    parser.add_option('--iterations', default=20, type=int)
+    parser.add_option('--width', default=1000, type=int,
+                      help='Number of keys in the wide dict.')
+    parser.add_option('--depth', default=100, type=int,
+                      help='Nesting depth of the deep list.')
+    parser.add_option('--nodes', default=8, type=int,
+                      help='Number of nodes in the cyclic graph.')
+    (options, args) = parser.parse_args()
+
+    cases = (
+        ('wide dict', wide_dict(options.width)),
+        ('deep nesting', deep_list(options.depth)),
+        ('cyclic graph', cyclic_graph(options.nodes)),
+    )
+
+    print '%-14s %14s %14s %8s' % ('case', 'before (ms)', 'after (ms)', 'speedup')
+    for name, value in cases:
+        assert recursive_transform(value) == transform(value)
+        before = timeit.Timer(lambda: recursive_transform(value)).timeit(options.iterations)
+        after = timeit.Timer(lambda: transform(value)).timeit(options.iterations)
+        print '%-14s %14.3f %14.3f %7.1fx' % (name, before / options.iterations * 1000,
+                                              after / options.iterations * 1000, before / after)
+
+    # past the recursion limit the recursive implementation either raises or,
+    # as its fallbacks swallow the RuntimeError, returns a mangled result
+    depth = sys.getrecursionlimit()
+    value = deep_list(depth)
+    try:
+        before = get_depth(recursive_transform(value)) == depth and 'ok' or 'mangled'
+    except RuntimeError:
+        before = 'failed'
+    after = get_depth(transform(value)) == depth and 'ok' or 'mangled'
+    print 'depth %d: before %s, after %s' % (depth, before, after)
+
+if __name__ == '__main__':
+    main()
@@ -104,7 +104,6 @@ app = Flask(__name__)
 
 from flaskext.babel import Babel
 
-from sentry.core.cleaner import Cleaner
 from sentry.client import ClientProxy
 from sentry.db import get_backend
 
@@ -121,16 +120,6 @@ app.client = ClientProxy(app)
 # Flask-Babel (internationalization)
 app.babel = Babel(app)
 
-@app.before_request
-def init_threads():
-    """
-    Attaches threads to the process on the first web request if 
-    they're not already present.
-    """
-    if not hasattr(app, 'cleaner'):
-        app.cleaner = Cleaner(app)
-        app.cleaner.start()
-
 # Shortcuts to be exported for API
 capture = app.client.capture
 
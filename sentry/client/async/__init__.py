@@ -6,18 +6,47 @@ sentry.client.async
 :license: BSD, see LICENSE for more details.
 """
 
-from Queue import Queue
+import time
+
+from Queue import Queue, Empty, Full
+from sentry import app
 from sentry.client.base import SentryClient
-from threading import Thread, Lock
+from threading import Thread, Lock, Event
 
 class AsyncSentryClient(SentryClient):
-    """This client uses a single background thread to dispatch errors."""
+    """
+    This client uses a single background thread to dispatch errors.
+
+    Events wait in a queue bounded by ``ASYNC_QUEUE_SIZE``, and are sent in
+    batches of up to ``ASYNC_BATCH_SIZE`` events, collected over at most
+    ``ASYNC_BATCH_INTERVAL`` seconds. ``ASYNC_OVERFLOW`` controls what
+    happens when the queue is full:
+
+    - ``drop_oldest``: discard the oldest queued event
+    - ``drop_newest``: discard the event being sent
+    - ``block``: wait up to ``ASYNC_BLOCK_TIMEOUT`` seconds for space, and
+      discard the event being sent if none frees up
+
+    With ``REMOTES``, events which no remote accepted are counted as
+    ``spooled`` if they were spooled to be replayed, and otherwise as
+    ``dropped``.
+    """
+    # wakes the thread up when it is waiting on an empty queue to stop
     _terminator = object()
 
-    def __init__(self):
+    def __init__(self, *args, **kwargs):
         """Starts the task thread."""
-        self.queue = Queue(-1)
+        super(AsyncSentryClient, self).__init__(*args, **kwargs)
+        self.queue = Queue(app.config['ASYNC_QUEUE_SIZE'])
+        self.stats = {
+            'queued': 0,
+            'sent': 0,
+            'spooled': 0,
+            'dropped': 0,
+        }
+        self._stats_lock = Lock()
         self._lock = Lock()
+        self._stopping = Event()
         self._thread = None
         self.start()
 
@@ -25,32 +54,138 @@ class AsyncSentryClient(SentryClient):
         self._lock.acquire()
         try:
             if not self._thread:
+                self._stopping.clear()
                 self._thread = Thread(target=self._target)
                 self._thread.setDaemon(False)
                 self._thread.start()
         finally:
             self._lock.release()
 
-    def stop(self):
-        """Stops the task thread. Synchronous!"""
+    def stop(self, timeout=None):
+        """
+        Stops the task thread, after sending any queued events. Synchronous!
+
+        Waits up to ``timeout`` seconds (or for as long as it takes, if
+        ``None``), and returns ``False`` if the thread is still sending
+        events by then.
+        """
         self._lock.acquire()
         try:
             if self._thread:
-                self.queue.put_nowait(self._terminator)
-                self._thread.join()
+                self._stopping.set()
+                try:
+                    self.queue.put_nowait(self._terminator)
+                except Full:
+                    # the thread is not waiting, and stops once the queue is empty
+                    pass
+                self._thread.join(timeout)
+                if self._thread.isAlive():
+                    self.logger.warning('Timed out stopping the task thread with %d events pending' % (
+                        self.queue.qsize(),))
+                    return False
                 self._thread = None
+            return True
         finally:
             self._lock.release()
 
-    def _target(self):
-        while 1:
-            record = self.queue.get()
+    def get_stats(self):
+        """
+        Returns the number of events queued, sent, spooled and dropped by this
+        client, as well as the number currently pending in the queue.
+        """
+        self._stats_lock.acquire()
+        try:
+            stats = self.stats.copy()
+        finally:
+            self._stats_lock.release()
+        stats['pending'] = self.queue.qsize()
+        return stats
+
+    def _incr_stat(self, key, amount=1):
+        self._stats_lock.acquire()
+        try:
+            self.stats[key] += amount
+        finally:
+            self._stats_lock.release()
+
+    def _get_batch(self):
+        """
+        Blocks until an event is available (or the client is stopped), and
+        then collects further events until the batch is full or the batch
+        interval has passed.
+        """
+        record = self.queue.get()
+        if record is self._terminator:
+            return []
+
+        batch = [record]
+        deadline = time.time() + app.config['ASYNC_BATCH_INTERVAL']
+        while len(batch) < app.config['ASYNC_BATCH_SIZE']:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                record = self.queue.get(True, timeout)
+            except Empty:
+                break
             if record is self._terminator:
                 break
-            self.send_sync(**record)
+            batch.append(record)
+        return batch
+
+    def _target(self):
+        # events sent while stopping are sent as well, as the terminator may
+        # be behind them or have been dropped from a full queue
+        while not (self._stopping.isSet() and self.queue.empty()):
+            batch = self._get_batch()
+            if batch:
+                self.send_batch(batch)
 
     def send_sync(self, **kwargs):
         super(AsyncSentryClient, self).send(**kwargs)
 
+    def send_batch(self, event_list):
+        try:
+            if app.config['REMOTES']:
+                if len(event_list) == 1:
+                    response, spooled = self._send_to_remotes(event_list[0])
+                else:
+                    response, spooled = self._send_to_remotes(event_list)
+                if response is None:
+                    self._incr_stat(spooled and 'spooled' or 'dropped', len(event_list))
+                    return
+            elif len(event_list) == 1:
+                self.send_sync(**event_list[0])
+            else:
+                self.send_many(event_list)
+        except Exception:
+            self.logger.exception('Unable to send batch of %d events' % (len(event_list),))
+            self.forget_modules(event_list)
+            self._incr_stat('dropped', len(event_list))
+        else:
+            self._incr_stat('sent', len(event_list))
+
     def send(self, **kwargs):
-        self.queue.put_nowait(kwargs)
+        policy = app.config['ASYNC_OVERFLOW']
+        while 1:
+            try:
+                if policy == 'block':
+                    self.queue.put(kwargs, True, app.config['ASYNC_BLOCK_TIMEOUT'])
+                else:
+                    self.queue.put_nowait(kwargs)
+            except Full:
+                if policy != 'drop_oldest':
+                    self.forget_modules(kwargs)
+                    self._incr_stat('dropped')
+                    return
+                try:
+                    record = self.queue.get_nowait()
+                except Empty:
+                    pass
+                else:
+                    if record is not self._terminator:
+                        self.forget_modules(record)
+                        self._incr_stat('dropped')
+                continue
+            self._incr_stat('queued')
+            return
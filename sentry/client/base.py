@@ -12,32 +12,40 @@ import base64
 import datetime
 import hashlib
 import logging
+import os
 import simplejson
+import threading
 import time
 import uuid
 import urllib2
+import zlib
 
 import sentry
 from sentry import app
+from sentry.client.spool import Spool
 from sentry.core import processors
-from sentry.models import Group, Event
-from sentry.utils import get_versions, transform
+from sentry.db.models import count_cache
+from sentry.models import Group, Event, ModuleManifest
+from sentry.utils import transform
 from sentry.utils.api import get_mac_signature, get_auth_header
-
-class ModuleProxyCache(dict):
-    def __missing__(self, key):
-        module, class_name = key.rsplit('.', 1)
-
-        handler = getattr(__import__(module, {}, {}, [class_name], -1), class_name)
-        
-        self[key] = handler
-        
-        return handler
+from sentry.utils.cache import ThrashingCache
+from sentry.utils.http import ConnectionPool
+from sentry.utils.imports import ModuleProxyCache, class_cache
+from sentry.utils.versions import registry as version_registry
 
 class SentryClient(object):
     def __init__(self, *args, **kwargs):
         self.logger = logging.getLogger('sentry.errors')
-        self.module_cache = ModuleProxyCache()
+        self.module_cache = class_cache
+        self.thrashing_cache = ThrashingCache(app.config['THRASHING_CACHE_SIZE'])
+        self._pools = {}
+        self._spool = None
+        self._remote_lock = threading.Lock()
+        self._remote_pid = os.getpid()
+        # the hash of the modules last sent, and when
+        self._modules_sent = (None, 0)
+        # replays events left by processes which have since exited
+        self.get_spool()
 
     def capture(self, event_type, tags=None, data=None, date=None, time_spent=None, event_id=None,
                 extra=None, culprit=None, **kwargs):
@@ -61,15 +69,23 @@ class SentryClient(object):
         >>>     'culprit': 'full.module.name', # or /arbitrary/path
         >>>     # the culprit version information
         >>>     'version': ('full.module.name', 'version string'),
-        >>>     # all detectable installed modules
+        >>>     # all detectable installed modules, sent only when they change (or
+        >>>     # every MODULES_INTERVAL seconds)
         >>>     'modules': {
         >>>         'full.module.name': 'version string',
         >>>     },
+        >>>     # identifies the list of modules
+        >>>     'modules_hash': 'md5 hex digest',
         >>>     # arbitrary data provided by user
         >>>     'extra': {
         >>>         'key': 'value',
-        >>>     }
+        >>>     },
+        >>>     # the number of identical events dropped since the last one sent
+        >>>     'suppressed': 12,
         >>> }
+
+        Events seen more than ``THRASHING_LIMIT`` times within ``THRASHING_TIMEOUT`` seconds
+        are dropped before any data is collected, and ``None`` is returned.
         
         :param event_type: the module path to the Event class. Builtins can use shorthand class
                            notation and exclude the full module path.
@@ -96,7 +112,15 @@ class SentryClient(object):
             # Assume it's a builtin
             event_type = 'sentry.events.%s' % event_type
 
-        handler = self.module_cache[event_type]()
+        handler = self.module_cache.get_instance(event_type)
+
+        suppressed = 0
+        if app.config['THRASHING_TIMEOUT'] and app.config['THRASHING_LIMIT']:
+            cache_key = (event_type, handler.get_checksum(**kwargs))
+            allowed, suppressed = self.thrashing_cache.check(cache_key, app.config['THRASHING_LIMIT'],
+                                                             app.config['THRASHING_TIMEOUT'])
+            if not allowed:
+                return
 
         result = handler.capture(**kwargs)
 
@@ -120,41 +144,24 @@ class SentryClient(object):
         
         tags.append(('server', app.config['NAME']))
 
-        versions = get_versions()
+        modules_hash, versions = version_registry.get_manifest()
 
-        data['modules'] = versions
+        data['modules_hash'] = modules_hash
+        sent_hash, sent_at = self._modules_sent
+        if modules_hash != sent_hash or time.time() - sent_at >= app.config['MODULES_INTERVAL']:
+            data['modules'] = versions
+            self._modules_sent = (modules_hash, time.time())
 
         if culprit:
             data['culprit'] = culprit
 
-            # get list of modules from right to left
-            parts = culprit.split('.')
-            module_list = ['.'.join(parts[:idx]) for idx in xrange(1, len(parts)+1)][::-1]
-            version = None
-            module = None
-            for m in module_list:
-                if m in versions:
-                    module = m
-                    version = versions[m]
-
             # store our "best guess" for application version
+            version = version_registry.get_version(culprit)
             if version:
-                data['version'] = (module, version),
-
-        # TODO: Cache should be handled by the db backend by default (as we expect a fast access backend)
-        # if app.config['THRASHING_TIMEOUT'] and app.config['THRASHING_LIMIT']:
-        #     cache_key = 'sentry:%s:%s' % (kwargs.get('class_name') or '', checksum)
-        #     added = cache.add(cache_key, 1, app.config['THRASHING_TIMEOUT'])
-        #     if not added:
-        #         try:
-        #             thrash_count = cache.incr(cache_key)
-        #         except (KeyError, ValueError):
-        #             # cache.incr can fail. Assume we aren't thrashing yet, and
-        #             # if we are, hope that the next error has a successful
-        #             # cache.incr call.
-        #             thrash_count = 0
-        #         if thrash_count > app.config['THRASHING_LIMIT']:
-        #             return
+                data['version'] = version
+
+        if suppressed:
+            data['suppressed'] = suppressed
 
         # for filter_ in filters.all():
         #     kwargs = filter_(None).process(kwargs) or kwargs
@@ -165,7 +172,7 @@ class SentryClient(object):
         # Run the data through processors
 
         for processor in processors.all():
-            data.update(self.module_cache[processor].process(data))
+            data.update(processor.process(data))
 
         # Make sure all data is coerced
         data = transform(data)
@@ -178,13 +185,48 @@ class SentryClient(object):
         """
         Saves a new event to the datastore.
         """
-        module, class_name = event_type.rsplit('.', 1)
+        params = self._get_store_params(event_type, tags, data, date, time_spent, event_id)
+        # an event is not stored without its counts, and vice versa
+        with app.db.transaction():
+            result = app.db.store_event(*params)
+            self._incr_counts([result])
+        count_cache.clear()
+        return result
+
+    def store_many(self, event_list):
+        """
+        Saves a list of events to the datastore using a single batched write.
 
-        handler = getattr(__import__(module, {}, {}, [class_name], -1), class_name)()
+        Each item in ``event_list`` is a dictionary of the keyword arguments
+        accepted by ``store``.
+        """
+        params = [self._get_store_params(**kwargs) for kwargs in event_list]
+        with app.db.transaction():
+            result = app.db.store_events(params)
+            self._incr_counts(result)
+        count_cache.clear()
+        return result
+
+    def _incr_counts(self, result):
+        # counts events over time, for each group and across all groups
+        counts = []
+        for event, group in result:
+            date = event.date or datetime.datetime.now()
+            counts.extend([(group.pk, date, 1), (None, date, 1)])
+        app.db.incr_counts(Group, counts)
+
+    def _get_store_params(self, event_type, tags, data, date, time_spent, event_id, **kwargs):
+        # returns the (event, group, data) for the backend's store_event
+        if 'modules' in data:
+            # each distinct list of modules is only stored once
+            data = dict(data)
+            data['modules_hash'] = ModuleManifest.store(data.pop('modules'))
+
+        handler = self.module_cache.get_instance(event_type)
 
         event_hash = hashlib.md5('|'.join(k or '' for k in handler.get_event_hash(**data[handler.interface]))).hexdigest()
 
-        event = Event.objects.create(
+        event = Event(
             pk=event_id,
             type=event_type,
             hash=event_hash,
@@ -192,72 +234,226 @@ class SentryClient(object):
             time_spent=time_spent,
             tags=tags,
         )
-        event.set_meta(**data)
 
-        event_message = handler.to_string(data[handler.interface])
-
-        group, created = Group.objects.get_or_create(
+        group = Group(
             type=event_type,
             hash=event_hash,
-            defaults={
-                'count': 1,
-                'time_spent': time_spent or 0,
-                'tags': tags,
-                'message': event_message,
-            }
+            count=1,
+            time_spent=time_spent or 0,
+            tags=tags,
+            message=handler.to_string(data[handler.interface]),
+            first_seen=date,
+            last_seen=date,
         )
-        if not created:
-            group.incr('count')
-            if time_spent:
-                group.incr('time_spent', time_spent)
 
-        group.update(last_seen=event.date, score=group.get_score())
+        return event, group, data
 
-        group.add_relation(event, date.strftime('%s.%m'))
+    def get_pool(self, url):
+        """
+        Returns the pool of keep-alive connections to the server of ``url``.
+        """
+        # scheme://host:port
+        key = '/'.join(url.split('/', 3)[:3])
+        self._remote_lock.acquire()
+        try:
+            self._check_pid()
+            pool = self._pools.get(key)
+            if pool is None:
+                pool = self._pools[key] = ConnectionPool(url, app.config['REMOTE_POOL_SIZE'],
+                                                         app.config['REMOTE_TIMEOUT'])
+            return pool
+        finally:
+            self._remote_lock.release()
+
+    def get_spool(self):
+        """
+        Returns the spool for events which could not be sent, or ``None``
+        unless ``SPOOL_DIR`` is set. Its replay thread is started along with
+        it.
+        """
+        if not app.config['SPOOL_DIR']:
+            return None
+        self._remote_lock.acquire()
+        try:
+            self._check_pid()
+            if self._spool is None:
+                self._spool = Spool(app.config['SPOOL_DIR'], self.replay_remote,
+                    segment_size=app.config['SPOOL_SEGMENT_SIZE'],
+                    max_size=app.config['SPOOL_MAX_SIZE'],
+                    fsync_interval=app.config['SPOOL_FSYNC_INTERVAL'],
+                    retry_interval=app.config['SPOOL_RETRY_INTERVAL'],
+                    max_retry_interval=app.config['SPOOL_MAX_RETRY_INTERVAL'],
+                )
+                self._spool.start()
+            return self._spool
+        finally:
+            self._remote_lock.release()
+
+    def _check_pid(self):
+        # connections and segment files must not be shared with the parent
+        # process, whose threads are gone
+        if self._remote_pid != os.getpid():
+            if self._spool is not None:
+                self._spool.close()
+            self._pools, self._spool, self._remote_pid = {}, None, os.getpid()
 
-        # TODO: we need to manually add indexes per sort+filter value pair
+    def send_remote(self, url, data, headers=None):
+        return self.get_pool(url).urlopen(url, data, headers)
 
-        return event, group
+    def _dumps(self, data):
+        def coerce(kwargs):
+            if kwargs.get('date'):
+                kwargs = dict(kwargs, date=kwargs['date'].strftime('%Y-%m-%dT%H:%M:%S.%f'))
+            return kwargs
 
-    def send_remote(self, url, data, headers=None):
-        if headers is None:
-            headers = {}
-        req = urllib2.Request(url, headers=headers)
-        try:
-            response = urllib2.urlopen(req, data, app.config['REMOTE_TIMEOUT']).read()
-        except:
-            response = urllib2.urlopen(req, data).read()
-        return response
+        if isinstance(data, list):
+            data = [coerce(kwargs) for kwargs in data]
+        else:
+            data = coerce(data)
+        return simplejson.dumps(data)
+
+    def encode_request(self, data):
+        """
+        Returns the body and headers of a request to the storage API for a
+        single event (or a list of events), as set by ``REMOTE_ENCODING``.
+        """
+        return self._encode_payload(self._dumps(data))
+
+    def _encode_payload(self, payload):
+        level = app.config['REMOTE_COMPRESSION_LEVEL']
+        if app.config['REMOTE_ENCODING'] != 'raw':
+            return base64.b64encode(zlib.compress(payload, level)), {'Content-Type': 'application/octet-stream'}
+        if not level:
+            return payload, {'Content-Type': 'application/json'}
+        return zlib.compress(payload, level), {
+            'Content-Type': 'application/octet-stream',
+            'Content-Encoding': 'deflate',
+        }
 
     def send(self, **kwargs):
         "Sends the message to the server."
         if app.config['REMOTES']:
-            if kwargs.get('date'):
-                kwargs['date'] = kwargs['date'].strftime('%Y-%m-%dT%H:%M:%S.%f')
-            for url in app.config['REMOTES']:
-                message = base64.b64encode(simplejson.dumps(kwargs).encode('zlib'))
-                timestamp = time.time()
-                nonce = uuid.uuid4().hex
-                signature = get_mac_signature(app.config['KEY'], message, nonce, timestamp)
-                headers={
-                    'Authorization': get_auth_header(signature, timestamp, '%s/%s' % (self.__class__.__name__, sentry.VERSION), nonce),
-                    'Content-Type': 'application/octet-stream',
-                }
-                
-                try:
-                    return self.send_remote(url=url, data=message, headers=headers)
-                except urllib2.HTTPError, e:
-                    body = e.read()
-                    self.logger.error('Unable to reach Sentry log server: %s (url: %%s, body: %%s)' % (e,), url, body,
-                                 exc_info=True, extra={'data':{'body': body, 'remote_url': url}})
-                    self.logger.log(kwargs.pop('level', None) or logging.ERROR, kwargs.pop('message', None))
-                except urllib2.URLError, e:
-                    self.logger.error('Unable to reach Sentry log server: %s (url: %%s)' % (e,), url,
-                                 exc_info=True, extra={'data':{'remote_url': url}})
-                    self.logger.log(kwargs.pop('level', None) or logging.ERROR, kwargs.pop('message', None))
+            return self.send_to_remotes(kwargs)
         else:
             return self.store(**kwargs)
 
+    def send_many(self, event_list):
+        "Sends a list of messages to the server in a single request."
+        if app.config['REMOTES']:
+            return self.send_to_remotes(event_list)
+        else:
+            return self.store_many(event_list)
+
+    def send_to_remotes(self, data):
+        """
+        Sends the message to every server in ``REMOTES`` at once, and returns
+        the response of the first (in that order) which accepted it, or
+        ``None`` if none did.
+        """
+        return self._send_to_remotes(data)[0]
+
+    def _send_to_remotes(self, data):
+        # returns (response, spooled), where spooled is whether the message
+        # was spooled for any server which did not accept it
+        message, headers = self.encode_request(data)
+        urls = app.config['REMOTES']
+        results = [(None, False)] * len(urls)
+
+        def send(n):
+            results[n] = self._send_to_remote(urls[n], message, headers, data)
+
+        threads = [threading.Thread(target=send, args=(n,)) for n in xrange(1, len(urls))]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        send(0)
+        # each request is bounded by REMOTE_TIMEOUT
+        for thread in threads:
+            thread.join()
+
+        spooled = False
+        for response, result_spooled in results:
+            if response is not None:
+                return response, spooled
+            spooled = spooled or result_spooled
+        return None, spooled
+
+    def _send_signed(self, url, message, headers):
+        timestamp = time.time()
+        nonce = uuid.uuid4().hex
+        signature = get_mac_signature(app.config['KEY'], message, nonce, timestamp)
+        headers = dict(headers,
+            Authorization=get_auth_header(signature, timestamp, '%s/%s' % (self.__class__.__name__, sentry.VERSION), nonce),
+        )
+        return self.send_remote(url=url, data=message, headers=headers)
+
+    def _send_to_remote(self, url, message, headers, data):
+        # returns (response, spooled)
+        try:
+            return self._send_signed(url, message, headers), False
+        except urllib2.HTTPError, e:
+            body = e.read()
+            self.logger.error('Unable to reach Sentry log server: %s (url: %%s, body: %%s)' % (e,), url, body,
+                         exc_info=True, extra={'data':{'body': body, 'remote_url': url}})
+            if e.code >= 500:
+                return None, self.spool_failed(url, data)
+            # the server will never accept it
+            self.forget_modules(data)
+            self.log_failed(data)
+            return None, False
+        except urllib2.URLError, e:
+            self.logger.error('Unable to reach Sentry log server: %s (url: %%s)' % (e,), url,
+                         exc_info=True, extra={'data':{'remote_url': url}})
+            return None, self.spool_failed(url, data)
+
+    def spool_failed(self, url, data):
+        """
+        Spools events which could not be sent to ``url``, to be replayed once
+        it is back, or writes them to the error log without a spool (or if
+        the spool is full). Returns whether they were spooled.
+        """
+        spool = self.get_spool()
+        if spool is None or not spool.write(url, self._dumps(data)):
+            self.forget_modules(data)
+            self.log_failed(data)
+            return False
+        return True
+
+    def replay_remote(self, url, payload):
+        """
+        Sends events from the spool to ``url``, raising if it is still
+        unavailable.
+        """
+        message, headers = self._encode_payload(payload)
+        try:
+            self._send_signed(url, message, headers)
+        except urllib2.HTTPError, e:
+            if e.code >= 500:
+                raise
+            self.logger.error('Dropping spooled events rejected by Sentry log server: %s (url: %%s, body: %%s)' % (e,),
+                              url, e.read(), extra={'data': {'remote_url': url}})
+            data = simplejson.loads(payload)
+            self.forget_modules(data)
+            self.log_failed(data)
+
+    def forget_modules(self, data):
+        """
+        Called with events which will never reach the server. If any of them
+        carried the list of modules, the next event carries it again, as
+        the server may not have it.
+        """
+        if not isinstance(data, list):
+            data = [data]
+        if any('modules' in (kwargs.get('data') or {}) for kwargs in data):
+            self._modules_sent = (None, 0)
+
+    def log_failed(self, data):
+        "Writes events which could not be sent to the error log."
+        if not isinstance(data, list):
+            data = [data]
+        for kwargs in data:
+            self.logger.log(kwargs.get('level') or logging.ERROR, kwargs.get('message'))
+
 class DummyClient(SentryClient):
     "Sends events into an empty void"
     def send(self, **kwargs):
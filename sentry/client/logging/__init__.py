@@ -24,9 +24,7 @@ class LoggingSentryClient(SentryClient):
     def send(self, event_type, data, **kwargs):
         exc_info = sys.exc_info()
 
-        module, class_name = event_type.rsplit('.', 1)
-
-        handler = getattr(__import__(module, {}, {}, [class_name], -1), class_name)()
+        handler = self.module_cache.get_instance(event_type)
 
         message = handler.to_string(data[handler.interface])
 
@@ -0,0 +1,300 @@
+"""
+sentry.client.spool
+~~~~~~~~~~~~~~~~~~~
+
+An on-disk spool for events which could not be sent to a remote.
+
+Each process appends to its own segment file, which is closed once it
+reaches the segment size (or is about to be replayed). A background
+thread replays closed segments, of this process or any other which
+spools to the same directory, in the order they were created, and
+deletes each once every event in it was delivered. Events are delivered
+at least once: a process which dies while replaying a segment leaves it
+to be replayed again from the start.
+
+Each record is the length and CRC32 of its body, followed by the remote's
+URL and the serialized events, separated by a newline. A record cut
+short by a crash is detected by its length or CRC, and skipped along with
+the rest of its segment.
+
+:copyright: (c) 2010 by the Sentry Team, see AUTHORS for more details.
+:license: BSD, see LICENSE for more details.
+"""
+
+from __future__ import absolute_import
+
+import atexit
+import errno
+import fcntl
+import logging
+import os
+import struct
+import threading
+import time
+import zlib
+
+HEADER = struct.Struct('>Ii')
+
+SUFFIX = '.spool'
+
+# segments being created, see Spool._open
+TMP_SUFFIX = '.tmp'
+
+class Spool(object):
+    """
+    Spools events to segment files in ``path``, and replays them through
+    ``send(url, payload)``, which raises if the remote is still unavailable.
+
+    Segments are rotated at ``segment_size`` bytes, and events are dropped
+    while the segments in ``path`` take up more than ``max_size`` bytes.
+    Writes are synced to disk at most every ``fsync_interval`` seconds.
+
+    Replay is retried after ``retry_interval`` seconds, doubling up to
+    ``max_retry_interval`` while the remote is unavailable. The replay
+    thread is stopped when the interpreter exits.
+    """
+    def __init__(self, path, send, segment_size=1024 * 1024, max_size=100 * 1024 * 1024,
+                 fsync_interval=1.0, retry_interval=1.0, max_retry_interval=300):
+        self.path = path
+        self.send = send
+        self.segment_size = segment_size
+        self.max_size = max_size
+        self.fsync_interval = fsync_interval
+        self.retry_interval = retry_interval
+        self.max_retry_interval = max_retry_interval
+        self.logger = logging.getLogger('sentry.errors')
+
+        self._file = None
+        self._synced = 0
+        self._size = None
+        self._offsets = {}
+        self._lock = threading.Lock()
+        self._replay_lock = threading.Lock()
+        self._wake = threading.Event()
+        # set to stop the current replay thread
+        self._stopping = threading.Event()
+        self._thread = None
+        self._atexit = False
+
+        if not os.path.isdir(path):
+            try:
+                os.makedirs(path)
+            except OSError, e:
+                if e.errno != errno.EEXIST:
+                    raise
+
+    def _get_segments(self):
+        # returns the path of each segment in the directory, oldest first
+        names = [n for n in os.listdir(self.path) if n.endswith(SUFFIX)]
+        names.sort(key=lambda n: tuple(int(p) for p in n[:-len(SUFFIX)].split('-')))
+        return [os.path.join(self.path, n) for n in names]
+
+    def _get_size(self):
+        size = 0
+        for path in self._get_segments():
+            try:
+                size += os.path.getsize(path)
+            except OSError:
+                # replayed and deleted since
+                pass
+        return size
+
+    ## Writing
+
+    def write(self, url, payload):
+        """
+        Appends the serialized events ``payload`` for ``url`` to the spool,
+        and wakes the replay thread. Returns ``False`` if the spool is full.
+        """
+        body = '%s\n%s' % (url, payload)
+        record = HEADER.pack(len(body), zlib.crc32(body)) + body
+
+        self._lock.acquire()
+        try:
+            if self._size is None:
+                self._size = self._get_size()
+            if self._size + len(record) > self.max_size:
+                return False
+
+            if self._file is None:
+                self._open()
+            self._file.write(record)
+            self._file.flush()
+            self._size += len(record)
+
+            if time.time() - self._synced >= self.fsync_interval:
+                self._sync()
+            if self._file.tell() >= self.segment_size:
+                self._close()
+        finally:
+            self._lock.release()
+
+        self.start()
+        self._wake.set()
+        return True
+
+    def _open(self):
+        name = '%d-%d' % (int(time.time() * 1000000), os.getpid())
+        path = os.path.join(self.path, name + SUFFIX)
+        # created under a name replay ignores, as it would otherwise take the
+        # empty segment for a replayed one and delete it before it is locked
+        tmp_path = os.path.join(self.path, name + TMP_SUFFIX)
+        self._file = open(tmp_path, 'ab')
+        # held until the segment is closed, so that it is not replayed while
+        # it is being written
+        fcntl.flock(self._file.fileno(), fcntl.LOCK_EX)
+        os.rename(tmp_path, path)
+
+    def _sync(self):
+        os.fsync(self._file.fileno())
+        self._synced = time.time()
+
+    def _close(self):
+        self._sync()
+        self._file.close()
+        self._file = None
+
+    def rotate(self):
+        """
+        Closes the current segment, if any, so that it can be replayed.
+        """
+        self._lock.acquire()
+        try:
+            if self._file is not None:
+                self._close()
+            # other processes may have written or replayed segments
+            self._size = None
+        finally:
+            self._lock.release()
+
+    def close(self):
+        """
+        Closes the current segment without syncing it, e.g. in a forked
+        process, which must not write to its parent's segment.
+        """
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    ## Replay
+
+    def start(self):
+        self._lock.acquire()
+        try:
+            if not self._thread:
+                # each thread has its own flag, so that one which is still
+                # stopping does not carry on once another has started
+                self._stopping = threading.Event()
+                self._thread = threading.Thread(target=self._target, args=(self._stopping,))
+                self._thread.setDaemon(True)
+                self._thread.start()
+                if not self._atexit:
+                    atexit.register(self.stop)
+                    self._atexit = True
+        finally:
+            self._lock.release()
+
+    def stop(self, timeout=None):
+        """
+        Stops the replay thread, which finishes sending the current event
+        first, waiting up to ``timeout`` seconds (or for as long as it takes,
+        if ``None``). No further events are replayed until it is started
+        again.
+        """
+        self._lock.acquire()
+        try:
+            thread, self._thread = self._thread, None
+            self._stopping.set()
+        finally:
+            self._lock.release()
+        if thread is not None:
+            self._wake.set()
+            thread.join(timeout)
+
+    def _target(self, stopping):
+        # looks for segments left by other processes once started
+        self._wake.set()
+        while not stopping.isSet():
+            # woken by each write, and otherwise looks for segments left by
+            # other processes every max_retry_interval seconds
+            self._wake.wait(self.max_retry_interval)
+            self._wake.clear()
+
+            delay = self.retry_interval
+            # give the remote time to come back
+            while not stopping.wait(delay):
+                try:
+                    self.replay()
+                except Exception, e:
+                    delay = min(delay * 2, self.max_retry_interval)
+                    self.logger.warning('Unable to replay spooled events, retrying in %.1f seconds: %s' % (delay, e))
+                else:
+                    break
+
+    def replay(self):
+        """
+        Sends the events in every closed segment, in order, and deletes each
+        segment once it was delivered. Segments which another process is
+        writing or replaying are skipped. Stops at the first record which
+        cannot be sent, raising its error.
+
+        Returns the number of records sent.
+        """
+        self._replay_lock.acquire()
+        try:
+            self.rotate()
+            return sum(self._replay_segment(path) for path in self._get_segments())
+        finally:
+            self._replay_lock.release()
+
+    def _replay_segment(self, path):
+        try:
+            fp = open(path, 'rb')
+        except IOError, e:
+            if e.errno == errno.ENOENT:
+                # replayed by another process
+                return 0
+            raise
+        try:
+            try:
+                fcntl.flock(fp.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError, e:
+                if e.errno in (errno.EAGAIN, errno.EACCES):
+                    return 0
+                raise
+            if not os.path.exists(path):
+                # replayed by another process since it was opened
+                return 0
+
+            sent = 0
+            fp.seek(self._offsets.get(path, 0))
+            for offset, url, payload in self._read(fp, path):
+                if self._stopping.isSet():
+                    # left to be replayed by the next process
+                    return sent
+                self.send(url, payload)
+                self._offsets[path] = offset
+                sent += 1
+
+            os.unlink(path)
+            self._offsets.pop(path, None)
+            return sent
+        finally:
+            fp.close()
+
+    def _read(self, fp, path):
+        # yields (offset after the record, url, payload) for each record
+        while True:
+            header = fp.read(HEADER.size)
+            if not header:
+                return
+            if len(header) == HEADER.size:
+                length, crc = HEADER.unpack(header)
+                body = fp.read(length)
+                if len(body) == length and zlib.crc32(body) == crc:
+                    url, payload = body.split('\n', 1)
+                    yield fp.tell(), url, payload
+                    continue
+            self.logger.error('Skipping the rest of %s, which is corrupt at byte %d' % (
+                path, fp.tell() - len(header)))
+            return
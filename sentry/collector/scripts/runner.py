@@ -7,25 +7,28 @@ sentry.collector.scripts.runner
 :license: BSD, see LICENSE for more details.
 """
 
-import eventlet
+import logging
 import os
 import os.path
+import signal
 import sys
 
 from daemon.daemon import DaemonContext
 from daemon.runner import DaemonRunner, make_pidlockfile
-from eventlet import wsgi
 from optparse import OptionParser
 
 from sentry import VERSION, app
+from sentry.collector.server import PreforkServer
+from sentry.core.scripts.cleaner import add_cleanup_options, run_cleanup
 from sentry.middleware import WSGIErrorMiddleware
+from sentry.utils.imports import class_cache
 
 class SentryCollector(DaemonRunner):
     pidfile_timeout = 10
     start_message = u"started with pid %(pid)d"
 
     def __init__(self, host=None, port=None, pidfile=None,
-                 logfile=None, daemonize=False, debug=False):
+                 logfile=None, daemonize=False, debug=False, workers=None, config=None):
         if not logfile:
             logfile = app.config['WEB_LOG_FILE']
 
@@ -49,6 +52,8 @@ class SentryCollector(DaemonRunner):
         self.port = port or app.config['WEB_PORT']
 
         self.debug = debug
+        self.workers = workers or app.config['COLLECTOR_WORKERS']
+        self.config = config
 
         # HACK: set app to self so self.app.run() works
         self.app = self
@@ -65,41 +70,43 @@ class SentryCollector(DaemonRunner):
         # Import views/templatetags to ensure registration
         import sentry.collector.views
 
+        # before forking, so that workers share the imported classes
+        class_cache.warm(app.config['PRELOAD_CLASSES'])
+
         upgrade()
         app.wsgi_app = WSGIErrorMiddleware(app.wsgi_app)
         if self.debug:
             app.run(host=self.host, port=self.port, debug=self.debug)
         else:
-            wsgi.server(eventlet.listen((self.host, self.port)), app)
-
-def cleanup(days=30, tags=None):
-    from sentry.models import Group, Event
-    import datetime
-    
-    ts = datetime.datetime.now() - datetime.timedelta(days=days)
-    
-    for event in Event.objects.order_by('date'):
-        if event.date > ts:
-            break
-        event.delete()
-    
-    for group in Group.objects.order_by('last_seen'):
-        if group.last_seen > ts:
-            break
-        event.delete()
-
+            logging.getLogger('sentry.collector.server').setLevel(logging.INFO)
+            server = PreforkServer(app, self.host, self.port,
+                                   workers=self.workers,
+                                   concurrency=app.config['COLLECTOR_CONCURRENCY'],
+                                   health_interval=app.config['COLLECTOR_HEALTH_INTERVAL'],
+                                   timeout=app.config['COLLECTOR_WORKER_TIMEOUT'],
+                                   graceful_timeout=app.config['COLLECTOR_GRACEFUL_TIMEOUT'],
+                                   on_reload=lambda: load_config(self.config))
+            server.run()
+
+    def reload(self):
+        # the running server replaces its workers on SIGHUP
+        os.kill(self.pidfile.read_pid(), signal.SIGHUP)
 
 def upgrade():
-    pass
-    # from sentry.conf import settings
-    # 
-    # call_command('syncdb', database=settings.DATABASE_USING or 'default', interactive=False)
-    # 
-    # if 'south' in django_settings.INSTALLED_APPS:
-    #     call_command('migrate', database=settings.DATABASE_USING or 'default', interactive=False)
+    # data migrations, e.g. indexing groups stored by earlier versions
+    from sentry.core.upgrade import upgrade
+    upgrade()
+
+def load_config(path=None):
+    if path:
+        app.config.from_pyfile(path)
+    else:
+        config_path = os.path.expanduser(os.path.join('~', '.sentry', 'sentry.conf.py'))
+        if os.path.exists(config_path):
+            app.config.from_pyfile(config_path)
 
 def main():
-    command_list = ('start', 'stop', 'restart', 'cleanup', 'upgrade')
+    command_list = ('start', 'stop', 'restart', 'reload', 'cleanup', 'upgrade')
     args = sys.argv
     if len(args) < 2 or args[1] not in command_list:
         print "usage: sentry [command] [options]"
@@ -115,27 +122,21 @@ def main():
         parser.add_option('--debug', action='store_true', default=False, dest='debug')
         parser.add_option('--host', metavar='HOSTNAME')
         parser.add_option('--port', type=int, metavar='PORT')
+        parser.add_option('--workers', type=int, metavar='NUM',
+                          help='Number of worker processes, overriding COLLECTOR_WORKERS.')
         parser.add_option('--daemon', action='store_true', default=False, dest='daemonize')
         parser.add_option('--no-daemon', action='store_false', default=False, dest='daemonize')
         parser.add_option('--pidfile', dest='pidfile')
         parser.add_option('--logfile', dest='logfile')
-    elif args[1] == 'stop':
+    elif args[1] in ('stop', 'reload'):
         parser.add_option('--pidfile', dest='pidfile')
         parser.add_option('--logfile', dest='logfile')
     elif args[1] == 'cleanup':
-        parser.add_option('--days', default='30', type=int,
-                          help='Numbers of days to truncate on.')
-        parser.add_option('--tags',
-                          help='Limit truncation to only entries tagged with key:value.')
+        add_cleanup_options(parser)
 
     (options, args) = parser.parse_args()
 
-    if options.config:
-        app.config.from_pyfile(options.config)
-    else:
-        config_path = os.path.expanduser(os.path.join('~', '.sentry', 'sentry.conf.py'))
-        if os.path.exists(config_path):
-            app.config.from_pyfile(config_path)
+    load_config(options.config)
 
     if args[0] == 'upgrade':
         upgrade()
@@ -143,7 +144,8 @@ def main():
     elif args[0] == 'start':
         web = SentryCollector(host=options.host, port=options.port,
                            pidfile=options.pidfile, logfile=options.logfile,
-                           daemonize=options.daemonize, debug=options.debug)
+                           daemonize=options.daemonize, debug=options.debug,
+                           workers=options.workers, config=options.config)
         web.execute(args[0])
 
     elif args[0] == 'restart':
@@ -154,8 +156,12 @@ def main():
         web = SentryCollector(pidfile=options.pidfile, logfile=options.logfile)
         web.execute(args[0])
 
+    elif args[0] == 'reload':
+        web = SentryCollector(pidfile=options.pidfile, logfile=options.logfile)
+        web.reload()
+
     elif args[0] == 'cleanup':
-        cleanup(days=options.days, tags=options.tags)
+        run_cleanup(options)
 
     sys.exit(0)
 
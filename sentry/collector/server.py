@@ -0,0 +1,322 @@
+"""
+sentry.collector.server
+~~~~~~~~~~~~~~~~~~~~~~~
+
+A pre-fork server for the collector. The master process binds the
+listening socket and forks worker processes, each of which accepts
+connections from that socket and serves them from green threads.
+
+Workers report their health to the master through a pipe. The master
+replaces workers which exit or stop reporting, logs the health of each,
+and on ``SIGHUP`` replaces every worker without dropping a connection.
+
+:copyright: (c) 2010 by the Sentry Team, see AUTHORS for more details.
+:license: BSD, see LICENSE for more details.
+"""
+
+import errno
+import fcntl
+import logging
+import os
+import resource
+import select
+import signal
+import time
+
+import eventlet
+import simplejson
+from eventlet import greenpool, wsgi
+
+from sentry.db import get_backend
+from sentry.db.backends.memory import MemoryBackend
+
+logger = logging.getLogger('sentry.collector.server')
+
+def get_rss():
+    # the current resident set size of this process in KB, or None where
+    # /proc is not available
+    try:
+        fp = open('/proc/self/statm')
+        try:
+            pages = int(fp.read().split()[1])
+        finally:
+            fp.close()
+    except (IOError, ValueError, IndexError):
+        return None
+    return pages * resource.getpagesize() // 1024
+
+class Worker(object):
+    """
+    Serves up to ``concurrency`` connections from ``sock`` at once, and
+    writes its health to the pipe ``health_fd`` every ``interval`` seconds.
+
+    On ``SIGTERM`` (or ``SIGINT``) it stops accepting connections, and
+    exits once its requests are finished or ``graceful_timeout`` seconds
+    have passed.
+    """
+    def __init__(self, app, sock, health_fd, concurrency=1000, interval=5, graceful_timeout=30):
+        self.app = app
+        self.sock = sock
+        self.health_fd = health_fd
+        self.concurrency = concurrency
+        self.interval = interval
+        self.graceful_timeout = graceful_timeout
+        self.alive = True
+        self.requests = 0
+        self.errors = 0
+        self.pool = None
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.handle_stop)
+        signal.signal(signal.SIGINT, self.handle_stop)
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+
+        # blocking calls to the datastore must yield to other green threads,
+        # and connections opened before forking are shared with the master
+        eventlet.monkey_patch()
+        self.app.db = get_backend(self.app)
+
+        self.pool = greenpool.GreenPool(self.concurrency)
+        server = eventlet.spawn(wsgi.server, self.sock, self.handle, custom_pool=self.pool,
+                                log_output=False, debug=False)
+
+        next_report = 0
+        while self.alive:
+            if time.time() >= next_report:
+                self.report()
+                next_report = time.time() + self.interval
+            eventlet.sleep(0.1)
+
+        server.kill()
+        with eventlet.Timeout(self.graceful_timeout, False):
+            self.pool.waitall()
+        self.report()
+
+    def handle(self, environ, start_response):
+        self.requests += 1
+
+        def _start_response(status, headers, exc_info=None):
+            if status.startswith('5'):
+                self.errors += 1
+            return start_response(status, headers, exc_info)
+
+        return self.app(environ, _start_response)
+
+    def handle_stop(self, signum, frame):
+        self.alive = False
+
+    def report(self):
+        health = {
+            'requests': self.requests,
+            'errors': self.errors,
+            'active': self.pool.running(),
+            'rss': get_rss(),
+            # the peak, in KB on Linux
+            'max_rss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            'stopping': not self.alive,
+        }
+        os.write(self.health_fd, simplejson.dumps(health) + '\n')
+
+class WorkerProcess(object):
+    # the master's view of a worker
+    def __init__(self, pid, fd, generation):
+        self.pid = pid
+        self.fd = fd
+        self.generation = generation
+        self.started = self.last_report = time.time()
+        self.health = {}
+        self.buffer = ''
+        self.logged_requests = 0
+        self.stopping = False
+
+class PreforkServer(object):
+    """
+    Serves ``app`` on (``host``, ``port``) from ``workers`` processes.
+
+    ``on_reload`` is called on ``SIGHUP``, e.g. to read the configuration
+    again, after which new workers replace the existing ones. Workers which
+    have not reported for ``timeout`` seconds are killed and replaced.
+    """
+    def __init__(self, app, host, port, workers=1, concurrency=1000, health_interval=5,
+                 timeout=30, graceful_timeout=30, on_reload=None):
+        self.app = app
+        self.host = host
+        self.port = port
+        self.num_workers = workers
+        self.concurrency = concurrency
+        self.health_interval = health_interval
+        self.timeout = timeout
+        self.graceful_timeout = graceful_timeout
+        self.on_reload = on_reload
+        self.workers = {}
+        self.generation = 0
+        self.sock = None
+        self._signals = []
+
+    def run(self):
+        if self.num_workers > 1 and isinstance(self.app.db, MemoryBackend):
+            logger.warning('Each worker keeps its own data with the in-memory datastore')
+
+        self.sock = eventlet.listen((self.host, self.port))
+        for signum in (signal.SIGHUP, signal.SIGTERM, signal.SIGINT, signal.SIGCHLD):
+            signal.signal(signum, self.handle_signal)
+        logger.info('Listening on %s:%d with %d workers' % (self.host, self.port, self.num_workers))
+
+        next_status = time.time() + self.health_interval
+        try:
+            self.spawn_workers()
+            while True:
+                self.read_health()
+                self.reap_workers()
+
+                while self._signals:
+                    signum = self._signals.pop(0)
+                    if signum == signal.SIGHUP:
+                        self.reload()
+                    elif signum in (signal.SIGTERM, signal.SIGINT):
+                        return
+
+                self.kill_unresponsive_workers()
+                self.spawn_workers()
+
+                if time.time() >= next_status:
+                    self.log_status()
+                    next_status = time.time() + self.health_interval
+        finally:
+            self.stop()
+
+    def handle_signal(self, signum, frame):
+        # handled by the main loop, which the signal wakes from select
+        if signum != signal.SIGCHLD:
+            self._signals.append(signum)
+
+    ## Workers
+
+    def spawn_workers(self):
+        current = [w for w in self.workers.itervalues() if w.generation == self.generation]
+        for n in xrange(self.num_workers - len(current)):
+            self.spawn_worker()
+
+    def spawn_worker(self):
+        read_fd, write_fd = os.pipe()
+        pid = os.fork()
+        if pid:
+            os.close(write_fd)
+            fcntl.fcntl(read_fd, fcntl.F_SETFL, fcntl.fcntl(read_fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+            self.workers[pid] = WorkerProcess(pid, read_fd, self.generation)
+            logger.info('Started worker %d' % pid)
+            return
+
+        # the worker, which must never return into the master's loop
+        status = 1
+        try:
+            try:
+                os.close(read_fd)
+                for worker in self.workers.itervalues():
+                    os.close(worker.fd)
+                signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+                Worker(self.app, self.sock, write_fd, self.concurrency, self.health_interval,
+                       self.graceful_timeout).run()
+                status = 0
+            except Exception, e:
+                logger.exception('Worker %d failed: %s' % (os.getpid(), e))
+        finally:
+            os._exit(status)
+
+    def stop_worker(self, worker, signum=signal.SIGTERM):
+        worker.stopping = True
+        try:
+            os.kill(worker.pid, signum)
+        except OSError, e:
+            if e.errno != errno.ESRCH:
+                raise
+
+    def reap_workers(self):
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError, e:
+                if e.errno == errno.ECHILD:
+                    return
+                raise
+            if not pid:
+                return
+            worker = self.workers.pop(pid, None)
+            if worker is None:
+                continue
+            os.close(worker.fd)
+            if not worker.stopping:
+                logger.error('Worker %d exited unexpectedly with status %d' % (pid, status))
+
+    def kill_unresponsive_workers(self):
+        now = time.time()
+        for worker in self.workers.values():
+            if worker.stopping:
+                # left to finish its requests, within the graceful timeout
+                if now - worker.last_report > self.graceful_timeout + self.timeout:
+                    self.stop_worker(worker, signal.SIGKILL)
+            elif now - worker.last_report > self.timeout:
+                logger.error('Worker %d has not reported for %d seconds, killing it' % (
+                    worker.pid, now - worker.last_report))
+                self.stop_worker(worker, signal.SIGKILL)
+                worker.stopping = False
+
+    def reload(self):
+        logger.info('Reloading')
+        if self.on_reload is not None:
+            self.on_reload()
+        self.generation += 1
+        old_workers = self.workers.values()
+        self.spawn_workers()
+        for worker in old_workers:
+            self.stop_worker(worker)
+
+    def stop(self):
+        for worker in self.workers.values():
+            self.stop_worker(worker)
+        deadline = time.time() + self.graceful_timeout
+        while self.workers and time.time() < deadline:
+            self.read_health(timeout=0.1)
+            self.reap_workers()
+        for worker in self.workers.values():
+            self.stop_worker(worker, signal.SIGKILL)
+        self.sock.close()
+
+    ## Health
+
+    def read_health(self, timeout=1.0):
+        fds = dict((w.fd, w) for w in self.workers.itervalues())
+        try:
+            readable = select.select(fds.keys(), [], [], timeout)[0]
+        except select.error, e:
+            if e.args[0] == errno.EINTR:
+                return
+            raise
+        for fd in readable:
+            worker = fds[fd]
+            try:
+                data = os.read(fd, 65536)
+            except OSError, e:
+                if e.errno in (errno.EAGAIN, errno.EINTR):
+                    continue
+                raise
+            lines = (worker.buffer + data).split('\n')
+            worker.buffer = lines.pop()
+            for line in lines:
+                worker.health = simplejson.loads(line)
+                worker.last_report = time.time()
+
+    def log_status(self):
+        for worker in sorted(self.workers.itervalues(), key=lambda w: w.pid):
+            health = worker.health
+            if not health:
+                continue
+            requests = health['requests']
+            if health['rss'] is None:
+                memory = 'peak %d KB' % health['max_rss']
+            else:
+                memory = '%d KB (peak %d KB)' % (health['rss'], health['max_rss'])
+            logger.info('Worker %d: %d requests (%.1f/s), %d active, %d errors, %s%s' % (
+                worker.pid, requests, (requests - worker.logged_requests) / float(self.health_interval),
+                health['active'], health['errors'], memory, health['stopping'] and ', stopping' or ''))
+            worker.logged_requests = requests
@@ -16,14 +16,44 @@ from sentry import app
 from sentry.utils import is_float
 from sentry.utils.api import get_mac_signature, parse_auth_header
 
-from flask import request, abort
+from flask import request, abort, Response
+
+# the keyword arguments required by ``SentryClient.store``
+REQUIRED_FIELDS = ('event_type', 'tags', 'data', 'date', 'time_spent', 'event_id')
+
+def get_event_kwargs(data):
+    """
+    Coerces a decoded event into the keyword arguments accepted by
+    ``SentryClient.store``.
+    """
+    # XXX: ensure keys are coerced to strings
+    data = dict((str(k), v) for k, v in data.iteritems())
+
+    if 'date' in data:
+        if is_float(data['date']):
+            data['date'] = datetime.datetime.fromtimestamp(float(data['date']))
+        else:
+            if '.' in data['date']:
+                format = '%Y-%m-%dT%H:%M:%S.%f'
+            else:
+                format = '%Y-%m-%dT%H:%M:%S'
+            data['date'] = datetime.datetime.strptime(data['date'], format)
+
+    return data
 
 @app.route('/api/store/', methods=['POST'])
 def store():
     """
-    Accepts a gzipped JSON POST body.
+    Accepts a gzipped JSON POST body, base64 encoded unless it is sent with
+    ``Content-Encoding: deflate``, or a plain JSON body sent as
+    ``application/json``.
     
     If ``PUBLIC_WRITES`` is truthy, the Authorization header is ignored.
+
+    The body may also be a list of events (up to ``MAX_BATCH_SIZE``), in
+    which case the signature is verified once, the events are stored with
+    a single batched write, and a JSON list of event IDs is returned. An
+    empty batch, or one with any malformed event, is rejected as a whole.
     
     Format resembles the following:
     
@@ -102,7 +132,12 @@ def store():
     logger = logging.getLogger('sentry.web.api.store')
 
     try:
-        data = base64.b64decode(data).decode('zlib')
+        # clients may send raw (deflated, or plain JSON) bodies rather than
+        # the base64 encoding every client understands
+        if request.headers.get('Content-Encoding') == 'deflate':
+            data = data.decode('zlib')
+        elif request.mimetype != 'application/json':
+            data = base64.b64decode(data).decode('zlib')
     except Exception, e:
         # This error should be caught as it suggests that there's a
         # bug somewhere in the client's code.
@@ -117,19 +152,30 @@ def store():
         logger.exception('Bad data received')
         abort(403, 'Bad data reconstructing object (%s, %s)' % (e.__class__.__name__, e))
 
-    # XXX: ensure keys are coerced to strings
-    data = dict((str(k), v) for k, v in data.iteritems())
+    if isinstance(data, list):
+        if len(data) > app.config['MAX_BATCH_SIZE']:
+            abort(413, 'Too many events in batch (limit is %d)' % (app.config['MAX_BATCH_SIZE'],))
+
+        if not data:
+            abort(400, 'Empty batch')
+
+        # every event is checked before any is stored
+        event_list = []
+        for n, d in enumerate(data):
+            if not isinstance(d, dict):
+                abort(400, 'Invalid event at index %d (expected an object)' % (n,))
+            missing = [k for k in REQUIRED_FIELDS if k not in d]
+            if missing:
+                abort(400, 'Invalid event at index %d (missing %s)' % (n, ', '.join(missing)))
+            try:
+                event_list.append(get_event_kwargs(d))
+            except (TypeError, ValueError), e:
+                abort(400, 'Invalid event at index %d (%s, %s)' % (n, e.__class__.__name__, e))
 
-    if 'date' in data:
-        if is_float(data['date']):
-            data['date'] = datetime.datetime.fromtimestamp(float(data['date']))
-        else:
-            if '.' in data['date']:
-                format = '%Y-%m-%dT%H:%M:%S.%f'
-            else:
-                format = '%Y-%m-%dT%H:%M:%S'
-            data['date'] = datetime.datetime.strptime(data['date'], format)
+        results = app.client.store_many(event_list)
+
+        return Response(simplejson.dumps([event.pk for event, group in results]), mimetype='application/json')
 
-    event, group = app.client.store(**data)
+    event, group = app.client.store(**get_event_kwargs(data))
     
     return event.pk
@@ -21,9 +21,27 @@ class SentryConfig(object):
 
     DATABASE_USING = None
 
+    # Events seen more than THRASHING_LIMIT times within THRASHING_TIMEOUT
+    # seconds are dropped by the client
     THRASHING_TIMEOUT = 60
     THRASHING_LIMIT = 10
 
+    # Maximum number of distinct events tracked by the client for thrashing
+    THRASHING_CACHE_SIZE = 1000
+
+    # Events refer to the list of installed modules by its hash, and the list
+    # itself is sent when it changes, or after this many seconds in case the
+    # server has lost it
+    MODULES_INTERVAL = 3600
+
+    # Maximum number of characters of source code kept in memory for
+    # stacktrace context
+    SOURCE_CACHE_SIZE = 4 * 1024 * 1024
+
+    # Read stacktrace context through the linecache module rather than
+    # keeping a separate cache
+    SOURCE_CACHE_LINECACHE = False
+
     # Sentry allows you to specify an alternative search backend for itself
     SEARCH_ENGINE = None
     SEARCH_OPTIONS = {}
@@ -41,8 +59,53 @@ class SentryConfig(object):
     # This should a list of the full URI to the storage API endpionts.
     REMOTES = []
 
+    # Seconds to wait for a connection to a remote, and then for each read
+    # and write, before giving up on sending an event
     REMOTE_TIMEOUT = 5
 
+    # Number of keep-alive connections kept to each remote, which is also the
+    # number of events sent to it at once
+    REMOTE_POOL_SIZE = 4
+
+    # How events are sent: 'base64' encoded, which every server accepts, or
+    # 'raw', which is a third smaller. REMOTE_COMPRESSION_LEVEL is the zlib
+    # level, and raw events are sent uncompressed at 0.
+    REMOTE_ENCODING = 'base64'
+    REMOTE_COMPRESSION_LEVEL = 6
+
+    # Directory in which events are kept when a remote cannot be reached,
+    # to be sent once it is back. Events are logged and dropped if unset.
+    SPOOL_DIR = None
+
+    # Each process writes to its own segment of up to SPOOL_SEGMENT_SIZE
+    # bytes, and events are dropped while the spool holds SPOOL_MAX_SIZE
+    SPOOL_SEGMENT_SIZE = 1024 * 1024
+    SPOOL_MAX_SIZE = 100 * 1024 * 1024
+
+    # Seconds between syncing writes to disk
+    SPOOL_FSYNC_INTERVAL = 1.0
+
+    # Seconds before sending spooled events, doubled after each failure up
+    # to SPOOL_MAX_RETRY_INTERVAL
+    SPOOL_RETRY_INTERVAL = 1.0
+    SPOOL_MAX_RETRY_INTERVAL = 300
+
+    ## The following settings refer to the AsyncSentryClient
+
+    # Maximum number of events waiting to be sent
+    ASYNC_QUEUE_SIZE = 1000
+
+    # What to do when the queue is full: 'drop_oldest', 'drop_newest' or 'block'
+    ASYNC_OVERFLOW = 'drop_oldest'
+
+    # Seconds to wait for space in the queue with the 'block' policy
+    ASYNC_BLOCK_TIMEOUT = 0.1
+
+    # Events are sent in batches of up to ASYNC_BATCH_SIZE, waiting at most
+    # ASYNC_BATCH_INTERVAL seconds for a batch to fill up
+    ASYNC_BATCH_SIZE = 100
+    ASYNC_BATCH_INTERVAL = 1.0
+
     ADMINS = []
 
     CLIENT = 'sentry.client.base.SentryClient'
@@ -72,10 +135,28 @@ class SentryConfig(object):
     # Allow writes without authentication (including the API)
     PUBLIC_WRITES = False
 
+    # Maximum number of events accepted in a single batched store request
+    MAX_BATCH_SIZE = 500
+
+    # Number of groups shown per page
+    MESSAGES_PER_PAGE = 15
+
+    # Number of seconds counts of groups and events are cached for
+    COUNT_CACHE_TIMEOUT = 5
+
+    # Compression of the data stored with events: None, 'zlib' or
+    # 'dictionary' (zlib with a dictionary of strings common to events)
+    DATA_COMPRESSION = 'dictionary'
+
     # Maximum length of variables before they get truncated
     MAX_LENGTH_LIST = 50
     MAX_LENGTH_STRING = 200
 
+    # Maximum nesting depth and approximate size in bytes of the variables
+    # stored for each frame of a stacktrace
+    MAX_VARS_DEPTH = 5
+    MAX_VARS_SIZE = 16 * 1024
+
     FILTERS = [
         ('server', 'sentry.web.filters.Choice'),
         ('level', 'sentry.web.filters.Choice'),
@@ -92,11 +173,43 @@ class SentryConfig(object):
     PROCESSORS = (
         'sentry.core.processors.SantizePasswordsProcessor',
     )
+
+    # Event types and interfaces imported when a server starts, rather than
+    # by the first event which uses them
+    PRELOAD_CLASSES = (
+        'sentry.events.Exception',
+        'sentry.events.Message',
+        'sentry.events.Query',
+        'sentry.interfaces.Exception',
+        'sentry.interfaces.Http',
+        'sentry.interfaces.Message',
+        'sentry.interfaces.Query',
+        'sentry.interfaces.Stacktrace',
+    )
     
     # Controls how long entries should stay along before the
     # cleaner removes them. Set to None to disable
     TRUNCATE_AFTER = datetime.timedelta(days=30)
 
+    # Seconds between runs of the cleaner, and the number of seconds each
+    # run may spend deleting expired events and groups
+    CLEANER_INTERVAL = 5
+    CLEANER_TIME_BUDGET = 1.0
+
+    # Bounds of the number of events (or groups) deleted at once, which the
+    # cleaner adapts to fit several batches within its time budget
+    CLEANER_MIN_BATCH_SIZE = 10
+    CLEANER_MAX_BATCH_SIZE = 1000
+
+    # Seconds after which the lock held by the running cleaner expires if it
+    # is not renewed, e.g. as its process died. Must exceed the interval plus
+    # the time budget.
+    CLEANER_LOCK_TIMEOUT = 60
+
+    # The log and PID files of ``sentry cleanup --daemon``
+    CLEANER_LOG_FILE = 'sentry-cleaner.log'
+    CLEANER_PID_FILE = 'sentry-cleaner.pid'
+
     # The From address for outgoing emails
     SERVER_EMAIL = None
 
@@ -105,4 +218,19 @@ class SentryConfig(object):
     WEB_HOST = 'localhost'
     WEB_PORT = 9000
     WEB_LOG_FILE = 'sentry.log'
-    WEB_PID_FILE = 'sentry.pid'
\ No newline at end of file
+    WEB_PID_FILE = 'sentry.pid'
+
+    # Number of processes serving ``sentry-collector start``, each of which
+    # serves up to COLLECTOR_CONCURRENCY connections at once
+    COLLECTOR_WORKERS = 1
+    COLLECTOR_CONCURRENCY = 1000
+
+    # Seconds between the health reports of collector workers. A worker
+    # which has not reported for COLLECTOR_WORKER_TIMEOUT seconds is killed
+    # and replaced.
+    COLLECTOR_HEALTH_INTERVAL = 5
+    COLLECTOR_WORKER_TIMEOUT = 30
+
+    # Seconds collector workers are given to finish their requests when
+    # stopped or reloaded
+    COLLECTOR_GRACEFUL_TIMEOUT = 30
\ No newline at end of file
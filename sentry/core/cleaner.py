@@ -7,42 +7,262 @@ sentry.core.cleaner
 """
 
 from sentry import app
-from sentry.models import Group, Event
+from sentry.db.models import count_cache
+from sentry.models import Group, Event, EventType, Tag
 
 import logging
 import datetime
+import os
+import socket
+import sys
 import time
 import threading
+import uuid
+
+from multiprocessing.pool import ThreadPool
+
+# the name of the lock held by the cleaner which is running, of which there
+# is one among all processes sharing a datastore
+LOCK_NAME = 'cleaner'
 
 class Cleaner(threading.Thread):
     """
     Manages cleaning up expired messages.
+
+    Every ``CLEANER_INTERVAL`` seconds, events and then groups older than
+    ``TRUNCATE_AFTER`` are found by their date index and purged in batches,
+    until none are left or ``CLEANER_TIME_BUDGET`` seconds have passed. The
+    batch size adapts so that a batch takes about a quarter of the budget.
+
+    Only the cleaner holding the datastore's ``cleaner`` lock runs, so any
+    number may be started; the others take over within
+    ``CLEANER_LOCK_TIMEOUT`` seconds of it stopping.
     """
     def __init__(self, app):
         self.app = app
         self.logger = logging.getLogger('sentry.core.cleaner')
+        self.batch_size = app.config['CLEANER_MIN_BATCH_SIZE']
+        # totals deleted, and the number of instances left to delete as of
+        # the last run, by model
+        self.deleted = {Event: 0, Group: 0}
+        self.backlog = {Event: 0, Group: 0}
+        self.last_run = None
+        self.owner = '%s:%d:%s' % (socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8])
+        self.is_leader = False
         super(Cleaner, self).__init__()
+        self.daemon = True
 
     def run(self):
-        while True:
-            time.sleep(5)
+        try:
+            while True:
+                self.tick()
+                time.sleep(app.config['CLEANER_INTERVAL'])
+        finally:
+            if self.is_leader:
+                app.db.release_lock(LOCK_NAME, self.owner)
+
+    def tick(self):
+        """
+        Cleans up expired events and groups if this cleaner holds (or can
+        take) the lock. Returns the number of instances deleted, or ``None``
+        if another cleaner holds the lock or the clean up failed.
+        """
+        if not app.config['TRUNCATE_AFTER']:
+            return None
 
-            if not app.config['TRUNCATE_AFTER']:
-                continue
-            
+        try:
+            is_leader = app.db.acquire_lock(LOCK_NAME, self.owner, app.config['CLEANER_LOCK_TIMEOUT'])
+            if is_leader != self.is_leader:
+                self.logger.info('%s the cleaner lock as %s' % (
+                    is_leader and 'Acquired' or 'Lost', self.owner))
+                self.is_leader = is_leader
+            if is_leader:
+                return self.clean()
+        except Exception, e:
+            self.logger.exception('Unable to clean up expired events: %s' % e)
+        return None
+
+    def clean(self, cutoff=None):
+        """
+        Deletes expired events and groups until none are left, or the time
+        budget is spent. Returns the number of instances deleted.
+        """
+        if cutoff is None:
             cutoff = datetime.datetime.now() - app.config['TRUNCATE_AFTER']
-            # XXX: this could be more efficient if we took interest in what
-            # groups an event is part of, and checked them while iterating the events
-            for event in Event.objects.order_by('date')[:100]:
-                if event.date > cutoff:
-                    continue
+        budget = app.config['CLEANER_TIME_BUDGET']
+        deadline = time.time() + budget
 
-                self.logger.debug('Cleaning up %r' % event)
-                event.delete()
+        # events go first, as a group is never older than its events
+        deleted = 0
+        for model, index, purge in ((Event, 'date', self.purge_events),
+                                    (Group, 'last_seen', self.purge_groups)):
+            while time.time() < deadline:
+                batch_size = self.batch_size
+                start = time.time()
+                pk_set = app.db.list_before(model, index, cutoff, batch_size)
+                if pk_set:
+                    purge(pk_set)
+                    self.deleted[model] += len(pk_set)
+                    deleted += len(pk_set)
+                    self._adapt_batch_size(len(pk_set), time.time() - start, budget)
+                if len(pk_set) < batch_size:
+                    break
 
-            for group in Group.objects.order_by('last_seen')[:100]:
-                if group.last_seen > cutoff:
-                    continue
+            self.backlog[model] = app.db.count_before(model, index, cutoff)
+
+        self.last_run = datetime.datetime.now()
+        if deleted or any(self.backlog.itervalues()):
+            self.logger.info('Cleaned up %d instances, %d events and %d groups left to delete (batch size %d)' % (
+                deleted, self.backlog[Event], self.backlog[Group], self.batch_size))
+        return deleted
+
+    def _adapt_batch_size(self, count, duration, budget):
+        target = budget / 4
+        if duration > target:
+            batch_size = self.batch_size // 2
+        elif count == self.batch_size and duration < target / 2:
+            batch_size = self.batch_size * 2
+        else:
+            return
+        self.batch_size = max(app.config['CLEANER_MIN_BATCH_SIZE'],
+                              min(batch_size, app.config['CLEANER_MAX_BATCH_SIZE']))
+
+    def purge_events(self, pk_set):
+        self.logger.debug('Cleaning up %d events' % len(pk_set))
+        app.db.purge(Event, pk_set, related=(Group,))
+        count_cache.clear()
+
+    def purge_groups(self, pk_set, groups=None):
+        self.logger.debug('Cleaning up %d groups' % len(pk_set))
+        # their types and tags are needed to update the counters, and groups
+        # which are already gone must not be counted twice
+        if groups is None:
+            groups = [Group(pk, **data) for pk, data in app.db.get_many(Group, pk_set) if data]
+        app.db.purge(Group, pk_set, related=(Event,))
+        EventType.remove_groups(groups)
+        Tag.remove_groups(groups)
+        count_cache.clear()
+
+class Progress(object):
+    """
+    Writes the number of instances deleted so far, out of ``total`` if it is
+    known, and the rate at which they are deleted, at most once a second.
+    """
+    def __init__(self, name, total=None, stream=sys.stderr, interval=1.0):
+        self.name = name
+        self.total = total
+        self.stream = stream
+        self.interval = interval
+        self.count = 0
+        self.start = self.last_write = time.time()
 
-                self.logger.debug('Cleaning up %r' % group)
-                group.delete()
+    def update(self, count):
+        self.count += count
+        if time.time() - self.last_write >= self.interval:
+            self.write()
+
+    def write(self):
+        self.last_write = time.time()
+        rate = self.count / max(self.last_write - self.start, 0.001)
+        if self.total:
+            line = '%s: %d of %d deleted (%.1f%%), %.0f/s' % (
+                self.name, self.count, self.total, 100.0 * self.count / self.total, rate)
+            if rate and self.count < self.total:
+                line += ', %d seconds left' % ((self.total - self.count) / rate)
+        else:
+            line = '%s: %d deleted, %.0f/s' % (self.name, self.count, rate)
+        print >> self.stream, line
+
+class BulkPurge(object):
+    """
+    Deletes the events from after ``since`` up to ``cutoff``, and the groups
+    all of whose events are within that range, e.g. to purge historical
+    data during maintenance.
+
+    Instances are found by their date indexes, and events are deleted by
+    ``workers`` threads at once, in batches of ``batch_size``. As deleted
+    instances leave the indexes, running the same purge again after it is
+    interrupted carries on where it stopped.
+
+    With ``tags``, only the groups with all of the given tags are deleted,
+    along with all of their events.
+    """
+    def __init__(self, cutoff, since=None, tags=None, batch_size=1000, workers=4, stream=sys.stderr):
+        self.cutoff = cutoff
+        self.since = since
+        self.tags = tags
+        self.batch_size = batch_size
+        self.workers = workers
+        self.stream = stream
+        self.cleaner = Cleaner(app)
+
+    def run(self):
+        """
+        Returns the number of events and groups deleted.
+        """
+        pool = ThreadPool(self.workers)
+        try:
+            if self.tags:
+                return self.purge_groups(pool)
+            return self.purge_events(pool) + self.purge_groups(pool)
+        finally:
+            pool.terminate()
+
+    def _map(self, pool, func, values):
+        # a timeout keeps the main thread responsive to KeyboardInterrupt
+        return pool.map_async(func, values).get(sys.maxint)
+
+    def purge_events(self, pool):
+        progress = Progress('events', app.db.count_before(Event, 'date', self.cutoff, self.since),
+                            self.stream)
+        while True:
+            # each round reads a batch for every worker from the index, as
+            # the index only changes once they are done
+            pk_set = app.db.list_before(Event, 'date', self.cutoff, self.batch_size * self.workers,
+                                        since=self.since)
+            if not pk_set:
+                break
+            self._map(pool, self.cleaner.purge_events,
+                      [pk_set[i:i + self.batch_size] for i in xrange(0, len(pk_set), self.batch_size)])
+            progress.update(len(pk_set))
+        progress.write()
+        return progress.count
+
+    def purge_group_events(self, group):
+        count = 0
+        while True:
+            pk_set = [pk for pk, data in app.db.list_relations(Group, group.pk, Event, limit=self.batch_size)]
+            if not pk_set:
+                return count
+            self.cleaner.purge_events(pk_set)
+            count += len(pk_set)
+
+    def purge_groups(self, pool):
+        progress = Progress('groups', app.db.count_before(Group, 'last_seen', self.cutoff, self.since, self.tags),
+                            self.stream)
+        # the events of tagged groups are found through the groups
+        events = Progress('events', None, self.stream)
+        # groups seen before ``since`` still have events, and stay at the
+        # start of the index
+        offset = 0
+        while True:
+            pk_set = app.db.list_before(Group, 'last_seen', self.cutoff, self.batch_size, offset,
+                                        since=self.since, tags=self.tags)
+            if not pk_set:
+                break
+            groups = dict((pk, Group(pk, **data)) for pk, data in app.db.get_many(Group, pk_set) if data)
+            if self.since:
+                skipped = set(pk for pk, g in groups.iteritems() if g.first_seen <= self.since)
+                offset += len(skipped)
+                pk_set = [pk for pk in pk_set if pk not in skipped]
+                if not pk_set:
+                    continue
+            groups = [groups[pk] for pk in pk_set if pk in groups]
+            if self.tags:
+                events.update(sum(self._map(pool, self.purge_group_events, groups)))
+            self.cleaner.purge_groups(pk_set, groups)
+            progress.update(len(pk_set))
+        if self.tags:
+            events.write()
+        progress.write()
+        return events.count + progress.count
@@ -9,6 +9,7 @@ sentry.core.processors
 import logging
 
 from sentry import app
+from sentry.utils.imports import class_cache
 
 _CACHE = None
 def all(from_cache=True):
@@ -17,10 +18,8 @@ def all(from_cache=True):
     if _CACHE is None or not from_cache:
         modules = []
         for path in app.config['PROCESSORS']:
-            module_name, class_name = path.rsplit('.', 1)
             try:
-                module = __import__(module_name, {}, {}, class_name)
-                handler = getattr(module, class_name)
+                handler = class_cache[path]
             except Exception:
                 logger = logging.getLogger(__name__)
                 logger.exception('Unable to import %s' % (path,))
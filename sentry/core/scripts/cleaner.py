@@ -0,0 +1,133 @@
+"""
+sentry.core.scripts.cleaner
+~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Runs the cleaner as a worker process of its own, started by
+``sentry cleanup --daemon``, and bulk purges, run by ``sentry cleanup``.
+
+:copyright: (c) 2010 by the Sentry Team, see AUTHORS for more details.
+:license: BSD, see LICENSE for more details.
+"""
+
+import datetime
+import logging
+import os.path
+import sys
+
+from daemon.daemon import DaemonContext
+from daemon.runner import DaemonRunner, make_pidlockfile
+
+from sentry import app
+from sentry.core.cleaner import BulkPurge, Cleaner
+
+class SentryCleaner(DaemonRunner):
+    pidfile_timeout = 10
+    start_message = u"started with pid %(pid)d"
+
+    def __init__(self, pidfile=None, logfile=None, daemonize=False):
+        if not logfile:
+            logfile = app.config['CLEANER_LOG_FILE']
+
+        logfile = os.path.realpath(logfile)
+        pidfile = os.path.realpath(pidfile or app.config['CLEANER_PID_FILE'])
+
+        self.daemon_context = DaemonContext(detach_process=daemonize)
+        self.daemon_context.stdout = open(logfile, 'a+')
+        self.daemon_context.stderr = open(logfile, 'a+', buffering=0)
+
+        self.pidfile = make_pidlockfile(pidfile, self.pidfile_timeout)
+
+        self.daemon_context.pidfile = self.pidfile
+
+        # HACK: set app to self so self.app.run() works
+        self.app = self
+
+    def execute(self, action):
+        self.action = action
+        if self.daemon_context.detach_process is False and self.action == 'start':
+            # HACK:
+            self.run()
+        else:
+            self.do_action()
+
+    def run(self):
+        logging.getLogger('sentry.core.cleaner').setLevel(logging.INFO)
+
+        # runs in this process rather than as a thread, so that stopping the
+        # process releases the lock
+        Cleaner(app).run()
+
+def parse_date(value):
+    return datetime.datetime.strptime(value, '%Y-%m-%d')
+
+def parse_tags(value):
+    # "key:value,key:value"
+    tags = []
+    for tag in value.split(','):
+        key, _, value = tag.partition(':')
+        tags.append((key, value))
+    return tags
+
+def cleanup(days=30, tags=None, before=None, after=None, batch_size=1000, workers=4):
+    if before:
+        cutoff = parse_date(before)
+    else:
+        cutoff = datetime.datetime.now() - datetime.timedelta(days=days)
+    if after:
+        after = parse_date(after)
+    if tags:
+        tags = parse_tags(tags)
+
+    purge = BulkPurge(cutoff, since=after, tags=tags, batch_size=batch_size, workers=workers)
+    try:
+        purge.run()
+    except KeyboardInterrupt:
+        print >> sys.stderr, 'Interrupted, run the same command again to carry on.'
+        sys.exit(1)
+
+def add_cleanup_options(parser):
+    """
+    Adds the options of ``sentry cleanup`` to ``parser``.
+    """
+    parser.add_option('--days', default='30', type=int,
+                      help='Numbers of days to truncate on.')
+    parser.add_option('--tags',
+                      help='Limit truncation to only groups tagged with key:value[,key:value].')
+    parser.add_option('--before', metavar='YYYY-MM-DD',
+                      help='Truncate entries before this date, rather than --days ago.')
+    parser.add_option('--after', metavar='YYYY-MM-DD',
+                      help='Only truncate entries after this date.')
+    parser.add_option('--batch-size', default=1000, type=int, dest='batch_size',
+                      help='Number of events each worker deletes at once.')
+    parser.add_option('--workers', default=4, type=int,
+                      help='Number of batches deleted in parallel.')
+    parser.add_option('--daemon', action='store_true', default=False, dest='daemon',
+                      help='Keep running, cleaning up every CLEANER_INTERVAL seconds.')
+    parser.add_option('--no-detach', action='store_false', default=True, dest='detach',
+                      help='Run the --daemon worker in the foreground.')
+    parser.add_option('--stop', action='store_true', default=False, dest='stop',
+                      help='Stop the --daemon worker.')
+    parser.add_option('--interval', type=float, metavar='SECONDS',
+                      help='Overrides CLEANER_INTERVAL.')
+    parser.add_option('--budget', type=float, metavar='SECONDS',
+                      help='Overrides CLEANER_TIME_BUDGET.')
+    parser.add_option('--pidfile', dest='pidfile')
+    parser.add_option('--logfile', dest='logfile')
+
+def run_cleanup(options):
+    """
+    Runs ``sentry cleanup`` with ``options``, as parsed by a parser which
+    ``add_cleanup_options`` was called on.
+    """
+    if options.interval is not None:
+        app.config['CLEANER_INTERVAL'] = options.interval
+    if options.budget is not None:
+        app.config['CLEANER_TIME_BUDGET'] = options.budget
+
+    if options.daemon or options.stop:
+        cleaner = SentryCleaner(pidfile=options.pidfile, logfile=options.logfile,
+                                daemonize=options.detach)
+        cleaner.execute(options.stop and 'stop' or 'start')
+    else:
+        cleanup(days=options.days, tags=options.tags, before=options.before, after=options.after,
+                batch_size=options.batch_size, workers=options.workers)
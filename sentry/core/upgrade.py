@@ -0,0 +1,63 @@
+"""
+sentry.core.upgrade
+~~~~~~~~~~~~~~~~~~~
+
+Data migrations, each of which is run once by ``sentry upgrade`` (which
+``sentry start`` also runs).
+
+:copyright: (c) 2010 by the Sentry Team, see AUTHORS for more details.
+:license: BSD, see LICENSE for more details.
+"""
+
+from sentry import app
+from sentry.models import Group, Migration
+
+import datetime
+import logging
+
+logger = logging.getLogger('sentry.core.upgrade')
+
+def index_groups(batch_size=1000):
+    """
+    Adds each group to the ``count`` index and to the indexes of its tags,
+    which groups stored before they were kept are missing from.
+    """
+    # pages are read after the first_seen of the last group indexed rather
+    # than from a position, which the cleaner purging groups meanwhile would
+    # shift, and groups stored meanwhile are indexed already
+    since = None
+    count = 0
+    while True:
+        pk_set = app.db.list_before(Group, 'first_seen', datetime.datetime.max, batch_size, since=since)
+        groups = [Group(pk, **data) for pk, data in app.db.get_many(Group, pk_set) if data]
+        last_page = len(pk_set) < batch_size
+        if not last_page and groups:
+            # groups first seen along with the last one may not have fit
+            until = groups[-1].first_seen
+            seen = set(pk_set)
+            extra = [pk for pk in app.db.list_before(Group, 'first_seen', until, since=since) if pk not in seen]
+            groups.extend(Group(pk, **data) for pk, data in app.db.get_many(Group, extra) if data)
+            since = until
+        for group in groups:
+            # tags are indexed with the group's scores, so count comes first
+            Group.objects.add_to_index(group.pk, 'count', group.count)
+            app.db.add_tags(Group, group.pk, group.tags)
+        count += len(groups)
+        if last_page:
+            return count
+
+# (name, migration), in the order they are run
+MIGRATIONS = (
+    ('index_groups', index_groups),
+)
+
+def upgrade():
+    """
+    Runs each migration which has not been run yet.
+    """
+    for name, migration in MIGRATIONS:
+        if Migration.is_applied(name):
+            continue
+        logger.info('Running migration %s' % name)
+        migration()
+        Migration.set_applied(name)
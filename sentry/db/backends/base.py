@@ -6,9 +6,22 @@ sentry.db.backends.base
 :license: BSD, see LICENSE for more details.
 """
 
+import calendar
+import datetime
 import hashlib
 import uuid
 
+from contextlib import contextmanager
+
+from sentry.db.models import to_db
+
+# The (seconds per bucket, seconds kept) of the counts kept by incr_counts:
+# per minute for a day, and per hour for 90 days.
+COUNT_RESOLUTIONS = (
+    (60, 60 * 60 * 24),
+    (60 * 60, 60 * 60 * 24 * 91),
+)
+
 class SentryBackend(object):
     def _get_schema_name(self, schema):
         return schema.__name__.lower()
@@ -16,5 +29,167 @@ class SentryBackend(object):
     def _get_composite_key(self, **keys):
         return hashlib.md5(';'.join('%s=%s' % (k, v) for k, v in keys.iteritems())).hexdigest()
 
+    def _get_tag_hash(self, key, value):
+        return hashlib.md5((u'%s=%s' % (key, value)).encode('utf-8')).hexdigest()
+
+    def _get_tag_hashes(self, tags):
+        return set(self._get_tag_hash(k, v) for k, v in tags)
+
+    def _get_score(self, score):
+        if isinstance(score, datetime.datetime):
+            score = score.strftime('%s.%m')
+        return float(score)
+
+    def _get_bucket(self, date, resolution):
+        # returns the start of the bucket ``date`` falls within, in seconds
+        # since the epoch (dates are naive, and taken as UTC)
+        return calendar.timegm(date.timetuple()) // resolution * resolution
+
+    def _get_buckets(self, resolution, start, end):
+        # returns the start of each bucket from ``start`` to ``end``
+        if resolution not in dict(COUNT_RESOLUTIONS):
+            raise ValueError('Counts are not kept per %r seconds' % resolution)
+        return range(self._get_bucket(start, resolution), self._get_bucket(end, resolution) + 1, resolution)
+
+    def _get_sort_indexes(self, schema):
+        # returns every sorted index an instance of ``schema`` is added to
+        indexes = set(schema._meta.sortables)
+        if schema._meta.ordering == 'default':
+            indexes.add('default')
+        return indexes
+
+    def _get_constraint_keys(self, instance):
+        model = type(instance)
+        return [self._get_constraint_key(model, to_db(model, dict((name, getattr(instance, name)) for name in index)))
+                for index in model._meta.indexes]
+
+    def _get_values(self, instance):
+        model = type(instance)
+        return to_db(model, dict((name, getattr(instance, name)) for name in model._meta.fields))
+
+    def _get_counters(self, group):
+        # returns the instances which count unique groups (see Group.save),
+        # as they would be when first created
+        from sentry.models import EventType, Tag
+
+        counters = [EventType(path=group.type, count=1)]
+        counters.extend(Tag(key=k, value=v, hash=Tag.get_hash(k, v), count=1) for k, v in group.tags)
+        return counters
+
     def generate_key(self, schema):
         return uuid.uuid4().hex
+
+    @contextmanager
+    def transaction(self):
+        """
+        Runs the writes within the block as one transaction, where the
+        backend supports transactions, e.g. storing an event along with its
+        counts.
+        """
+        yield None
+
+    def get_many(self, schema, pk_set):
+        # backends which can batch lookups should override this
+        return [(pk, self.get_data(schema, pk)) for pk in pk_set]
+
+    def get_many_meta(self, schema, pk_set):
+        # backends which can batch lookups should override this
+        return [(pk, self.get_meta(schema, pk)) for pk in pk_set]
+
+    def decr(self, schema, pk, key, amount=1):
+        return self.incr(schema, pk, key, -amount)
+
+    def list_before(self, schema, index, date, limit=-1, offset=0, since=None, tags=None):
+        """
+        Returns the keys of up to ``limit`` instances, from ``offset``, whose
+        value of the sorted index ``index`` is at most ``date`` (and after
+        ``since``), oldest first, without reading the instances. ``tags``
+        limits these to instances with all of the given tags.
+        """
+        raise NotImplementedError
+
+    def count_before(self, schema, index, date, since=None, tags=None):
+        """
+        Returns the number of instances ``list_before`` would find without a
+        limit.
+        """
+        raise NotImplementedError
+
+    def purge(self, schema, pk_set, related=()):
+        """
+        Deletes the instances with the keys in ``pk_set`` along with their
+        metadata, tags, sort and composite indexes, and their relations, in
+        both directions, with the models in ``related``.
+
+        Unlike ``Model.delete`` this works on keys, and in batches.
+        """
+        raise NotImplementedError
+
+    def acquire_lock(self, name, owner, timeout):
+        """
+        Takes the lock ``name`` for ``owner`` for ``timeout`` seconds, unless
+        another owner holds it. An owner which already holds the lock extends
+        it. Returns whether ``owner`` holds the lock.
+        """
+        raise NotImplementedError
+
+    def release_lock(self, name, owner):
+        """
+        Releases the lock ``name``, if ``owner`` holds it.
+        """
+        raise NotImplementedError
+
+    def incr_counts(self, schema, counts):
+        """
+        Increments counters bucketed by time, at each of ``COUNT_RESOLUTIONS``,
+        for a list of ``(pk, date, amount)``. A ``pk`` of ``None`` counts
+        across all instances of ``schema``.
+        """
+        raise NotImplementedError
+
+    def get_counts(self, schema, pk, resolution, start, end):
+        """
+        Returns the counts kept by ``incr_counts`` for each bucket of
+        ``resolution`` seconds from ``start`` to ``end``, as a list of
+        ``(date, count)``.
+        """
+        raise NotImplementedError
+
+    def store_event(self, event, group, data):
+        """
+        Saves ``event`` along with its metadata (``data``) and records it
+        against ``group``, which is created if no group exists yet for its
+        (type, hash). The group is added to the tag indexes for each of the
+        event's tags.
+
+        Returns a tuple of ``(event, group)``, where ``group`` reflects the
+        stored values.
+
+        This implementation composes the generic model API and is neither
+        atomic nor cheap. Backends should override it where they can.
+        """
+        event.save()
+        event.set_meta(**data)
+
+        defaults = dict((name, getattr(group, name)) for name in group._meta.fields)
+        instance, created = group.objects.get_or_create(type=group.type, hash=group.hash, defaults=defaults)
+        if not created:
+            instance.incr('count')
+            if event.time_spent:
+                instance.incr('time_spent', event.time_spent)
+
+        instance.last_seen = event.date
+        instance.update(last_seen=instance.last_seen, score=instance.get_score())
+
+        instance.add_relation(event, event.date)
+
+        self.add_tags(type(instance), instance.pk, event.tags)
+
+        return event, instance
+
+    def store_events(self, event_list):
+        """
+        Stores a list of ``(event, group, data)`` tuples, returning a list
+        of ``(event, group)`` tuples in the same order.
+        """
+        return [self.store_event(*args) for args in event_list]
@@ -0,0 +1,443 @@
+"""
+sentry.db.backends.memory
+~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Keeps everything in the memory of the current process, which suits tests,
+benchmarks and single process deployments.
+
+:copyright: (c) 2010 by the Sentry Team, see AUTHORS for more details.
+:license: BSD, see LICENSE for more details.
+"""
+
+from __future__ import absolute_import
+
+from sentry.db.backends.base import SentryBackend, COUNT_RESOLUTIONS
+
+import datetime
+import functools
+import os
+import time
+
+from bisect import bisect_left, insort
+from threading import RLock
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+def synchronized(func):
+    @functools.wraps(func)
+    def wrapped(self, *args, **kwargs):
+        self._lock.acquire()
+        try:
+            return func(self, *args, **kwargs)
+        finally:
+            self._lock.release()
+    return wrapped
+
+class SortedIndex(object):
+    """
+    A sorted set, ordered by (score, member) like Redis' sorted sets.
+
+    Members are kept in a sorted list, so a member's position is found by
+    bisection in O(log n) and a range is a slice.
+    """
+    def __init__(self):
+        self.scores = {}
+        self.members = []
+
+    def __len__(self):
+        return len(self.members)
+
+    def __contains__(self, member):
+        return member in self.scores
+
+    def add(self, member, score):
+        self.remove(member)
+        self.scores[member] = score
+        insort(self.members, (score, member))
+
+    def remove(self, member):
+        score = self.scores.pop(member, None)
+        if score is not None:
+            del self.members[bisect_left(self.members, (score, member))]
+
+    def count_by_score(self, max_score):
+        # returns the number of members with a score of at most ``max_score``
+        low, high = 0, len(self.members)
+        while low < high:
+            middle = (low + high) // 2
+            if self.members[middle][0] <= max_score:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def range(self, offset=0, limit=-1, desc=False):
+        # returns the members within [offset, offset + limit)
+        total = len(self.members)
+        if limit > 0:
+            end = min(offset + limit, total)
+        else:
+            end = total
+        if offset >= end:
+            return []
+        if desc:
+            items = self.members[total - end:total - offset][::-1]
+        else:
+            items = self.members[offset:end]
+        return [member for score, member in items]
+
+class MemoryBackend(SentryBackend):
+    """
+    Holds hashes, sorted indexes, composite indexes and relations in memory.
+
+    Every operation holds a single lock, which also makes ``store_event``
+    atomic. When ``path`` is given, the data is loaded from it on startup
+    and written back by ``snapshot``, which is also called after a write
+    once ``snapshot_interval`` seconds have passed since the last snapshot.
+    """
+    def __init__(self, path=None, snapshot_interval=None):
+        self.path = path
+        self.snapshot_interval = snapshot_interval
+        self._lock = RLock()
+        self._last_snapshot = time.time()
+        self._state = None
+        # locks are only held for as long as the process runs
+        self._locks = {}
+        if path and os.path.exists(path):
+            with open(path, 'rb') as fp:
+                self._state = pickle.load(fp)
+        if self._state is None:
+            self._state = {
+                'data': {},
+                'meta': {},
+                'indexes': {},
+                'relations': {},
+                'cindexes': {},
+                'tags': {},
+            }
+        # snapshots written before counts were kept lack them
+        self._state.setdefault('counts', {})
+
+    ## Keys
+
+    def _get_data_key(self, schema, pk):
+        return (self._get_schema_name(schema), pk)
+
+    def _get_index_key(self, schema, index):
+        return (self._get_schema_name(schema), index)
+
+    def _get_relation_key(self, from_schema, from_pk, to_schema):
+        return (self._get_schema_name(from_schema), from_pk, self._get_schema_name(to_schema))
+
+    def _get_constraint_key(self, schema, kwargs):
+        return (self._get_schema_name(schema), self._get_composite_key(**kwargs))
+
+    def _get_tag_index_key(self, schema, index, tag_hash):
+        return (self._get_schema_name(schema), index, tag_hash)
+
+    def _get_index(self, key, kind='indexes', create=False):
+        indexes = self._state[kind]
+        index = indexes.get(key)
+        if index is None:
+            index = SortedIndex()
+            if create:
+                indexes[key] = index
+        return index
+
+    ## Snapshots
+
+    @synchronized
+    def snapshot(self):
+        """
+        Writes all data to ``path``, replacing the previous snapshot.
+        """
+        assert self.path
+        tmp_path = '%s.tmp' % self.path
+        with open(tmp_path, 'wb') as fp:
+            pickle.dump(self._state, fp, pickle.HIGHEST_PROTOCOL)
+        os.rename(tmp_path, self.path)
+        self._last_snapshot = time.time()
+
+    def _changed(self):
+        if self.path and self.snapshot_interval is not None \
+           and time.time() - self._last_snapshot >= self.snapshot_interval:
+            self.snapshot()
+
+    ## Hash table lookups
+
+    def create_model(self, schema):
+        return
+
+    @synchronized
+    def add(self, schema, **values):
+        # generates a pk and sets the values
+        pk = self.generate_key(schema)
+        if values:
+            self.set(schema, pk, **values)
+        return pk
+
+    @synchronized
+    def delete(self, schema, pk):
+        key = self._get_data_key(schema, pk)
+        for kind in ('data', 'meta', 'tags'):
+            self._state[kind].pop(key, None)
+        self._changed()
+
+    @synchronized
+    def set(self, schema, pk, **values):
+        if values:
+            self._state['data'].setdefault(self._get_data_key(schema, pk), {}).update(values)
+            self._changed()
+
+    @synchronized
+    def get(self, schema, pk):
+        return dict(self._state['data'].get(self._get_data_key(schema, pk), {}))
+
+    @synchronized
+    def incr(self, schema, pk, key, amount=1):
+        data = self._state['data'].setdefault(self._get_data_key(schema, pk), {})
+        data[key] = int(data.get(key) or 0) + amount
+        self._changed()
+        return data[key]
+
+    @synchronized
+    def set_meta(self, schema, pk, **values):
+        self._state['meta'].setdefault(self._get_data_key(schema, pk), {}).update(values)
+        self._changed()
+
+    @synchronized
+    def get_meta(self, schema, pk):
+        return dict(self._state['meta'].get(self._get_data_key(schema, pk), {}))
+
+    def get_data(self, schema, pk):
+        return self.get(schema, pk)
+
+    @synchronized
+    def get_many(self, schema, pk_set):
+        data = self._state['data']
+        return [(pk, dict(data.get(self._get_data_key(schema, pk), {}))) for pk in pk_set]
+
+    def _intersect(self, indexes):
+        # yields the members of the smallest index found in all others, in
+        # the order of that index
+        indexes = sorted(indexes, key=len)
+        first, rest = indexes[0], indexes[1:]
+        for score, member in first.members:
+            if all(member in index for index in rest):
+                yield score, member
+
+    def _get_filtered_index(self, schema, index, tags):
+        # returns the sorted index for instances matching all tags
+        indexes = [self._get_index(self._get_tag_index_key(schema, index, tag_hash))
+                   for tag_hash in self._get_tag_hashes(tags)]
+        if len(indexes) == 1:
+            return indexes[0]
+        result = SortedIndex()
+        result.members = list(self._intersect(indexes))
+        result.scores = dict((member, score) for score, member in result.members)
+        return result
+
+    @synchronized
+    def count(self, schema, index='default', tags=None):
+        if not tags:
+            return len(self._get_index(self._get_index_key(schema, index)))
+        indexes = [self._get_index(self._get_tag_index_key(schema, index, tag_hash))
+                   for tag_hash in self._get_tag_hashes(tags)]
+        if len(indexes) == 1:
+            return len(indexes[0])
+        return sum(1 for item in self._intersect(indexes))
+
+    @synchronized
+    def list(self, schema, index='default', offset=0, limit=-1, desc=False, tags=None):
+        if tags:
+            sorted_index = self._get_filtered_index(schema, index, tags)
+        else:
+            sorted_index = self._get_index(self._get_index_key(schema, index))
+        return self.get_many(schema, sorted_index.range(offset, limit, desc))
+
+    ## Retention
+
+    def _get_range_before(self, schema, index, date, since, tags):
+        # returns the sorted index, and the positions within it of the first
+        # and after the last instance within (since, date]
+        if tags:
+            sorted_index = self._get_filtered_index(schema, index, tags)
+        else:
+            sorted_index = self._get_index(self._get_index_key(schema, index))
+        start = 0
+        if since is not None:
+            start = sorted_index.count_by_score(self._get_score(since))
+        end = sorted_index.count_by_score(self._get_score(date))
+        return sorted_index, start, max(start, end)
+
+    @synchronized
+    def list_before(self, schema, index, date, limit=-1, offset=0, since=None, tags=None):
+        sorted_index, start, end = self._get_range_before(schema, index, date, since, tags)
+        count = end - start - offset
+        if limit > 0:
+            count = min(count, limit)
+        if count <= 0:
+            return []
+        return sorted_index.range(start + offset, count)
+
+    @synchronized
+    def count_before(self, schema, index, date, since=None, tags=None):
+        sorted_index, start, end = self._get_range_before(schema, index, date, since, tags)
+        return end - start
+
+    @synchronized
+    def purge(self, schema, pk_set, related=()):
+        state = self._state
+        indexes = self._get_sort_indexes(schema)
+        schema_name = self._get_schema_name(schema)
+        for pk in pk_set:
+            key = self._get_data_key(schema, pk)
+            for index in indexes:
+                self._get_index(self._get_index_key(schema, index)).remove(pk)
+                for tag_index in self._get_tag_indexes(schema, pk, index):
+                    tag_index.remove(pk)
+            if key in state['data']:
+                for constraint_key in self._get_constraint_keys(schema(pk, **state['data'][key])):
+                    state['cindexes'].get(constraint_key, set()).discard(pk)
+            for to_schema in related:
+                relation_key = self._get_relation_key(schema, pk, to_schema)
+                for to_pk in self._get_index(relation_key, 'relations').range():
+                    self._get_index(self._get_relation_key(to_schema, to_pk, schema), 'relations').remove(pk)
+                state['relations'].pop(relation_key, None)
+            for kind in ('data', 'meta', 'tags'):
+                state[kind].pop(key, None)
+            for resolution, ttl in COUNT_RESOLUTIONS:
+                state['counts'].pop((schema_name, pk, resolution), None)
+        self._changed()
+
+    ## Locks
+
+    @synchronized
+    def acquire_lock(self, name, owner, timeout):
+        now = time.time()
+        holder, expires = self._locks.get(name, (None, 0))
+        if holder not in (None, owner) and expires > now:
+            return False
+        self._locks[name] = (owner, now + timeout)
+        return True
+
+    @synchronized
+    def release_lock(self, name, owner):
+        if self._locks.get(name, (None, 0))[0] == owner:
+            del self._locks[name]
+
+    ## Events
+
+    @synchronized
+    def store_event(self, event, group, data):
+        # holding the lock throughout makes the generic implementation atomic
+        return super(MemoryBackend, self).store_event(event, group, data)
+
+    @synchronized
+    def store_events(self, event_list):
+        return super(MemoryBackend, self).store_events(event_list)
+
+    ## Counts
+
+    @synchronized
+    def incr_counts(self, schema, counts):
+        for pk, date, amount in counts:
+            for resolution, ttl in COUNT_RESOLUTIONS:
+                bucket = self._get_bucket(date, resolution)
+                buckets = self._state['counts'].setdefault((self._get_schema_name(schema), pk, resolution), {})
+                if bucket not in buckets:
+                    # drops the buckets which are no longer kept
+                    for expired in [b for b in buckets if b <= bucket - ttl]:
+                        del buckets[expired]
+                buckets[bucket] = buckets.get(bucket, 0) + amount
+        self._changed()
+
+    @synchronized
+    def get_counts(self, schema, pk, resolution, start, end):
+        counts = self._state['counts'].get((self._get_schema_name(schema), pk, resolution), {})
+        return [(datetime.datetime.utcfromtimestamp(b), counts.get(b, 0))
+                for b in self._get_buckets(resolution, start, end)]
+
+    ## Indexes using sorted sets
+
+    @synchronized
+    def add_relation(self, from_schema, from_pk, to_schema, to_pk, score):
+        # adds a relation to a sorted index for base instance
+        key = self._get_relation_key(from_schema, from_pk, to_schema)
+        self._get_index(key, 'relations', create=True).add(to_pk, self._get_score(score))
+        self._changed()
+
+    @synchronized
+    def remove_relation(self, from_schema, from_pk, to_schema, to_pk=None):
+        key = self._get_relation_key(from_schema, from_pk, to_schema)
+        if to_pk:
+            self._get_index(key, 'relations').remove(to_pk)
+        else:
+            self._state['relations'].pop(key, None)
+        self._changed()
+
+    @synchronized
+    def list_relations(self, from_schema, from_pk, to_schema, offset=0, limit=-1, desc=False):
+        # lists relations in a sorted index for base instance
+        key = self._get_relation_key(from_schema, from_pk, to_schema)
+        return self.get_many(to_schema, self._get_index(key, 'relations').range(offset, limit, desc))
+
+    def _get_tag_indexes(self, schema, pk, index, create=False):
+        # returns the tag indexes of ``index`` for each of the instance's tags
+        tag_hashes = self._state['tags'].get(self._get_data_key(schema, pk), ())
+        return [self._get_index(self._get_tag_index_key(schema, index, tag_hash), create=create)
+                for tag_hash in tag_hashes]
+
+    @synchronized
+    def add_to_index(self, schema, pk, index, score):
+        # adds an instance to a sorted index, and the matching tag indexes
+        score = self._get_score(score)
+        self._get_index(self._get_index_key(schema, index), create=True).add(pk, score)
+        for tag_index in self._get_tag_indexes(schema, pk, index, create=True):
+            tag_index.add(pk, score)
+        self._changed()
+
+    @synchronized
+    def remove_from_index(self, schema, pk, index):
+        self._get_index(self._get_index_key(schema, index)).remove(pk)
+        for tag_index in self._get_tag_indexes(schema, pk, index):
+            tag_index.remove(pk)
+        self._changed()
+
+    ## Tag indexes, which hold the instances of a sorted index with a given tag
+
+    @synchronized
+    def add_tags(self, schema, pk, tags):
+        tag_hashes = self._get_tag_hashes(tags)
+        if not tag_hashes:
+            return
+        self._state['tags'].setdefault(self._get_data_key(schema, pk), set()).update(tag_hashes)
+        for index in set(schema._meta.sortables):
+            sorted_index = self._get_index(self._get_index_key(schema, index))
+            if pk not in sorted_index:
+                continue
+            score = sorted_index.scores[pk]
+            for tag_hash in tag_hashes:
+                self._get_index(self._get_tag_index_key(schema, index, tag_hash), create=True).add(pk, score)
+        self._changed()
+
+    ## Generic indexes
+
+    @synchronized
+    def add_to_cindex(self, schema, pk, **kwargs):
+        # adds an index to a composite index (for checking uniqueness)
+        self._state['cindexes'].setdefault(self._get_constraint_key(schema, kwargs), set()).add(pk)
+        self._changed()
+
+    @synchronized
+    def remove_from_cindex(self, schema, pk, **kwargs):
+        self._state['cindexes'].get(self._get_constraint_key(schema, kwargs), set()).discard(pk)
+        self._changed()
+
+    @synchronized
+    def list_by_cindex(self, schema, **kwargs):
+        # returns a list of keys associated with a constraint
+        return list(self._state['cindexes'].get(self._get_constraint_key(schema, kwargs), ()))
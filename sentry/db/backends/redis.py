@@ -8,15 +8,232 @@ sentry.db.backends.redis
 
 from __future__ import absolute_import
 
-from sentry.db.backends.base import SentryBackend
+from sentry.db.backends.base import SentryBackend, COUNT_RESOLUTIONS
+from sentry.db.models import to_db
 
 import datetime
+import hashlib
 import redis
 
+# Counts are kept in hashes of this many consecutive buckets, which Redis
+# stores compactly, and each of which expires once its buckets are no longer
+# kept.
+COUNTS_PER_KEY = 64
+
+# Arguments are consumed in order from ARGV; lists are prefixed with their
+# length. Keys which depend on the (not yet known) group key are passed as
+# templates containing "{pk}".
+STORE_EVENT_SCRIPT = """
+local cursor = 0
+local function nextarg()
+    cursor = cursor + 1
+    return ARGV[cursor]
+end
+local function nextlist()
+    local values = {}
+    for i = 1, tonumber(nextarg()) do
+        values[i] = nextarg()
+    end
+    return values
+end
+local function with_pk(template, pk)
+    return (string.gsub(template, '{pk}', pk))
+end
+
+local event_pk = nextarg()
+local event_values = nextlist()
+local event_meta = nextlist()
+local event_indexes = nextlist()
+
+local group_cindexes = nextlist()
+local group_pk = nextarg()
+local group_key = nextarg()
+local group_values = nextlist()
+local group_sortables = nextlist()
+local time_spent = tonumber(nextarg())
+local last_seen = nextarg()
+local last_seen_score = tonumber(nextarg())
+local first_seen_score = tonumber(nextarg())
+local child_relation = nextarg()
+local parent_relation = nextarg()
+local tags_key = nextarg()
+local tag_index_key = nextarg()
+local event_tags = nextlist()
+
+local counters = {}
+for i = 1, tonumber(nextarg()) do
+    counters[i] = {
+        cindexes = nextlist(),
+        pk = nextarg(),
+        key = nextarg(),
+        values = nextlist(),
+        index = nextarg(),
+    }
+end
+
+-- event
+redis.call('HMSET', KEYS[1], unpack(event_values))
+if #event_meta > 0 then
+    redis.call('HMSET', KEYS[2], unpack(event_meta))
+end
+for i = 1, #event_indexes, 2 do
+    redis.call('ZADD', event_indexes[i], event_indexes[i + 1], event_pk)
+end
+
+-- group get_or_create
+local created = false
+local existing = redis.call('SRANDMEMBER', group_cindexes[1])
+if existing then
+    group_pk = existing
+    group_key = with_pk(group_key, group_pk)
+    redis.call('HINCRBY', group_key, 'count', 1)
+    if time_spent ~= 0 then
+        redis.call('HINCRBY', group_key, 'time_spent', time_spent)
+    end
+else
+    created = true
+    group_key = with_pk(group_key, group_pk)
+    redis.call('HMSET', group_key, unpack(group_values))
+    for i = 1, #group_cindexes do
+        redis.call('SADD', group_cindexes[i], group_pk)
+    end
+end
+
+-- mirrors Group.get_score
+local count = tonumber(redis.call('HGET', group_key, 'count'))
+local score = math.abs(math.log(count) * 600 + last_seen_score)
+redis.call('HMSET', group_key, 'last_seen', last_seen, 'score', string.format('%.17g', score))
+
+local scores = {
+    count = count,
+    time_spent = tonumber(redis.call('HGET', group_key, 'time_spent')),
+    last_seen = last_seen_score,
+    score = score,
+}
+if created then
+    scores.first_seen = first_seen_score
+end
+for i = 1, #group_sortables, 2 do
+    local value = scores[group_sortables[i]]
+    if value then
+        redis.call('ZADD', group_sortables[i + 1], value, group_pk)
+    end
+end
+
+-- tag indexes mirror the sortable indexes for each tag seen on the group
+tags_key = with_pk(tags_key, group_pk)
+if #event_tags > 0 then
+    redis.call('SADD', tags_key, unpack(event_tags))
+end
+local group_tags = redis.call('SMEMBERS', tags_key)
+for i = 1, #group_sortables, 2 do
+    local value = redis.call('ZSCORE', group_sortables[i + 1], group_pk)
+    if value then
+        local template = string.gsub(tag_index_key, '{index}', group_sortables[i])
+        for _, tag in ipairs(group_tags) do
+            redis.call('ZADD', (string.gsub(template, '{tag}', tag)), value, group_pk)
+        end
+    end
+end
+
+redis.call('ZADD', with_pk(child_relation, group_pk), last_seen_score, event_pk)
+redis.call('ZADD', parent_relation, last_seen_score, group_pk)
+
+-- counters which are maintained per unique group (e.g. EventType, Tag)
+if created then
+    for _, counter in ipairs(counters) do
+        local pk = redis.call('SRANDMEMBER', counter.cindexes[1])
+        local value
+        if pk then
+            value = redis.call('HINCRBY', with_pk(counter.key, pk), 'count', 1)
+        else
+            pk = counter.pk
+            value = 1
+            redis.call('HMSET', with_pk(counter.key, pk), unpack(counter.values))
+            for i = 1, #counter.cindexes do
+                redis.call('SADD', counter.cindexes[i], pk)
+            end
+        end
+        redis.call('ZADD', counter.index, value, pk)
+    end
+end
+
+return {group_pk, redis.call('HGETALL', group_key)}
+"""
+
+# Applies ZADD (with ARGV[4] as the score) or ZREM for ARGV[2] to a sorted
+# index, KEYS[1], and to its tag indexes for each tag in the instance's tag
+# set, KEYS[2]. ARGV[3] is the tag index key template containing "{tag}".
+UPDATE_INDEX_SCRIPT = """
+local command, pk, template = ARGV[1], ARGV[2], ARGV[3]
+local function apply(key)
+    if command == 'ZADD' then
+        redis.call('ZADD', key, ARGV[4], pk)
+    else
+        redis.call('ZREM', key, pk)
+    end
+end
+apply(KEYS[1])
+for _, tag in ipairs(redis.call('SMEMBERS', KEYS[2])) do
+    apply((string.gsub(template, '{tag}', tag)))
+end
+"""
+
+# Stores the intersection of the tag indexes KEYS[2..n] in KEYS[1], unless
+# it is still cached, and expires it after ARGV[1] seconds. Every tag index
+# holds the same score for an instance, so MAX keeps that score. Returns the
+# number of instances in the intersection.
+INTERSECT_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    local args = {KEYS[1], #KEYS - 1}
+    for i = 2, #KEYS do
+        args[#args + 1] = KEYS[i]
+    end
+    args[#args + 1] = 'AGGREGATE'
+    args[#args + 1] = 'MAX'
+    redis.call('ZINTERSTORE', unpack(args))
+    redis.call('EXPIRE', KEYS[1], ARGV[1])
+end
+return redis.call('ZCARD', KEYS[1])
+"""
+
+# Sets the lock KEYS[1] to the owner ARGV[1] for ARGV[2] milliseconds, unless
+# another owner holds it. Returns 1 if ARGV[1] holds the lock.
+ACQUIRE_LOCK_SCRIPT = """
+local owner = redis.call('GET', KEYS[1])
+if owner and owner ~= ARGV[1] then
+    return 0
+end
+redis.call('SET', KEYS[1], ARGV[1], 'PX', ARGV[2])
+return 1
+"""
+
+# Deletes the lock KEYS[1] if the owner ARGV[1] holds it.
+RELEASE_LOCK_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    redis.call('DEL', KEYS[1])
+end
+"""
+
 class RedisBackend(SentryBackend):
-    def __init__(self, host='localhost', port=6379, db=0, key_prefix=''):
-        self.conn = redis.Redis(host, port, db)
+    def __init__(self, host='localhost', port=6379, db=0, key_prefix='', filter_timeout=5,
+                 max_connections=None, pool_timeout=20):
+        if max_connections:
+            # callers wait up to ``pool_timeout`` seconds for a connection,
+            # rather than each opening one of their own
+            pool = redis.BlockingConnectionPool(max_connections=max_connections, timeout=pool_timeout,
+                                                host=host, port=port, db=db)
+            self.conn = redis.Redis(connection_pool=pool)
+        else:
+            self.conn = redis.Redis(host, port, db)
         self.key_prefix = key_prefix
+        # number of seconds the intersection of several tag indexes is cached
+        self.filter_timeout = filter_timeout
+        self.store_event_script = self.conn.register_script(STORE_EVENT_SCRIPT)
+        self.update_index_script = self.conn.register_script(UPDATE_INDEX_SCRIPT)
+        self.intersect_script = self.conn.register_script(INTERSECT_SCRIPT)
+        self.acquire_lock_script = self.conn.register_script(ACQUIRE_LOCK_SCRIPT)
+        self.release_lock_script = self.conn.register_script(RELEASE_LOCK_SCRIPT)
 
     ## Keys
     
@@ -38,6 +255,23 @@ class RedisBackend(SentryBackend):
     def _get_constraint_key(self, schema, kwargs):
         return self._get_key('cindex:%s:%s' % (self._get_schema_name(schema), self._get_composite_key(**kwargs)))
 
+    def _get_tags_key(self, schema, pk):
+        return self._get_key('tags:%s:%s' % (self._get_schema_name(schema), pk))
+
+    def _get_tag_index_key(self, schema, index, tag_hash):
+        return self._get_key('tindex:%s:%s:%s' % (self._get_schema_name(schema), index, tag_hash))
+
+    def _get_filter_key(self, schema, index, tag_hashes):
+        return self._get_key('findex:%s:%s:%s' % (self._get_schema_name(schema), index,
+                                                  hashlib.md5('|'.join(sorted(tag_hashes))).hexdigest()))
+
+    def _get_lock_key(self, name):
+        return self._get_key('lock:%s' % name)
+
+    def _get_counts_key(self, schema, pk, resolution, bucket):
+        start = bucket // (resolution * COUNTS_PER_KEY) * (resolution * COUNTS_PER_KEY)
+        return self._get_key('counts:%s:%s:%s:%s' % (self._get_schema_name(schema), pk or '', resolution, start))
+
     ## Hash table lookups
 
     def create_model(self, schema):
@@ -51,8 +285,7 @@ class RedisBackend(SentryBackend):
         return pk
 
     def delete(self, schema, pk):
-        self.conn.delete(self._get_data_key(schema, pk))
-        self.conn.delete(self._get_metadata_key(schema, pk))
+        self.conn.delete(self._get_data_key(schema, pk), self._get_metadata_key(schema, pk), self._get_tags_key(schema, pk))
 
     def set(self, schema, pk, **values):
         if values:
@@ -75,24 +308,248 @@ class RedisBackend(SentryBackend):
     def get_data(self, schema, pk):
         return self.conn.hgetall(self._get_data_key(schema, pk))
 
-    def count(self, schema, index='default'):
-        return self.conn.zcard(self._get_index_key(schema, index))
-
-    def list(self, schema, index='default', offset=0, limit=-1, desc=False):
+    def get_many(self, schema, pk_set):
+        # fetches the data hashes for a list of keys in a single round trip
+        if not pk_set:
+            return []
+        pipe = self.conn.pipeline(transaction=False)
+        for pk in pk_set:
+            pipe.hgetall(self._get_data_key(schema, pk))
+        return zip(pk_set, pipe.execute())
+
+    def get_many_meta(self, schema, pk_set):
+        if not pk_set:
+            return []
+        pipe = self.conn.pipeline(transaction=False)
+        for pk in pk_set:
+            pipe.hgetall(self._get_metadata_key(schema, pk))
+        return zip(pk_set, pipe.execute())
+
+    def count(self, schema, index='default', tags=None):
+        if not tags:
+            return self.conn.zcard(self._get_index_key(schema, index))
+        tag_hashes = self._get_tag_hashes(tags)
+        if len(tag_hashes) == 1:
+            return self.conn.zcard(self._get_tag_index_key(schema, index, tag_hashes.pop()))
+        return self._intersect(schema, index, tag_hashes)
+
+    def _intersect(self, schema, index, tag_hashes):
+        # stores the intersection of several tag indexes, returning its size
+        keys = [self._get_filter_key(schema, index, tag_hashes)]
+        keys.extend(self._get_tag_index_key(schema, index, h) for h in tag_hashes)
+        return self.intersect_script(keys=keys, args=[self.filter_timeout])
+
+    def _get_filtered_index_key(self, schema, index, tags):
+        # returns the key of the sorted index for instances matching all tags
+        tag_hashes = self._get_tag_hashes(tags)
+        if len(tag_hashes) == 1:
+            return self._get_tag_index_key(schema, index, tag_hashes.pop())
+        self._intersect(schema, index, tag_hashes)
+        return self._get_filter_key(schema, index, tag_hashes)
+
+    def _get_range_end(self, offset, limit):
+        # ZRANGE is inclusive of the end index
         if limit > 0:
-            end = offset+limit
+            return offset + limit - 1
+        return limit
+
+    def list(self, schema, index='default', offset=0, limit=-1, desc=False, tags=None):
+        if tags:
+            key = self._get_filtered_index_key(schema, index, tags)
         else:
-            end = limit
-        pk_set = self.conn.zrange(self._get_index_key(schema, index), start=offset, end=end, desc=desc)
-        return [(pk, self.get_data(schema, pk)) for pk in pk_set]
+            key = self._get_index_key(schema, index)
+        end = self._get_range_end(offset, limit)
+        pk_set = self.conn.zrange(key, start=offset, end=end, desc=desc)
+        return self.get_many(schema, pk_set)
+
+    ## Retention
+
+    def _get_range_before(self, schema, index, date, since, tags):
+        # returns the key of the sorted index, and the bounds of (since, date]
+        if tags:
+            tag_hashes = self._get_tag_hashes(tags)
+            if len(tag_hashes) > 1:
+                # purged instances may linger in a cached intersection
+                self.conn.delete(self._get_filter_key(schema, index, tag_hashes))
+            key = self._get_filtered_index_key(schema, index, tags)
+        else:
+            key = self._get_index_key(schema, index)
+        if since is None:
+            min_score = '-inf'
+        else:
+            min_score = '(%r' % self._get_score(since)
+        return key, min_score, self._get_score(date)
+
+    def list_before(self, schema, index, date, limit=-1, offset=0, since=None, tags=None):
+        key, min_score, max_score = self._get_range_before(schema, index, date, since, tags)
+        if limit > 0 or offset:
+            start, num = offset, limit
+        else:
+            start, num = None, None
+        return self.conn.zrangebyscore(key, min_score, max_score, start=start, num=num)
+
+    def count_before(self, schema, index, date, since=None, tags=None):
+        return self.conn.zcount(*self._get_range_before(schema, index, date, since, tags))
+
+    def purge(self, schema, pk_set, related=()):
+        # one round trip reads the tags, composite index values and related
+        # keys of every instance, and a second removes everything
+        if not pk_set:
+            return
+        has_constraints = bool(schema._meta.indexes)
+        pipe = self.conn.pipeline(transaction=False)
+        for pk in pk_set:
+            pipe.smembers(self._get_tags_key(schema, pk))
+            if has_constraints:
+                pipe.hgetall(self._get_data_key(schema, pk))
+            for to_schema in related:
+                pipe.zrange(self._get_relation_key(schema, pk, to_schema), 0, -1)
+        results = iter(pipe.execute())
+
+        # members to remove from each sorted index (or set, for composite
+        # indexes), by key
+        zmembers, smembers = {}, {}
+        keys = []
+        indexes = self._get_sort_indexes(schema)
+        for pk in pk_set:
+            tag_hashes = results.next()
+            if has_constraints:
+                for key in self._get_constraint_keys(schema(pk, **results.next())):
+                    smembers.setdefault(key, []).append(pk)
+            for to_schema in related:
+                for to_pk in results.next():
+                    zmembers.setdefault(self._get_relation_key(to_schema, to_pk, schema), []).append(pk)
+                keys.append(self._get_relation_key(schema, pk, to_schema))
+            for index in indexes:
+                zmembers.setdefault(self._get_index_key(schema, index), []).append(pk)
+                for tag_hash in tag_hashes:
+                    zmembers.setdefault(self._get_tag_index_key(schema, index, tag_hash), []).append(pk)
+            keys.extend([self._get_data_key(schema, pk), self._get_metadata_key(schema, pk),
+                         self._get_tags_key(schema, pk)])
+
+        pipe = self.conn.pipeline(transaction=False)
+        for key, members in zmembers.iteritems():
+            pipe.zrem(key, *members)
+        for key, members in smembers.iteritems():
+            pipe.srem(key, *members)
+        pipe.delete(*keys)
+        pipe.execute()
+
+    ## Locks
+
+    def acquire_lock(self, name, owner, timeout):
+        # locks expire within Redis, so a crashed owner's lock is freed
+        return bool(self.acquire_lock_script(keys=[self._get_lock_key(name)],
+                                             args=[owner, int(timeout * 1000)]))
+
+    def release_lock(self, name, owner):
+        self.release_lock_script(keys=[self._get_lock_key(name)], args=[owner])
+
+    ## Events
+
+    def _flatten(self, values):
+        # packs a list (or dict) for STORE_EVENT_SCRIPT, prefixed by its length
+        if isinstance(values, dict):
+            values = [v for pair in values.iteritems() for v in pair]
+        return [len(values)] + list(values)
+
+    def _get_counter_args(self, instance):
+        model = type(instance)
+        args = self._flatten(self._get_constraint_keys(instance))
+        args.append(self.generate_key(model))
+        args.append(self._get_data_key(model, '{pk}'))
+        args.extend(self._flatten(self._get_values(instance)))
+        args.append(self._get_index_key(model, model._meta.ordering))
+        return args
+
+    def _get_store_event_params(self, event, group, data):
+        # returns the (keys, args) for STORE_EVENT_SCRIPT
+        event_model, group_model = type(event), type(group)
+
+        event_indexes = [(self._get_index_key(event_model, index), self._get_score(getattr(event, index) or 0.0))
+                         for index in set(event._meta.sortables)]
+        if event._meta.ordering == 'default':
+            event_indexes.append((self._get_index_key(event_model, 'default'), self._get_score(datetime.datetime.now())))
+
+        group_sortables = [(index, self._get_index_key(group_model, index))
+                           for index in set(group._meta.sortables)]
+
+        counters = self._get_counters(group)
+
+        args = [event.pk]
+        args.extend(self._flatten(self._get_values(event)))
+        args.extend(self._flatten(to_db(event_model, data)))
+        args.extend(self._flatten([v for pair in event_indexes for v in pair]))
+        args.extend(self._flatten(self._get_constraint_keys(group)))
+        args.append(self.generate_key(group_model))
+        args.append(self._get_data_key(group_model, '{pk}'))
+        args.extend(self._flatten(self._get_values(group)))
+        args.extend(self._flatten([v for pair in group_sortables for v in pair]))
+        args.append(int(event.time_spent or 0))
+        args.append(to_db(group_model, {'last_seen': event.date})['last_seen'])
+        args.append(self._get_score(event.date))
+        args.append(self._get_score(group.first_seen))
+        args.append(self._get_relation_key(group_model, '{pk}', event_model))
+        args.append(self._get_relation_key(event_model, event.pk, group_model))
+        args.append(self._get_tags_key(group_model, '{pk}'))
+        args.append(self._get_tag_index_key(group_model, '{index}', '{tag}'))
+        args.extend(self._flatten([self._get_tag_hash(k, v) for k, v in event.tags]))
+        args.append(len(counters))
+        for counter in counters:
+            args.extend(self._get_counter_args(counter))
+
+        keys = (self._get_data_key(event_model, event.pk), self._get_metadata_key(event_model, event.pk))
+
+        return keys, args
+
+    def store_event(self, event, group, data):
+        # The entire write path runs as a single server side script, which
+        # also guarantees only one group exists for a given (type, hash).
+        keys, args = self._get_store_event_params(event, group, data)
+        pk, values = self.store_event_script(keys=keys, args=args)
+        return event, type(group)(pk, **dict(zip(values[::2], values[1::2])))
+
+    def store_events(self, event_list):
+        # Each event is still stored atomically, but the whole batch is sent
+        # in a single pipeline.
+        pipe = self.conn.pipeline(transaction=False)
+        for event, group, data in event_list:
+            keys, args = self._get_store_event_params(event, group, data)
+            self.store_event_script(keys=keys, args=args, client=pipe)
+        results = []
+        for (event, group, data), (pk, values) in zip(event_list, pipe.execute()):
+            results.append((event, type(group)(pk, **dict(zip(values[::2], values[1::2])))))
+        return results
+
+    ## Counts
+
+    def incr_counts(self, schema, counts):
+        pipe = self.conn.pipeline(transaction=False)
+        for pk, date, amount in counts:
+            for resolution, ttl in COUNT_RESOLUTIONS:
+                bucket = self._get_bucket(date, resolution)
+                key = self._get_counts_key(schema, pk, resolution, bucket)
+                pipe.hincrby(key, bucket, amount)
+                pipe.expire(key, ttl + resolution * COUNTS_PER_KEY)
+        pipe.execute()
+
+    def get_counts(self, schema, pk, resolution, start, end):
+        # a single round trip, of one HGETALL per key the range spans
+        buckets = self._get_buckets(resolution, start, end)
+        keys = sorted(set(self._get_counts_key(schema, pk, resolution, b) for b in buckets))
+        pipe = self.conn.pipeline(transaction=False)
+        for key in keys:
+            pipe.hgetall(key)
+        counts = {}
+        for result in pipe.execute():
+            counts.update(result)
+        return [(datetime.datetime.utcfromtimestamp(b), int(counts.get(str(b), 0))) for b in buckets]
 
     ## Indexes using sorted sets
 
     def add_relation(self, from_schema, from_pk, to_schema, to_pk, score):
         # adds a relation to a sorted index for base instance
-        if isinstance(score, datetime.datetime):
-            score = score.strftime('%s.%m')
-        self.conn.zadd(self._get_relation_key(from_schema, from_pk, to_schema), to_pk, float(score))
+        self.conn.zadd(self._get_relation_key(from_schema, from_pk, to_schema), to_pk, self._get_score(score))
 
     def remove_relation(self, from_schema, from_pk, to_schema, to_pk=None):
         if to_pk:
@@ -102,24 +559,44 @@ class RedisBackend(SentryBackend):
 
     def list_relations(self, from_schema, from_pk, to_schema, offset=0, limit=-1, desc=False):
         # lists relations in a sorted index for base instance
-        # XXX: this is O(n)+1, ugh
-        if limit > 0:
-            end = offset+limit
-        else:
-            end = limit
-            
+        end = self._get_range_end(offset, limit)
         pk_set = self.conn.zrange(self._get_relation_key(from_schema, from_pk, to_schema), start=offset, end=end, desc=desc)
+        return self.get_many(to_schema, pk_set)
 
-        return [(pk, self.conn.hgetall(self._get_data_key(to_schema, pk))) for pk in pk_set]
+    def _update_index(self, schema, pk, index, command, score=None):
+        keys = [self._get_index_key(schema, index), self._get_tags_key(schema, pk)]
+        args = [command, pk, self._get_tag_index_key(schema, index, '{tag}')]
+        if score is not None:
+            args.append(score)
+        self.update_index_script(keys=keys, args=args)
 
     def add_to_index(self, schema, pk, index, score):
-        # adds an instance to a sorted index
-        if isinstance(score, datetime.datetime):
-            score = score.strftime('%s.%m')
-        self.conn.zadd(self._get_index_key(schema, index), pk, float(score))
+        # adds an instance to a sorted index, and the matching tag indexes
+        self._update_index(schema, pk, index, 'ZADD', self._get_score(score))
 
     def remove_from_index(self, schema, pk, index):
-        self.conn.zrem(self._get_index_key(schema, index), pk)
+        self._update_index(schema, pk, index, 'ZREM')
+
+    ## Tag indexes, which hold the instances of a sorted index with a given tag
+
+    def add_tags(self, schema, pk, tags):
+        tag_hashes = self._get_tag_hashes(tags)
+        if not tag_hashes:
+            return
+        sortables = set(schema._meta.sortables)
+        pipe = self.conn.pipeline(transaction=False)
+        pipe.sadd(self._get_tags_key(schema, pk), *tag_hashes)
+        for index in sortables:
+            pipe.zscore(self._get_index_key(schema, index), pk)
+        scores = pipe.execute()[1:]
+
+        pipe = self.conn.pipeline(transaction=False)
+        for index, score in zip(sortables, scores):
+            if score is None:
+                continue
+            for tag_hash in tag_hashes:
+                pipe.zadd(self._get_tag_index_key(schema, index, tag_hash), pk, score)
+        pipe.execute()
 
     ## Generic indexes
 
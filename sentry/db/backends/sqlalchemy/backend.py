@@ -8,122 +8,496 @@ sentry.db.backends.sqlalchemy
 
 from __future__ import absolute_import
 
-from sentry.db.backends.base import SentryBackend
+from sentry.db import models
+from sentry.db.backends.base import SentryBackend, COUNT_RESOLUTIONS
 
 import datetime
+import time
 
-from sqlalchemy import create_engine
-from sqlalchemy.sql import select
+from contextlib import contextmanager
+from threading import Lock, local
 
-from sentry.db.backends.sqlalchemy.models import metadata, model_map
+from sqlalchemy import create_engine, event, MetaData, and_, or_, func
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.sql import bindparam, select
+
+from sentry.db.backends.sqlalchemy.models import create_table, create_meta_table, \
+                                                 create_tags_table, create_relations_table, \
+                                                 create_counts_table, create_locks_table, get_sort_column
 
 class SQLAlchemyBackend(SentryBackend):
-    def __init__(self, uri, **kwargs):
+    """
+    Stores each model in a table of its own, created on first use.
+
+    Sort indexes and composite indexes are indexes over the model's columns,
+    relations live in a single table ordered by (parent, score), and tag
+    filters are joins against a table of (instance, tag) pairs.
+    """
+    def __init__(self, uri, table_prefix='sentry_', **kwargs):
         self.engine = create_engine(uri, **kwargs)
+        self._configure_engine()
+        self.table_prefix = table_prefix
+        self.metadata = MetaData()
+        self._tables = {}
+        self._lock = Lock()
+        # the connection of the current transaction, if any, for each thread
+        self._local = local()
+        self.relations = create_relations_table(self.metadata, '%srelations' % table_prefix)
+        self.relations.create(self.engine, checkfirst=True)
+        self.counts = create_counts_table(self.metadata, '%scounts' % table_prefix)
+        self.counts.create(self.engine, checkfirst=True)
+        self.locks = create_locks_table(self.metadata, '%slocks' % table_prefix)
+        self.locks.create(self.engine, checkfirst=True)
 
-    def create_model(self, schema):
-        metadata.create(model_map[schema])
+    def _configure_engine(self):
+        # called before the first connection is made
+        if self.engine.dialect.name == 'sqlite':
+            event.listen(self.engine, 'connect', self._on_sqlite_connect)
+            event.listen(self.engine, 'begin', self._on_sqlite_begin)
+
+    def _on_sqlite_connect(self, dbapi_conn, connection_record):
+        # the sqlite3 module starts and ends transactions on its own, which
+        # breaks savepoints (see set), so they are started by _on_sqlite_begin
+        dbapi_conn.isolation_level = None
+
+    def _on_sqlite_begin(self, conn):
+        conn.execute('BEGIN')
+
+    ## Tables
+
+    def _get_tables(self, schema):
+        # returns the (data, meta, tags) tables for a model
+        try:
+            return self._tables[schema]
+        except KeyError:
+            pass
+
+        self._lock.acquire()
+        try:
+            if schema not in self._tables:
+                name = '%s%s' % (self.table_prefix, self._get_schema_name(schema))
+                tables = (
+                    create_table(self.metadata, schema, name),
+                    create_meta_table(self.metadata, schema, name),
+                    create_tags_table(self.metadata, schema, name),
+                )
+                # within a transaction, the tables must be created on its
+                # connection, as it may hold the database's write lock
+                bind = getattr(self._local, 'conn', None) or self.engine
+                for table in tables:
+                    table.create(bind, checkfirst=True)
+                if bind is not self.engine:
+                    self._local.created.append(schema)
+                self._tables[schema] = tables
+            return self._tables[schema]
+        finally:
+            self._lock.release()
+
+    def _get_table(self, schema):
+        return self._get_tables(schema)[0]
+
+    def _get_sort_column(self, schema, index):
+        table = self._get_table(schema)
+        if index in schema._meta.fields:
+            return table.c[index]
+        return table.c[get_sort_column(index)]
+
+    def _to_columns(self, schema, values):
+        # values arrive as returned by ``to_db``, and are coerced back to
+        # Python types so they can be stored in typed columns
+        result = {}
+        for name, value in values.iteritems():
+            field = schema._meta.fields[name]
+            if value == '':
+                value = None
+            if not isinstance(field, models.List):
+                value = field.to_python(value)
+            result[name] = value
+        return result
+
+    def _to_data(self, schema, row):
+        return dict((name, row[name]) for name in schema._meta.fields
+                    if row[name] is not None)
+
+    @contextmanager
+    def transaction(self):
+        """
+        Runs every query within the block on a single connection, as one
+        transaction. Nested blocks join the outer transaction.
+        """
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            yield conn
+            return
+
+        with self.engine.begin() as conn:
+            self._local.conn = conn
+            self._local.created = []
+            try:
+                yield conn
+            except:
+                # tables created within the transaction are rolled back too
+                self._forget_tables(self._local.created)
+                raise
+            finally:
+                self._local.conn = None
+
+    def _forget_tables(self, schemas):
+        self._lock.acquire()
+        try:
+            for schema in schemas:
+                for table in self._tables.pop(schema, ()):
+                    self.metadata.remove(table)
+        finally:
+            self._lock.release()
+
+    def _execute(self, query, *args):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            return self.engine.execute(query, *args)
+        return conn.execute(query, *args)
 
     ## Hash table lookups
 
+    def create_model(self, schema):
+        self._get_tables(schema)
+
     def add(self, schema, **values):
         # generates a pk and sets the values
         pk = self.generate_key(schema)
-        table = model_map[schema]
-        query = table.insert(id=pk, **values)
-        self.engine.execute(query)
+        table = self._get_table(schema)
+        self._execute(table.insert().values(id=pk, **self._to_columns(schema, values)))
         return pk
 
     def delete(self, schema, pk):
-        table = model_map[schema]
-        query = table.delete(table.c.id==pk)
-        self.engine.execute(query)
+        table, meta, tags = self._get_tables(schema)
+        relations = self.relations
+        with self.transaction() as conn:
+            conn.execute(table.delete().where(table.c.id == pk))
+            conn.execute(meta.delete().where(meta.c.id == pk))
+            conn.execute(tags.delete().where(tags.c.id == pk))
+            conn.execute(relations.delete().where(and_(relations.c.from_schema == self._get_schema_name(schema),
+                                                       relations.c.from_id == pk)))
 
     def set(self, schema, pk, **values):
-        table = model_map[schema]
-        query = table.update(table.c.id==pk).values(**values)
-        self.engine.execute(query)
+        # instances may be saved with a key of their own (e.g. events), so
+        # this creates the row if needed
+        if not values:
+            return
+        table = self._get_table(schema)
+        values = self._to_columns(schema, values)
+        with self.transaction() as conn:
+            if not schema._meta.unique:
+                self._set(conn, table, pk, values)
+                return
+            # a conflict on a unique index is rolled back on its own, so that
+            # the transaction can go on with the instance which exists
+            try:
+                with conn.begin_nested():
+                    self._set(conn, table, pk, values)
+            except IntegrityError, e:
+                raise schema.DuplicateKeyError(str(e))
+
+    def _set(self, conn, table, pk, values):
+        result = conn.execute(table.update().where(table.c.id == pk).values(**values))
+        if not result.rowcount:
+            conn.execute(table.insert().values(id=pk, **values))
 
     def get(self, schema, pk):
-        table = model_map[schema]
-        query = select([table], table.c.id==pk)
-        return self.engine.execute(query).fetchone()
+        table = self._get_table(schema)
+        row = self._execute(select([table]).where(table.c.id == pk)).fetchone()
+        if row is None:
+            return {}
+        return self._to_data(schema, row)
+
+    def get_data(self, schema, pk):
+        return self.get(schema, pk)
+
+    def get_many(self, schema, pk_set):
+        if not pk_set:
+            return []
+        table = self._get_table(schema)
+        rows = self._execute(select([table]).where(table.c.id.in_(pk_set)))
+        data = dict((row['id'], self._to_data(schema, row)) for row in rows)
+        return [(pk, data.get(pk, {})) for pk in pk_set]
 
     def incr(self, schema, pk, key, amount=1):
-        table = model_map[schema]
-        query = table.update(table.c.id==pk, {key: getattr(table.c, key) + amount})
-        self.engine.execute(query)
-    
-    # meta data is stored in a seperate key to avoid collissions and heavy getall pulls
+        table = self._get_table(schema)
+        column = table.c[key]
+        with self.transaction() as conn:
+            conn.execute(table.update().where(table.c.id == pk).values({column: func.coalesce(column, 0) + amount}))
+            return conn.execute(select([column]).where(table.c.id == pk)).scalar()
+
+    # meta data is stored in a seperate table to avoid collissions and heavy getall pulls
 
-    # TODO:
     def set_meta(self, schema, pk, **values):
-        self.conn.hmset(self._get_metadata_key(schema, pk), values)
+        if not values:
+            return
+        meta = self._get_tables(schema)[1]
+        with self.transaction() as conn:
+            conn.execute(meta.delete().where(and_(meta.c.id == pk, meta.c.key.in_(values.keys()))))
+            conn.execute(meta.insert(), [{'id': pk, 'key': k, 'value': v} for k, v in values.iteritems()])
 
     def get_meta(self, schema, pk):
-        return self.conn.hgetall(self._get_metadata_key(schema, pk))
+        meta = self._get_tables(schema)[1]
+        rows = self._execute(select([meta.c.key, meta.c.value]).where(meta.c.id == pk))
+        return dict((row['key'], row['value']) for row in rows)
 
-    def get_data(self, schema, pk):
-        return self.conn.hgetall(self._get_data_key(schema, pk))
+    def get_many_meta(self, schema, pk_set):
+        if not pk_set:
+            return []
+        meta = self._get_tables(schema)[1]
+        rows = self._execute(select([meta]).where(meta.c.id.in_(pk_set)))
+        data = dict((pk, {}) for pk in pk_set)
+        for row in rows:
+            data[row['id']][row['key']] = row['value']
+        return [(pk, data[pk]) for pk in pk_set]
 
-    def count(self, schema, index='default'):
-        return self.conn.zcard(self._get_index_key(schema, index))
+    def _filter_tags(self, schema, from_obj, tags):
+        # joins one alias of the tags table per tag, each of which is a
+        # lookup on its (tag, id) index
+        table, meta, tags_table = self._get_tables(schema)
+        for tag_hash in self._get_tag_hashes(tags):
+            alias = tags_table.alias()
+            from_obj = from_obj.join(alias, and_(alias.c.id == table.c.id, alias.c.tag == tag_hash))
+        return from_obj
 
-    def list(self, schema, index='default', offset=0, limit=-1, desc=False):
-        if limit > 0:
-            end = offset+limit
+    def count(self, schema, index='default', tags=None):
+        table = self._get_table(schema)
+        from_obj = table
+        if tags:
+            from_obj = self._filter_tags(schema, from_obj, tags)
+        query = select([func.count()]).select_from(from_obj)
+        return self._execute(query).scalar()
+
+    def _apply_range(self, query, column, offset, limit, desc):
+        if desc:
+            query = query.order_by(column.desc())
         else:
-            end = limit
-        pk_set = self.conn.zrange(self._get_index_key(schema, index), start=offset, end=end, desc=desc)
-        return [(pk, self.get_data(schema, pk)) for pk in pk_set]
+            query = query.order_by(column)
+        if limit > 0:
+            query = query.limit(limit)
+        if offset:
+            query = query.offset(offset)
+        return query
+
+    def list(self, schema, index='default', offset=0, limit=-1, desc=False, tags=None):
+        table = self._get_table(schema)
+        from_obj = table
+        if tags:
+            from_obj = self._filter_tags(schema, from_obj, tags)
+        query = select([table]).select_from(from_obj)
+        query = self._apply_range(query, self._get_sort_column(schema, index), offset, limit, desc)
+        return [(row['id'], self._to_data(schema, row)) for row in self._execute(query)]
+
+    ## Retention
+
+    def _get_before_clause(self, schema, index, date, since):
+        column = self._get_sort_column(schema, index)
+        if index not in schema._meta.fields:
+            date = self._get_score(date)
+            if since is not None:
+                since = self._get_score(since)
+        clause = column <= date
+        if since is not None:
+            clause = and_(clause, column > since)
+        return column, clause
+
+    def _get_before_from(self, schema, tags):
+        from_obj = self._get_table(schema)
+        if tags:
+            from_obj = self._filter_tags(schema, from_obj, tags)
+        return from_obj
+
+    def list_before(self, schema, index, date, limit=-1, offset=0, since=None, tags=None):
+        table = self._get_table(schema)
+        column, clause = self._get_before_clause(schema, index, date, since)
+        query = select([table.c.id], from_obj=self._get_before_from(schema, tags)).where(clause) \
+                .order_by(column.asc(), table.c.id.asc())
+        if limit > 0:
+            query = query.limit(limit)
+        if offset:
+            query = query.offset(offset)
+        return [row['id'] for row in self._execute(query)]
+
+    def count_before(self, schema, index, date, since=None, tags=None):
+        column, clause = self._get_before_clause(schema, index, date, since)
+        query = select([func.count()]).select_from(self._get_before_from(schema, tags)).where(clause)
+        return self._execute(query).scalar()
+
+    def purge(self, schema, pk_set, related=()):
+        if not pk_set:
+            return
+        pk_set = list(pk_set)
+        table, meta, tags = self._get_tables(schema)
+        relations, counts = self.relations, self.counts
+        name = self._get_schema_name(schema)
+        forward = and_(relations.c.from_schema == name, relations.c.from_id.in_(pk_set))
+        with self.transaction() as conn:
+            # the reverse of each relation is deleted by its primary key
+            rows = conn.execute(select([relations.c.from_id, relations.c.to_schema, relations.c.to_id])
+                                .where(forward)).fetchall()
+            if rows:
+                conn.execute(relations.delete().where(and_(
+                    relations.c.from_schema == bindparam('r_schema'), relations.c.from_id == bindparam('r_id'),
+                    relations.c.to_schema == name, relations.c.to_id == bindparam('r_to_id'),
+                )), [{'r_schema': row['to_schema'], 'r_id': row['to_id'], 'r_to_id': row['from_id']} for row in rows])
+            conn.execute(relations.delete().where(forward))
+            conn.execute(table.delete().where(table.c.id.in_(pk_set)))
+            conn.execute(meta.delete().where(meta.c.id.in_(pk_set)))
+            conn.execute(tags.delete().where(tags.c.id.in_(pk_set)))
+            conn.execute(counts.delete().where(and_(counts.c.schema == name, counts.c.id.in_(pk_set))))
+
+    ## Locks, held in a table of (name, owner, expires)
 
-    ## Indexes using sorted sets
+    def acquire_lock(self, name, owner, timeout):
+        table = self.locks
+        now = time.time()
+        # takes over the lock if it is ours or has expired, and otherwise
+        # creates it, which fails if another owner got there first
+        result = self._execute(table.update().where(and_(
+            table.c.name == name, or_(table.c.owner == owner, table.c.expires <= now),
+        )).values(owner=owner, expires=now + timeout))
+        if result.rowcount:
+            return True
+        try:
+            self._execute(table.insert().values(name=name, owner=owner, expires=now + timeout))
+        except IntegrityError:
+            return False
+        return True
+
+    def release_lock(self, name, owner):
+        table = self.locks
+        self._execute(table.delete().where(and_(table.c.name == name, table.c.owner == owner)))
+
+    ## Events
+
+    def store_event(self, event, group, data):
+        with self.transaction():
+            return super(SQLAlchemyBackend, self).store_event(event, group, data)
+
+    def store_events(self, event_list):
+        # the whole batch is written in a single transaction
+        with self.transaction():
+            return super(SQLAlchemyBackend, self).store_events(event_list)
+
+    ## Counts, held in a single table of (instance, resolution, bucket)
+
+    def incr_counts(self, schema, counts):
+        table = self.counts
+        name = self._get_schema_name(schema)
+        with self.transaction() as conn:
+            for pk, date, amount in counts:
+                for resolution, ttl in COUNT_RESOLUTIONS:
+                    bucket = self._get_bucket(date, resolution)
+                    key = and_(table.c.schema == name, table.c.id == (pk or ''), table.c.resolution == resolution)
+                    update = table.update().where(and_(key, table.c.bucket == bucket)) \
+                                  .values(count=table.c.count + amount)
+                    if conn.execute(update).rowcount:
+                        continue
+                    try:
+                        with conn.begin_nested():
+                            conn.execute(table.insert().values(schema=name, id=pk or '', resolution=resolution,
+                                                               bucket=bucket, count=amount))
+                    except IntegrityError:
+                        # another process created the bucket first (e.g. the
+                        # one across all instances)
+                        conn.execute(update)
+                    else:
+                        # drops the buckets which are no longer kept
+                        conn.execute(table.delete().where(and_(key, table.c.bucket <= bucket - ttl)))
+
+    def get_counts(self, schema, pk, resolution, start, end):
+        table = self.counts
+        buckets = self._get_buckets(resolution, start, end)
+        if not buckets:
+            return []
+        rows = self._execute(select([table.c.bucket, table.c.count]).where(and_(
+            table.c.schema == self._get_schema_name(schema), table.c.id == (pk or ''),
+            table.c.resolution == resolution, table.c.bucket.between(buckets[0], buckets[-1]))))
+        counts = dict((row['bucket'], row['count']) for row in rows)
+        return [(datetime.datetime.utcfromtimestamp(b), counts.get(b, 0)) for b in buckets]
+
+    ## Relations, held in a single table indexed by (parent, score)
 
     def add_relation(self, from_schema, from_pk, to_schema, to_pk, score):
         # adds a relation to a sorted index for base instance
-        if isinstance(score, datetime.datetime):
-            score = score.strftime('%s.%m')
-        self.conn.zadd(self._get_relation_key(from_schema, from_pk, to_schema), to_pk, float(score))
+        relations = self.relations
+        values = {
+            'from_schema': self._get_schema_name(from_schema),
+            'from_id': from_pk,
+            'to_schema': self._get_schema_name(to_schema),
+            'to_id': to_pk,
+        }
+        score = self._get_score(score)
+        with self.transaction() as conn:
+            result = conn.execute(relations.update().where(and_(*[relations.c[k] == v for k, v in values.iteritems()]))
+                                                    .values(score=score))
+            if not result.rowcount:
+                conn.execute(relations.insert().values(score=score, **values))
 
     def remove_relation(self, from_schema, from_pk, to_schema, to_pk=None):
+        relations = self.relations
+        clauses = [
+            relations.c.from_schema == self._get_schema_name(from_schema),
+            relations.c.from_id == from_pk,
+            relations.c.to_schema == self._get_schema_name(to_schema),
+        ]
         if to_pk:
-            self.conn.zrem(self._get_relation_key(from_schema, from_pk, to_schema), to_pk)
-        else:
-            self.conn.delete(self._get_relation_key(from_schema, from_pk, to_schema))
+            clauses.append(relations.c.to_id == to_pk)
+        self._execute(relations.delete().where(and_(*clauses)))
 
     def list_relations(self, from_schema, from_pk, to_schema, offset=0, limit=-1, desc=False):
         # lists relations in a sorted index for base instance
-        # XXX: this is O(n)+1, ugh
-        if limit > 0:
-            end = offset+limit
-        else:
-            end = limit
-            
-        pk_set = self.conn.zrange(self._get_relation_key(from_schema, from_pk, to_schema), start=offset, end=end, desc=desc)
+        relations = self.relations
+        table = self._get_table(to_schema)
+        query = select([table]).select_from(relations.join(table, table.c.id == relations.c.to_id)) \
+                               .where(and_(relations.c.from_schema == self._get_schema_name(from_schema),
+                                           relations.c.from_id == from_pk,
+                                           relations.c.to_schema == self._get_schema_name(to_schema)))
+        query = self._apply_range(query, relations.c.score, offset, limit, desc)
+        return [(row['id'], self._to_data(to_schema, row)) for row in self._execute(query)]
 
-        return [(pk, self.conn.hgetall(self._get_data_key(to_schema, pk))) for pk in pk_set]
+    ## Sort indexes, which are the columns themselves
 
     def add_to_index(self, schema, pk, index, score):
-        # adds an instance to a sorted index
-        if isinstance(score, datetime.datetime):
-            score = score.strftime('%s.%m')
-        self.conn.zadd(self._get_index_key(schema, index), pk, float(score))
+        # fields are already stored by ``set``, so only the sort indexes
+        # which are not a field need updating
+        if index in schema._meta.fields:
+            return
+        table = self._get_table(schema)
+        column = self._get_sort_column(schema, index)
+        self._execute(table.update().where(table.c.id == pk).values({column: self._get_score(score)}))
 
     def remove_from_index(self, schema, pk, index):
-        self.conn.zrem(self._get_index_key(schema, index), pk)
+        # rows leave their indexes when they are deleted
+        return
+
+    ## Tags
 
-    ## Generic indexes
+    def add_tags(self, schema, pk, tags):
+        tag_hashes = self._get_tag_hashes(tags)
+        if not tag_hashes:
+            return
+        tags_table = self._get_tables(schema)[2]
+        with self.transaction() as conn:
+            existing = set(row[0] for row in conn.execute(select([tags_table.c.tag]).where(and_(
+                tags_table.c.id == pk, tags_table.c.tag.in_(tag_hashes)))))
+            missing = tag_hashes - existing
+            if missing:
+                conn.execute(tags_table.insert(), [{'id': pk, 'tag': h} for h in missing])
 
-    # TODO: can we combine constraint indexes with sort indexes? (at least the API)
+    ## Composite indexes, which are indexes over the columns themselves
 
     def add_to_cindex(self, schema, pk, **kwargs):
-        # adds an index to a composite index (for checking uniqueness)
-        self.conn.sadd(self._get_constraint_key(schema, kwargs), pk)
+        return
 
     def remove_from_cindex(self, schema, pk, **kwargs):
-        # adds an index to a composite index (for checking uniqueness)
-        self.conn.srem(self._get_constraint_key(schema, kwargs), pk)
+        return
 
     def list_by_cindex(self, schema, **kwargs):
         # returns a list of keys associated with a constraint
-        return list(self.conn.smembers(self._get_constraint_key(schema, kwargs)))
+        table = self._get_table(schema)
+        values = self._to_columns(schema, kwargs)
+        query = select([table.c.id]).where(and_(*[table.c[k] == v for k, v in values.iteritems()]))
+        return [row[0] for row in self._execute(query)]
@@ -1,49 +1,110 @@
-import sentry.models
+"""
+sentry.db.backends.sqlalchemy.models
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Table definitions for the models of ``sentry.db.models``.
+
+:copyright: (c) 2010 by the Sentry Team, see AUTHORS for more details.
+:license: BSD, see LICENSE for more details.
+"""
+
+from __future__ import absolute_import
+
 from sentry.db import models
 
-from sqlalchemy import Table, Column, Integer, Float, String, Text, \
-                       DateTime, MetaData
+from sqlalchemy import Table, Column, Index, Integer, BigInteger, Float, String, \
+                       Text, DateTime, LargeBinary
 
-__all__ = ('metadata', 'model_map', 'model_meta')
+__all__ = ('create_table', 'create_meta_table', 'create_tags_table',
+           'create_relations_table', 'create_counts_table', 'create_locks_table',
+           'get_sort_column')
 
 column_map = {
-    models.String: lambda x: String(255, default=x.default, nullable=True),
-    models.Text: lambda x: Text(default=x.default, nullable=True),
-    models.Integer: lambda x: Integer(default=x.default, nullable=True),
-    models.Float: lambda x: Float(default=x.default, nullable=True),
-    models.DateTime: lambda x: DateTime(default=x.default, nullable=True),
-    models.List: lambda x: Text(default=x.default, nullable=True),
+    models.String: lambda: String(255),
+    models.Text: Text,
+    models.Integer: Integer,
+    models.Float: Float,
+    models.DateTime: DateTime,
+    # lists are stored encoded, as returned by List.to_db
+    models.List: LargeBinary,
 }
 
-model_map = {}
-model_meta = {}
+def get_column_type(field):
+    for cls in type(field).__mro__:
+        if cls in column_map:
+            return column_map[cls]()
+    raise TypeError('%s has no matching column type' % type(field).__name__)
+
+def get_sort_column(index):
+    # sort indexes which are not a field, i.e. the creation order of models
+    # without an ordering, get a column of their own
+    return '_%s' % index
+
+def create_table(metadata, model, name):
+    """
+    Creates the table holding the fields of ``model``.
+
+    Each sort index is an indexed column, and each composite index (see
+    ``Meta.indexes``) an index over its columns, which is unique if it is
+    listed in ``Meta.unique``.
+    """
+    sortables = set(model._meta.sortables)
 
-def create_sqlalchemy_def(metadata, model):
     columns = [
         Column('id', String(32), primary_key=True),
     ]
-    for name, field in model._meta.fields: 
-        columns.append(Column(name, column_map[field](field), nullable=True))
+    for field_name, field in model._meta.fields.iteritems():
+        columns.append(Column(field_name, get_column_type(field), nullable=True,
+                              index=field_name in sortables))
 
-    table = Table(model.__name__.lower(), metadata, *columns)
-    
-    return table
+    if model._meta.ordering == 'default':
+        columns.append(Column(get_sort_column('default'), Float, nullable=True, index=True))
 
-def create_sqlalchemy_metadata_def(metadata, model):
-    columns = [
+    for fields in model._meta.indexes:
+        columns.append(Index('%s_%s' % (name, '_'.join(fields)), *fields,
+                             unique=tuple(fields) in model._meta.unique))
+
+    return Table(name, metadata, *columns)
+
+def create_meta_table(metadata, model, name):
+    return Table('%s_meta' % name, metadata,
         Column('id', String(32), primary_key=True),
         Column('key', String(255), primary_key=True),
-        Column('value', Text(nullable=True), primary_key=True),
-    ]
+        Column('value', LargeBinary, nullable=True),
+    )
 
-    table = Table('%s_metadata' % (model.__name__.lower(),), metadata, *columns)
-    
-    return table
+def create_tags_table(metadata, model, name):
+    # holds the hash of each tag an instance has been seen with
+    return Table('%s_tags' % name, metadata,
+        Column('id', String(32), primary_key=True),
+        Column('tag', String(32), primary_key=True),
+        Index('%s_tags_tag' % name, 'tag', 'id'),
+    )
+
+def create_relations_table(metadata, name):
+    return Table(name, metadata,
+        Column('from_schema', String(64), primary_key=True),
+        Column('from_id', String(32), primary_key=True),
+        Column('to_schema', String(64), primary_key=True),
+        Column('to_id', String(32), primary_key=True),
+        Column('score', Float, nullable=False),
+        Index('%s_score' % name, 'from_schema', 'from_id', 'to_schema', 'score'),
+    )
 
-metadata = MetaData()
-# metadata.create_all(engine) 
+def create_counts_table(metadata, name):
+    # counts per (instance, resolution, bucket), see incr_counts
+    return Table(name, metadata,
+        Column('schema', String(64), primary_key=True),
+        Column('id', String(32), primary_key=True),
+        Column('resolution', Integer, primary_key=True),
+        Column('bucket', BigInteger, primary_key=True),
+        Column('count', Integer, nullable=False),
+    )
 
-for var in dir(sentry.models):
-    if isinstance(var, models.Model):
-        model_map[var] = create_sqlalchemy_def(metadata, var)
-        model_meta[var] = create_sqlalchemy_metadata_def(metadata, var)
+def create_locks_table(metadata, name):
+    # the owner of each lock, and when it expires, in seconds since the epoch
+    return Table(name, metadata,
+        Column('name', String(64), primary_key=True),
+        Column('owner', String(255), nullable=False),
+        Column('expires', Float, nullable=False),
+    )
@@ -0,0 +1,233 @@
+"""
+sentry.db.backends.sqlite
+~~~~~~~~~~~~~~~~~~~~~~~~~
+
+An embedded backend, storing everything in a single SQLite database file.
+
+:copyright: (c) 2010 by the Sentry Team, see AUTHORS for more details.
+:license: BSD, see LICENSE for more details.
+"""
+
+from __future__ import absolute_import
+
+from sentry.db import models
+from sentry.db.backends.sqlalchemy import SQLAlchemyBackend
+from sentry.db.backends.sqlalchemy.models import get_sort_column
+from sentry.db.models import to_db
+
+import time
+
+from sqlalchemy import event
+from sqlalchemy.pool import QueuePool
+
+class SQLiteBackend(SQLAlchemyBackend):
+    """
+    Uses the tables of ``SQLAlchemyBackend`` within a database file at
+    ``path``, which is opened in WAL mode: writes are appended to a log,
+    readers never block on writers, and reads are served from a memory
+    map of up to ``mmap_size`` bytes.
+
+    Every transaction takes the write lock up front, so storing an event
+    (or a batch of events, see ``store_events``) is atomic across threads
+    and processes. With ``synchronous='NORMAL'``, committed transactions
+    survive restarts of the process but may be lost along with the OS,
+    whereas ``'FULL'`` waits for each commit to reach the disk.
+    """
+    def __init__(self, path, mmap_size=256 * 1024 * 1024, synchronous='NORMAL',
+                 busy_timeout=5.0, table_prefix='sentry_', pool_size=5):
+        self.path = path
+        self.mmap_size = mmap_size
+        self.synchronous = synchronous
+        self._names = {}
+        self._columns = {}
+        super(SQLiteBackend, self).__init__('sqlite:///%s' % path, table_prefix=table_prefix,
+                                            poolclass=QueuePool, pool_size=pool_size,
+                                            connect_args={'timeout': busy_timeout, 'check_same_thread': False})
+
+    def _configure_engine(self):
+        event.listen(self.engine, 'connect', self._on_connect)
+        event.listen(self.engine, 'begin', self._on_begin)
+
+    def _on_connect(self, dbapi_conn, connection_record):
+        # transactions are started explicitly by _on_begin, rather than by
+        # the sqlite3 module before the first write
+        dbapi_conn.isolation_level = None
+        cursor = dbapi_conn.cursor()
+        cursor.execute('PRAGMA journal_mode=WAL')
+        cursor.execute('PRAGMA synchronous=%s' % self.synchronous)
+        cursor.execute('PRAGMA mmap_size=%d' % self.mmap_size)
+        cursor.close()
+
+    def _on_begin(self, conn):
+        conn.execute('BEGIN IMMEDIATE')
+
+    ## Events
+
+    # Storing an event takes a dozen statements, which are written directly
+    # to the cursor rather than compiled by SQLAlchemy, as compiling them
+    # costs several times more than executing them. Values are still
+    # converted by each column's type, so they read back the same.
+
+    def store_event(self, event, group, data):
+        with self.transaction() as conn:
+            cursor = conn.connection.cursor()
+            try:
+                return self._store_event(cursor, event, group, data)
+            finally:
+                cursor.close()
+
+    def store_events(self, event_list):
+        # the whole batch is written in a single transaction
+        with self.transaction() as conn:
+            cursor = conn.connection.cursor()
+            try:
+                return [self._store_event(cursor, *args) for args in event_list]
+            finally:
+                cursor.close()
+
+    def _quote(self, name):
+        return self.engine.dialect.identifier_preparer.quote(name)
+
+    def _get_table_name(self, schema):
+        try:
+            return self._names[schema]
+        except KeyError:
+            name = self._names[schema] = self._quote(self._get_table(schema).name)
+            return name
+
+    def _get_columns(self, schema):
+        # returns the (quoted name, bind processor, result processor) of each
+        # column, by name
+        try:
+            return self._columns[schema]
+        except KeyError:
+            pass
+        dialect = self.engine.dialect
+        columns = {}
+        for column in self._get_table(schema).columns:
+            column_type = column.type.dialect_impl(dialect)
+            columns[column.name] = (self._quote(column.name),
+                                    column_type.bind_processor(dialect),
+                                    column_type.result_processor(dialect, None))
+        self._columns[schema] = columns
+        return columns
+
+    def _get_bind_processor(self, column):
+        dialect = self.engine.dialect
+        return column.type.dialect_impl(dialect).bind_processor(dialect) or (lambda value: value)
+
+    def _bind(self, schema, values):
+        # returns the quoted names and the bound values of ``values``, which
+        # are Python values as returned by ``_to_columns``
+        columns = self._get_columns(schema)
+        names, params = [], []
+        for name, value in values.iteritems():
+            quoted, process, _ = columns[name]
+            names.append(quoted)
+            if process is not None and value is not None:
+                value = process(value)
+            params.append(value)
+        return names, params
+
+    def _get_row(self, schema, values):
+        # the same as _to_columns(schema, to_db(schema, values)), but without
+        # formatting dates only to parse them again
+        for name, field in schema._meta.fields.iteritems():
+            if name in values and isinstance(field, models.List):
+                values[name] = field.to_db(values[name])
+        return self._to_columns(schema, values)
+
+    def _insert(self, cursor, schema, pk, instance, replace=False):
+        values = self._get_row(schema, dict((name, getattr(instance, name)) for name in schema._meta.fields))
+        values['id'] = pk
+        if schema._meta.ordering == 'default':
+            values[get_sort_column('default')] = self._get_score(time.time())
+        names, params = self._bind(schema, values)
+        cursor.execute('INSERT %sINTO %s (%s) VALUES (%s)' % (
+            replace and 'OR REPLACE ' or '', self._get_table_name(schema),
+            ', '.join(names), ', '.join('?' * len(names))), params)
+
+    def _update(self, cursor, schema, pk, **values):
+        names, params = self._bind(schema, self._get_row(schema, values))
+        cursor.execute('UPDATE %s SET %s WHERE id = ?' % (
+            self._get_table_name(schema), ', '.join('%s = ?' % n for n in names)), params + [pk])
+
+    def _incr_all(self, cursor, schema, pk, **amounts):
+        cursor.execute('UPDATE %s SET %s WHERE id = ?' % (
+            self._get_table_name(schema),
+            ', '.join('%s = coalesce(%s, 0) + ?' % ((self._get_columns(schema)[name][0],) * 2) for name in amounts)),
+            amounts.values() + [pk])
+
+    def _lookup(self, cursor, instance):
+        # returns the key of the instance matching ``instance`` on its first
+        # composite index, if any
+        schema = type(instance)
+        index = schema._meta.indexes[0]
+        names, params = self._bind(schema, self._get_row(schema, dict(
+            (name, getattr(instance, name)) for name in index)))
+        cursor.execute('SELECT id FROM %s WHERE %s LIMIT 1' % (
+            self._get_table_name(schema), ' AND '.join('%s = ?' % n for n in names)), params)
+        row = cursor.fetchone()
+        return row and row[0]
+
+    def _select(self, cursor, schema, pk):
+        columns = self._get_columns(schema)
+        names = list(schema._meta.fields)
+        cursor.execute('SELECT %s FROM %s WHERE id = ?' % (
+            ', '.join(columns[n][0] for n in names), self._get_table_name(schema)), (pk,))
+        data = {}
+        for name, value in zip(names, cursor.fetchone()):
+            process = columns[name][2]
+            if process is not None:
+                value = process(value)
+            if value is not None:
+                data[name] = value
+        return schema(pk, **data)
+
+    def _store_event(self, cursor, event, group, data):
+        event_model, group_model = type(event), type(group)
+        meta_table, tags_table = self._get_tables(event_model)[1], self._get_tables(group_model)[2]
+        score = self._get_score(event.date)
+
+        self._insert(cursor, event_model, event.pk, event, replace=True)
+        if data:
+            process = self._get_bind_processor(meta_table.c.value)
+            cursor.executemany('INSERT OR REPLACE INTO %s (id, %s, value) VALUES (?, ?, ?)' % (
+                self._quote(meta_table.name), self._quote('key')),
+                [(event.pk, k, process(v)) for k, v in to_db(event_model, data).iteritems()])
+
+        # group get_or_create, which is safe as the transaction holds the
+        # write lock
+        pk = self._lookup(cursor, group)
+        created = pk is None
+        if created:
+            pk = self.generate_key(group_model)
+            self._insert(cursor, group_model, pk, group)
+        else:
+            self._incr_all(cursor, group_model, pk, count=1, time_spent=int(event.time_spent or 0))
+
+        instance = self._select(cursor, group_model, pk)
+        instance.last_seen = event.date
+        instance.score = instance.get_score()
+        self._update(cursor, group_model, pk, last_seen=instance.last_seen, score=instance.score)
+
+        if event.tags:
+            cursor.executemany('INSERT OR IGNORE INTO %s (id, tag) VALUES (?, ?)' % self._quote(tags_table.name),
+                               [(pk, self._get_tag_hash(k, v)) for k, v in event.tags])
+
+        cursor.executemany('INSERT OR REPLACE INTO %s (from_schema, from_id, to_schema, to_id, score) '
+                           'VALUES (?, ?, ?, ?, ?)' % self._quote(self.relations.name), [
+            (self._get_schema_name(group_model), pk, self._get_schema_name(event_model), event.pk, score),
+            (self._get_schema_name(event_model), event.pk, self._get_schema_name(group_model), pk, score),
+        ])
+
+        # counters which are maintained per unique group (e.g. EventType, Tag)
+        if created:
+            for counter in self._get_counters(group):
+                counter_pk = self._lookup(cursor, counter)
+                if counter_pk is None:
+                    self._insert(cursor, type(counter), self.generate_key(type(counter)), counter)
+                else:
+                    self._incr_all(cursor, type(counter), counter_pk, count=1)
+
+        return event, instance
@@ -0,0 +1,170 @@
+"""
+sentry.db.encoding
+~~~~~~~~~~~~~~~~~~
+
+Serialization of metadata (e.g. the interfaces of an event) and ``List``
+fields.
+
+Values are marshalled, and compressed with zlib once they are large enough
+for it to pay off. The first byte of an encoded value identifies its format,
+so values stored in earlier formats (JSON for metadata, pickle for lists)
+remain readable.
+
+:copyright: (c) 2010 by the Sentry Team, see AUTHORS for more details.
+:license: BSD, see LICENSE for more details.
+"""
+
+import collections
+import marshal
+import zlib
+
+import simplejson
+
+# formats, stored as the first byte of an encoded value
+MARSHAL = '\x01'
+MARSHAL_ZLIB = '\x02'
+MARSHAL_ZLIB_DICT = '\x03'
+
+MARSHAL_VERSION = 2
+
+COMPRESSION_LEVEL = 6
+
+# values shorter than this are stored uncompressed, depending on whether
+# the dictionary is used
+COMPRESS_MIN_LENGTH = 128
+COMPRESS_DICT_MIN_LENGTH = 32
+
+# Strings which are common in the interfaces of events, against which values
+# are compressed with ``compression='dictionary'``. Compressed values can
+# only be read with the exact dictionary they were written with, so changing
+# this requires a new format.
+DICTIONARY = [
+    'sentry.interfaces.Stacktrace', 'sentry.interfaces.Exception',
+    'sentry.interfaces.Message', 'sentry.interfaces.Http',
+    'sentry.interfaces.Template', 'sentry.interfaces.Query',
+    'frames', 'filename', 'abs_path', 'module', 'function', 'lineno',
+    'context_line', 'pre_context', 'post_context', 'vars', 'id', 'in_app',
+    'type', 'value', 'message', 'params', 'url', 'method', 'data',
+    'query_string', 'cookies', 'headers', 'env', 'REMOTE_ADDR',
+    'SERVER_NAME', 'SERVER_PORT', 'extra', 'modules', 'version',
+    '/site-packages/', '/usr/lib/python2.', 'self', 'request', 'return ',
+    'raise ', '    ',
+]
+
+class Dictionary(object):
+    """
+    Compresses values against a preset dictionary.
+
+    zlib only accepts a preset dictionary as of Python 3.3, so the stream is
+    primed with the dictionary instead, and each value is compressed by a
+    copy of the primed compressor. The stored value is what follows the
+    primer in the stream.
+    """
+    def __init__(self, words):
+        # both the str and unicode forms of each word, as they are marshalled
+        primer = marshal.dumps([(w, unicode(w)) for w in words], MARSHAL_VERSION)
+        self._compressor = zlib.compressobj(COMPRESSION_LEVEL)
+        prefix = self._compressor.compress(primer) + self._compressor.flush(zlib.Z_SYNC_FLUSH)
+        self._decompressor = zlib.decompressobj()
+        self._decompressor.decompress(prefix)
+
+    def compress(self, data):
+        compressor = self._compressor.copy()
+        return compressor.compress(data) + compressor.flush()
+
+    def decompress(self, data):
+        decompressor = self._decompressor.copy()
+        return decompressor.decompress(data) + decompressor.flush()
+
+dictionary = Dictionary(DICTIONARY)
+
+def to_json_types(value):
+    """
+    Returns ``value`` with the types it would have after a round trip
+    through JSON (tuples become lists, and keys become strings), so that
+    data reads back the same whether it was sent from this process or over
+    HTTP.
+    """
+    if isinstance(value, dict):
+        return dict((k if isinstance(k, basestring) else simplejson.dumps(k), to_json_types(v))
+                    for k, v in value.iteritems())
+    elif isinstance(value, (list, tuple)):
+        return [to_json_types(v) for v in value]
+    return value
+
+def encode(value, compression='dictionary', fallback=simplejson.dumps):
+    """
+    Returns ``value`` as a string, compressed with ``compression`` (one of
+    ``None``, ``'zlib'`` or ``'dictionary'``) if that makes it smaller.
+
+    Values which cannot be marshalled are passed to ``fallback``.
+    """
+    try:
+        data = marshal.dumps(value, MARSHAL_VERSION)
+    except ValueError:
+        return fallback(value)
+
+    if compression == 'dictionary' and len(data) >= COMPRESS_DICT_MIN_LENGTH:
+        compressed = MARSHAL_ZLIB_DICT + dictionary.compress(data)
+    elif compression and len(data) >= COMPRESS_MIN_LENGTH:
+        compressed = MARSHAL_ZLIB + zlib.compress(data, COMPRESSION_LEVEL)
+    else:
+        compressed = None
+
+    if compressed and len(compressed) <= len(data):
+        return compressed
+    return MARSHAL + data
+
+def decode(value, fallback=simplejson.loads):
+    """
+    Returns the value encoded by ``encode``. Values in any other format are
+    passed to ``fallback``.
+    """
+    # legacy values may be unicode, e.g. from text columns
+    if isinstance(value, str):
+        format = value[:1]
+        if format == MARSHAL:
+            return marshal.loads(value[1:])
+        elif format == MARSHAL_ZLIB:
+            return marshal.loads(zlib.decompress(value[1:]))
+        elif format == MARSHAL_ZLIB_DICT:
+            return marshal.loads(dictionary.decompress(value[1:]))
+    return fallback(value)
+
+class LazyData(collections.MutableMapping):
+    """
+    A mapping of encoded values, each of which is decoded when it is first
+    accessed, e.g. so that listing the interfaces of an event does not decode
+    its modules.
+    """
+    def __init__(self, values, decode=decode):
+        self._values = dict(values)
+        self._encoded = set(self._values)
+        self._decode = decode
+
+    def __getitem__(self, key):
+        value = self._values[key]
+        if key in self._encoded:
+            value = self._values[key] = self._decode(value)
+            self._encoded.discard(key)
+        return value
+
+    def __setitem__(self, key, value):
+        self._values[key] = value
+        self._encoded.discard(key)
+
+    def __delitem__(self, key):
+        del self._values[key]
+        self._encoded.discard(key)
+
+    def __contains__(self, key):
+        return key in self._values
+
+    def __iter__(self):
+        return iter(self._values)
+
+    def __len__(self):
+        return len(self._values)
+
+    def __repr__(self):
+        return repr(dict(self))
@@ -9,7 +9,6 @@ sentry.db.models
 # Inspired by Django's models
 
 import datetime
-import simplejson
 
 try:
     import cPickle as pickle
@@ -17,6 +16,11 @@ except ImportError:
     import pickle
 
 from sentry import app
+from sentry.db.encoding import encode, decode, to_json_types, LazyData
+from sentry.utils.cache import LRUCache
+
+# counts by (model, index, filter, tags), see QuerySet.count
+count_cache = LRUCache()
 
 def to_db(model, values):
     result = {}
@@ -27,7 +31,7 @@ def to_db(model, values):
             if v is None:
                 v = ''
         else:
-            v = simplejson.dumps(v)
+            v = encode(to_json_types(v), app.config['DATA_COMPRESSION'])
         result[k] = v
     return result
 
@@ -52,6 +56,8 @@ class QuerySet(object):
         self.model = model
         self.index = order_by or self.model._meta.ordering
         self.filter = filter_by
+        self.tags = []
+        self._count = None
     
     def __repr__(self):
         return u'<%s: %s>' % (self.__class__.__name__, list(self))
@@ -85,12 +91,7 @@ class QuerySet(object):
         return results[0]
 
     def __len__(self):
-        if self.index.startswith('-'):
-            index = self.index[1:]
-        else:
-            index = self.index
-        
-        return app.db.count(self.model, index)
+        return self.count()
 
     def __iter__(self):
         for r in self[0:-1]:
@@ -98,7 +99,12 @@ class QuerySet(object):
 
     def _get_results(self, start, num, index, desc=False):
         if self.filter:
-            data = [(pk, app.db.get_data(self.model, pk)) for pk in app.db.list_by_cindex(self.model, **to_db(self.model, self.filter))]
+            pk_set = app.db.list_by_cindex(self.model, **to_db(self.model, self.filter))
+            if num > 0:
+                pk_set = pk_set[start:start + num]
+            data = app.db.get_many(self.model, pk_set)
+        elif self.tags:
+            data = app.db.list(self.model, index, start, num, desc, tags=self.tags)
         else:
             data = app.db.list(self.model, index, start, num, desc)
 
@@ -107,14 +113,53 @@ class QuerySet(object):
     def order_by(self, index):
         assert not self.filter
         self.index = index
+        self._count = None
         return self
+
+    def filter_tags(self, **tags):
+        # limits results to instances which have been seen with all of the
+        # given tag values (see SentryBackend.add_tags)
+        assert not self.filter
+        self.tags.extend(tags.iteritems())
+        self._count = None
+        return self
+
+    def count(self):
+        """
+        Returns the number of matching instances.
+
+        Counts are kept for the lifetime of the QuerySet, and shared for up
+        to ``COUNT_CACHE_TIMEOUT`` seconds, or until this process writes.
+        """
+        if self._count is not None:
+            return self._count
+
+        index = self.index.lstrip('-')
+        if self.filter:
+            cache_key = (self.model, None, frozenset(self.filter.iteritems()))
+        else:
+            cache_key = (self.model, index, frozenset(self.tags))
+
+        count = count_cache.get(cache_key)
+        if count is None:
+            if self.filter:
+                count = len(app.db.list_by_cindex(self.model, **to_db(self.model, self.filter)))
+            elif self.tags:
+                count = app.db.count(self.model, index, tags=self.tags)
+            else:
+                count = app.db.count(self.model, index)
+            if app.config['COUNT_CACHE_TIMEOUT']:
+                count_cache.set(cache_key, count, app.config['COUNT_CACHE_TIMEOUT'])
+
+        self._count = count
+        return count
     
 class Manager(object):
     def __init__(self, model):
         self.model = model
 
     def count(self):
-        return app.db.count(self.model, self.model._meta.ordering)
+        return self.get_query_set().count()
 
     def get_query_set(self):
         return QuerySet(self.model)
@@ -129,6 +174,9 @@ class Manager(object):
     def order_by(self, index):
         return self.get_query_set().order_by(index)
 
+    def filter_tags(self, **tags):
+        return self.get_query_set().filter_tags(**tags)
+
     def get(self, pk):
         data = app.db.get(self.model, pk)
         if data == {}:
@@ -147,7 +195,20 @@ class Manager(object):
         app.db.set_meta(self.model, pk, **to_db(self.model, values))
 
     def get_meta(self, pk):
-        return dict((k, simplejson.loads(v)) for k, v in app.db.get_meta(self.model, pk).iteritems())
+        # values are decoded as they are accessed
+        return LazyData(app.db.get_meta(self.model, pk))
+
+    def prefetch_meta(self, instances):
+        """
+        Fetches the metadata of each of ``instances`` at once, so that reading
+        their ``data`` does not hit the datastore.
+        """
+        instances = [i for i in instances if 'data' not in i._cache]
+        if not instances:
+            return
+        result = app.db.get_many_meta(self.model, [i.pk for i in instances])
+        for instance, (pk, values) in zip(instances, result):
+            instance._cache['data'] = LazyData(values)
 
     def remove_from_index(self, pk, index):
         return app.db.remove_from_index(self.model, pk, index)
@@ -170,7 +231,14 @@ class Manager(object):
             defaults = defaults.copy()
         defaults.update(index)
 
-        inst = self.create(**defaults)
+        try:
+            inst = self.create(**defaults)
+        except self.model.DuplicateKeyError:
+            # created by another process since the lookup
+            pk_set = app.db.list_by_cindex(self.model, **to_db(self.model, index))
+            if not pk_set:
+                raise
+            return self.get(pk_set[0]), False
 
         return inst, True
 
@@ -196,6 +264,9 @@ class Options(object):
 
         self.indexes = list(meta.__dict__.get('indexes', []))
 
+        # the composite indexes which no two instances may share
+        self.unique = list(meta.__dict__.get('unique', []))
+
         if self.ordering != 'default':
             self.sortables.append(self.ordering)
 
@@ -238,6 +309,8 @@ class Model(object):
 
     def __init__(self, pk=None, **kwargs):
         self.pk = pk
+        # metadata, and anything derived from it, as of the last read
+        self._cache = {}
         for attname, field in self._meta.fields.iteritems():
             try:
                 val = field.to_python(kwargs.pop(attname))
@@ -288,7 +361,13 @@ class Model(object):
         if created:
             self.pk = app.db.add(model)
 
-        self.update(**values)
+        try:
+            self.update(**values)
+        except DuplicateKeyError:
+            if created:
+                app.db.delete(model, self.pk)
+                self.pk = None
+            raise
         
         if created:
             # Ensure we save our default index (this only happens
@@ -298,6 +377,8 @@ class Model(object):
                 value = datetime.datetime.now()
                 self.objects.add_to_index(self.pk, 'default', value)
 
+            count_cache.clear()
+
     def update(self, **values):
         assert self.pk
         
@@ -344,8 +425,11 @@ class Model(object):
         # remove instance
         app.db.delete(model, self.pk)
 
+        count_cache.clear()
+
     def set_meta(self, **values):
         self.objects.set_meta(self.pk, **values)
+        self._cache.clear()
 
     def get_meta(self):
         return self.objects.get_meta(self.pk)
@@ -360,7 +444,12 @@ class Model(object):
         return [model(pk, **data) for pk, data in app.db.list_relations(self.__class__, self.pk, model, offset, limit, desc)]
 
     def _get_data(self):
-        return self.get_meta() or {}
+        # read once per instance, until set_meta is called
+        try:
+            return self._cache['data']
+        except KeyError:
+            data = self._cache['data'] = self.get_meta()
+            return data
     data = property(_get_data)
 
 class Field(object):
@@ -434,12 +523,13 @@ class DateTime(Field):
 class List(Field):
     def to_db(self, value=None):
         if isinstance(value, (tuple, list)):
-            value = pickle.dumps(value)
+            value = encode(value, app.config['DATA_COMPRESSION'], fallback=pickle.dumps)
         return value
 
     def to_python(self, value=None):
         if not value:
             value = []
         elif isinstance(value, basestring):
-            value = pickle.loads(value)
+            # lists were previously pickled
+            value = decode(value, fallback=pickle.loads)
         return value
\ No newline at end of file
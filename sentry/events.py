@@ -6,14 +6,55 @@ sentry.events
 :license: BSD, see LICENSE for more details.
 """
 
+import hashlib
+import linecache
+import os
 import re
 import sys
 
 from sentry import app
-from sentry.utils import transform
+from sentry.utils import serialize_vars, transform
+from sentry.utils.cache import LRUCache
 
 __all__ = ('BaseEvent', 'Exception', 'Message', 'Query')
 
+def get_source_encoding(source):
+    for line in source[:2]:
+        # File coding may be specified. Match pattern from PEP-263
+        # (http://www.python.org/dev/peps/pep-0263/)
+        match = re.search(r'coding[:=]\s*([-\w.]+)', line)
+        if match:
+            return match.group(1)
+    return 'ascii'
+
+def read_source(filename, loader=None, module_name=None):
+    """
+    Returns the decoded lines of a source file, or None if it can't be read.
+    """
+    source = None
+    if loader is not None and hasattr(loader, "get_source"):
+        source = loader.get_source(module_name)
+        if source is not None:
+            source = source.splitlines()
+    if source is None:
+        try:
+            f = open(filename)
+            try:
+                source = f.readlines()
+            finally:
+                f.close()
+        except (OSError, IOError):
+            pass
+    if source is None:
+        return None
+
+    encoding = get_source_encoding(source)
+    return [unicode(sline, encoding, 'replace') for sline in source]
+
+# decoded source lines, measured by their length, and sized on use by
+# SOURCE_CACHE_SIZE (see BaseEvent._get_source)
+source_cache = LRUCache(get_size=lambda source: sum(len(line) for line in source))
+
 class BaseEvent(object):
     def to_string(self, data):
         raise NotImplementedError
@@ -23,6 +64,16 @@ class BaseEvent(object):
     
     def get_tags(self, **kwargs):
         return []
+
+    def get_checksum(self, **kwargs):
+        """
+        Returns a checksum identifying repeats of an event, computed from the
+        arguments to ``capture`` before any data is collected or serialized.
+        """
+        checksum = hashlib.md5()
+        for value in self.get_event_hash(**kwargs):
+            checksum.update(repr(value))
+        return checksum.hexdigest()
     
     def capture(self, **kwargs):
         # tags and culprit are special cased and not stored with the
@@ -53,6 +104,31 @@ class Exception(BaseEvent):
         # TODO: Need to add in the frames without line numbers
         return [type, value]
 
+    def get_checksum(self, exc_info=None, **kwargs):
+        # Made of the type and value which the server groups events by (see
+        # get_event_hash), so that only events of the same group are taken
+        # as repeats, along with the raising code path.
+        if exc_info is None:
+            exc_info = sys.exc_info()
+
+        exc_type, exc_value, exc_traceback = exc_info
+
+        checksum = hashlib.md5()
+        for value in self.get_event_hash(type=self._get_type_name(exc_type), value=transform(exc_value)):
+            checksum.update(repr(value))
+        for tb in self._iter_tb(exc_traceback):
+            code = tb.tb_frame.f_code
+            checksum.update('%s:%s:%s' % (code.co_filename, code.co_name, tb.tb_lineno))
+        return checksum.hexdigest()
+
+    def _get_type_name(self, exc_type):
+        if hasattr(exc_type, '__class__'):
+            exc_module = exc_type.__class__.__module__
+            if exc_module == '__builtin__':
+                return exc_type.__name__
+            return '%s.%s' % (exc_module, exc_type.__name__)
+        return exc_type.__name__
+
     def capture(self, exc_info=None, **kwargs):
         if exc_info is None:
             exc_info = sys.exc_info()
@@ -63,15 +139,7 @@ class Exception(BaseEvent):
         
         culprit = self._get_culprit(exc_info[2])
 
-        if hasattr(exc_type, '__class__'):
-            exc_module = exc_type.__class__.__module__
-            if exc_module == '__builtin__':
-                exc_type = exc_type.__name__
-            else:
-                exc_type = '%s.%s' % (exc_module, exc_type.__name__)
-        else:
-            exc_module = None
-            exc_type = exc_type.__name__
+        exc_type = self._get_type_name(exc_type)
 
         # if isinstance(exc_value, TemplateSyntaxError) and hasattr(exc_value, 'source'):
         #     origin, (start, end) = exc_value.source
@@ -94,9 +162,8 @@ class Exception(BaseEvent):
         while tb:
             # support for __traceback_hide__ which is used by a few libraries
             # to hide internal frames.
-            if tb.tb_frame.f_locals.get('__traceback_hide__'):
-                continue
-            yield tb
+            if not tb.tb_frame.f_locals.get('__traceback_hide__'):
+                yield tb
             tb = tb.tb_next
 
     def _get_lines_from_file(self, filename, lineno, context_lines, loader=None, module_name=None):
@@ -104,42 +171,56 @@ class Exception(BaseEvent):
         Returns context_lines before and after lineno from file.
         Returns (pre_context_lineno, pre_context, context_line, post_context).
         """
-        source = None
-        if loader is not None and hasattr(loader, "get_source"):
-            source = loader.get_source(module_name)
-            if source is not None:
-                source = source.splitlines()
-        if source is None:
-            try:
-                f = open(filename)
-                try:
-                    source = f.readlines()
-                finally:
-                    f.close()
-            except (OSError, IOError):
-                pass
-        if source is None:
+        source, encoding = self._get_source(filename, loader, module_name)
+        if not source:
             return None, [], None, []
 
-        encoding = 'ascii'
-        for line in source[:2]:
-            # File coding may be specified. Match pattern from PEP-263
-            # (http://www.python.org/dev/peps/pep-0263/)
-            match = re.search(r'coding[:=]\s*([-\w.]+)', line)
-            if match:
-                encoding = match.group(1)
-                break
-        source = [unicode(sline, encoding, 'replace') for sline in source]
+        def decode(lines):
+            if encoding is None:
+                return [line.strip('\n') for line in lines]
+            return [unicode(line, encoding, 'replace').strip('\n') for line in lines]
 
         lower_bound = max(0, lineno - context_lines)
         upper_bound = lineno + context_lines
 
-        pre_context = [line.strip('\n') for line in source[lower_bound:lineno]]
-        context_line = source[lineno].strip('\n')
-        post_context = [line.strip('\n') for line in source[lineno+1:upper_bound]]
+        pre_context = decode(source[lower_bound:lineno])
+        context_line = decode(source[lineno:lineno+1])[0]
+        post_context = decode(source[lineno+1:upper_bound])
 
         return lower_bound, pre_context, context_line, post_context
 
+    def _get_source(self, filename, loader=None, module_name=None):
+        """
+        Returns (lines, encoding) for a source file, where lines still need
+        decoding from encoding, unless it is None.
+
+        Decoded lines are kept in ``source_cache``, keyed by the file's mtime
+        or, for sources provided by a loader, by the loader. With
+        ``SOURCE_CACHE_LINECACHE`` the raw lines kept by ``linecache`` are
+        used instead.
+        """
+        if app.config['SOURCE_CACHE_LINECACHE']:
+            linecache.checkcache(filename)
+            source = linecache.getlines(filename, {'__name__': module_name, '__loader__': loader})
+            return source, get_source_encoding(source)
+
+        if loader is not None and hasattr(loader, "get_source"):
+            cache_key = (filename, loader, module_name)
+        else:
+            try:
+                cache_key = (filename, os.stat(filename).st_mtime)
+            except (OSError, IOError):
+                return None, None
+
+        # the configuration may be loaded after this module is imported
+        source_cache.max_size = app.config['SOURCE_CACHE_SIZE']
+        source = source_cache.get(cache_key)
+        if source is None:
+            source = read_source(filename, loader, module_name)
+            if source is not None:
+                source_cache.set(cache_key, source)
+        return source, None
+
     def _get_culprit(self, traceback):
         # We iterate through each frame looking for a deterministic culprit
         # When one is found, we mark it as last "best guess" (best_guess) and then
@@ -188,7 +269,7 @@ class Exception(BaseEvent):
                     'function': function,
                     'lineno': lineno + 1,
                     # TODO: vars need to be references
-                    'vars': tb.tb_frame.f_locals,
+                    'vars': serialize_vars(tb.tb_frame.f_locals),
                     'pre_context': pre_context,
                     'context_line': context_line,
                     'post_context': post_context,
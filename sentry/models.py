@@ -10,10 +10,17 @@ from __future__ import absolute_import
 
 import datetime
 import hashlib
+import time
 
 from sentry.interfaces import unserialize
 from sentry.db import models
+from sentry.utils.cache import LRUCache
 from sentry.utils.compat import math
+from sentry.utils.imports import class_cache
+from sentry.utils.versions import get_manifest_hash
+
+# the modules of each ModuleManifest read or stored, by hash
+manifest_cache = LRUCache(100)
 
 class Group(models.Model):
     """
@@ -40,8 +47,9 @@ class Group(models.Model):
 
     class Meta:
         ordering = 'last_seen'
-        sortables = ('time_spent', 'first_seen', 'last_seen', 'score')
+        sortables = ('count', 'time_spent', 'first_seen', 'last_seen', 'score')
         indexes = (('type', 'hash'),)
+        unique = (('type', 'hash'),)
 
     def save(self, *args, **kwargs):
         created = not self.pk
@@ -82,22 +90,36 @@ class Event(models.Model):
             return
         return self.data['version']
 
+    def get_modules(self):
+        """
+        Returns the modules, and their versions, installed where the event
+        was captured.
+        """
+        data = self.data
+        if 'modules' in data:
+            # stored before the list was kept as a ModuleManifest
+            return data['modules']
+        if 'modules_hash' in data:
+            return ModuleManifest.get_modules(data['modules_hash']) or {}
+        return {}
+
     def get_processor(self):
-        # TODO: should use general import cache
-        mod_name, class_name = self.type.rsplit('.', 1)
-        processor = getattr(__import__(mod_name, {}, {}, [class_name]), class_name)()
-        return processor
+        return class_cache.get_instance(self.type)
     
     def get_interfaces(self):
-        # TODO: should use general import cache
+        try:
+            return self._cache['interfaces']
+        except KeyError:
+            pass
+
         interfaces = []
-        for k, v in self.data.iteritems():
+        data = self.data
+        # only interfaces are decoded, rather than e.g. the list of modules
+        for k in data:
             if '.' not in k:
                 continue
-            
-            mod_name, class_name = k.rsplit('.', 1)
-            interface = getattr(__import__(mod_name, {}, {}, [class_name]), class_name)
-            interfaces.append(unserialize(interface, v))
+            interfaces.append(unserialize(class_cache[k], data[k]))
+        self._cache['interfaces'] = interfaces
         return interfaces
 
 class EventType(models.Model):
@@ -113,6 +135,7 @@ class EventType(models.Model):
     class Meta:
         ordering = 'count'
         indexes = (('path',),)
+        unique = (('path',),)
 
     def __unicode__(self):
         return self.path
@@ -130,14 +153,19 @@ class EventType(models.Model):
     
     @classmethod
     def remove_group(cls, group):
-        try:
-            et = cls.objects.get(path=group.type)
-        except EventType.DoesNotExist:
-            return
+        cls.remove_groups([group])
+
+    @classmethod
+    def remove_groups(cls, groups):
+        # each type is decremented once, by its number of groups
+        counts = {}
+        for group in groups:
+            counts[group.type] = counts.get(group.type, 0) + 1
 
-        et.decr('count', 1)
-        if et.count <= 0:
-            et.delete()
+        for path, count in counts.iteritems():
+            for et in cls.objects.filter(path=path):
+                if et.decr('count', count) <= 0:
+                    et.delete()
 
 class Tag(models.Model):
     """
@@ -153,16 +181,20 @@ class Tag(models.Model):
     class Meta:
         ordering = 'count'
         indexes = (('hash',), ('key',))
+        unique = (('hash',),)
 
     def __unicode__(self):
         return u"%s=%s; count=%s" % (self.key, self.value, self.count)
 
+    @classmethod
+    def get_hash(cls, key, value):
+        return hashlib.md5((u'%s=%s' % (key, value)).encode('utf-8')).hexdigest()
+
     @classmethod
     def add_group(cls, group):
         for key, value in group.tags:
-            hash = hashlib.md5(u'%s=%s' % (key, value)).hexdigest()
             tag, created = cls.objects.get_or_create(
-                hash=hash,
+                hash=cls.get_hash(key, value),
                 defaults={
                     'key': key,
                     'value': value,
@@ -174,12 +206,71 @@ class Tag(models.Model):
     
     @classmethod
     def remove_group(cls, group):
-        for key, value in group.tags:
-            try:
-                tag = cls.objects.get(hash=hash)
-            except cls.DoesNotExist:
-                continue
+        cls.remove_groups([group])
+
+    @classmethod
+    def remove_groups(cls, groups):
+        # each tag is decremented once, by its number of groups
+        counts = {}
+        for group in groups:
+            for key, value in group.tags:
+                tag_hash = cls.get_hash(key, value)
+                counts[tag_hash] = counts.get(tag_hash, 0) + 1
+
+        for tag_hash, count in counts.iteritems():
+            for tag in cls.objects.filter(hash=tag_hash):
+                if tag.decr('count', count) <= 0:
+                    tag.delete()
+
+class ModuleManifest(models.Model):
+    """
+    Stores a list of modules and their versions once, keyed by a hash of its
+    contents, which events refer to as ``modules_hash`` rather than each
+    keeping a copy of the list.
+    """
+
+    # the list is kept in the manifest's metadata, and manifests are never
+    # listed
+    class Meta:
+        pass
+
+    @classmethod
+    def store(cls, modules):
+        """
+        Stores ``modules`` unless it is already, and returns its hash.
+        """
+        modules_hash = get_manifest_hash(modules)
+        if manifest_cache.get(modules_hash) is None:
+            cls.objects.set_meta(modules_hash, modules=modules)
+            manifest_cache.set(modules_hash, modules)
+        return modules_hash
+
+    @classmethod
+    def get_modules(cls, modules_hash):
+        """
+        Returns the modules stored under ``modules_hash``, or ``None``.
+        """
+        modules = manifest_cache.get(modules_hash)
+        if modules is None:
+            modules = cls.objects.get_meta(modules_hash).get('modules')
+            if modules is not None:
+                manifest_cache.set(modules_hash, modules)
+        return modules
 
-            tag.decr('count', 1)
-            if tag.count <= 0:
-                tag.delete()
+class Migration(models.Model):
+    """
+    Records each data migration of ``sentry.core.upgrade`` which has been
+    run, by name.
+    """
+
+    # kept in the migration's metadata, as for ModuleManifest
+    class Meta:
+        pass
+
+    @classmethod
+    def is_applied(cls, name):
+        return cls.objects.get_meta(name).get('applied') is not None
+
+    @classmethod
+    def set_applied(cls, name):
+        cls.objects.set_meta(name, applied=time.time())
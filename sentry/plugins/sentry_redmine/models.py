@@ -73,8 +73,7 @@ class CreateRedmineIssue(GroupActionProvider):
                 else:
                     data = simplejson.loads(response)
                     RedmineIssue.objects.create(group=group, issue_id=data['id'])
-                    group.data['redmine'] = {'issue_id': data['id']}
-                    group.save()
+                    group.set_meta(redmine={'issue_id': data['id']})
                     return HttpResponseRedirect(reverse('sentry:group', args=[group.pk]))
         else:
             description = 'Sentry Message: %s' % request.build_absolute_uri(group.get_absolute_url())
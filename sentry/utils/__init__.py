@@ -12,6 +12,7 @@ import logging
 import sys
 import uuid
 import warnings
+from itertools import islice
 from pprint import pformat
 from types import ClassType, TypeType
 
@@ -51,61 +52,156 @@ def has_sentry_metadata(value):
     except:
         return False
 
-def transform(value, stack=[], context=None):
+def to_unicode(value):
+    try:
+        value = unicode(force_unicode(value))
+    except (UnicodeEncodeError, UnicodeDecodeError):
+        value = '(Error decoding value)'
+    except Exception: # in some cases we get a different exception
+        try:
+            value = str(repr(type(value)))
+        except Exception:
+            value = '(Error decoding value)'
+    return value
+
+def _identity(value):
+    return value
+
+def _transform_str(value):
+    try:
+        return str(value)
+    except:
+        return to_unicode(value)
+
+def _transform_datetime(value):
+    return value.strftime('%Y-%m-%dT%H:%M:%S.%f')
+
+def _transform_date(value):
+    return value.strftime('%Y-%m-%d')
+
+def _expand_sequence(value):
+    try:
+        return value[:], True
+    except:
+        return value, False
+
+def _finish_sequence(value, results, sliced):
+    if type(value) is list:
+        return results
+    if sliced:
+        try:
+            return type(value)(results)
+        except:
+            pass
+    return tuple(results)
+
+def _expand_dict(value):
+    keys = value.keys()
+    return [value[k] for k in keys], keys
+
+def _finish_dict(value, results, keys):
+    return dict(zip(keys, results))
+
+def _expand_sentry(value):
+    return [value.__sentry__()], None
+
+def _finish_sentry(value, results, extra):
+    return results[0]
+
+# Containers are (expand, finish) pairs: expand returns the children to
+# transform, along with extra state, and finish builds the result from
+# their transformed values.
+_SEQUENCE = (_expand_sequence, _finish_sequence)
+_DICT = (_expand_dict, _finish_dict)
+_SENTRY = (_expand_sentry, _finish_sentry)
+
+# transforms by exact type, which covers nearly every value
+_TRANSFORMS = {
+    str: _identity,
+    unicode: _identity,
+    int: _identity,
+    bool: _identity,
+    type(None): _identity,
+    float: to_unicode,
+    long: to_unicode,
+    uuid.UUID: repr,
+    datetime.datetime: _transform_datetime,
+    datetime.date: _transform_date,
+    list: _SEQUENCE,
+    tuple: _SEQUENCE,
+    set: _SEQUENCE,
+    frozenset: _SEQUENCE,
+    dict: _DICT,
+}
+
+def _get_transform(value):
     # TODO: make this extendable
     # TODO: include some sane defaults, like UUID
     # TODO: dont coerce strings to unicode, leave them as strings
-    if context is None:
-        context = {}
-    objid = id(value)
-    if objid in context:
-        return '<...>'
-    context[objid] = 1
-    if any(value is s for s in stack):
-        ret = 'cycle'
-    transform_rec = lambda o: transform(o, stack + [value], context)
     if isinstance(value, (tuple, list, set, frozenset)):
-        try:
-            ret = type(value)(transform_rec(o) for o in value[:])
-        except:
-            ret = tuple(transform_rec(o) for o in value)
+        return _SEQUENCE
     elif isinstance(value, uuid.UUID):
-        ret = repr(value)
+        return repr
     elif isinstance(value, datetime.datetime):
-        ret = value.strftime('%Y-%m-%dT%H:%M:%S.%f')
+        return _transform_datetime
     elif isinstance(value, datetime.date):
-        ret = value.strftime('%Y-%m-%d')
+        return _transform_date
     elif isinstance(value, dict):
-        ret = dict((k, transform_rec(v)) for k, v in value.iteritems())
+        return _DICT
     elif isinstance(value, unicode):
-        ret = to_unicode(value)
+        return to_unicode
     elif isinstance(value, str):
-        try:
-            ret = str(value)
-        except:
-            ret = to_unicode(value)
+        return _transform_str
     elif not isinstance(value, (ClassType, TypeType)) and \
             has_sentry_metadata(value):
-        ret = transform_rec(value.__sentry__())
+        return _SENTRY
     elif not isinstance(value, (int, bool)) and value is not None:
         # XXX: we could do transform(repr(value)) here
-        ret = to_unicode(value)
-    else:
-        ret = value
-    del context[objid]
-    return ret
+        return to_unicode
+    return _identity
 
-def to_unicode(value):
-    try:
-        value = unicode(force_unicode(value))
-    except (UnicodeEncodeError, UnicodeDecodeError):
-        value = '(Error decoding value)'
-    except Exception: # in some cases we get a different exception
-        try:
-            value = str(repr(type(value)))
-        except Exception:
-            value = '(Error decoding value)'
-    return value
+def transform(value):
+    """
+    Coerces ``value`` into builtin types which can be serialized. Values
+    which refer back to one of their parents are replaced with ``'<...>'``.
+
+    Containers are walked with an explicit stack rather than by recursion,
+    so the depth of ``value`` isn't limited by the recursion limit.
+    """
+    root = []
+    results = root
+    # the ids of the containers currently being walked
+    context = set()
+    # frames of (container, finish, remaining children, results, parent's
+    # results, extra state)
+    stack = []
+    while 1:
+        func = _TRANSFORMS.get(type(value)) or _get_transform(value)
+        if type(func) is tuple:
+            objid = id(value)
+            if objid in context:
+                results.append('<...>')
+            else:
+                context.add(objid)
+                children, extra = func[0](value)
+                stack.append((value, func[1], iter(children), [], results, extra))
+        else:
+            results.append(func(value))
+
+        # move on to the next child of the innermost unfinished container
+        while stack:
+            frame = stack[-1]
+            for value in frame[2]:
+                results = frame[3]
+                break
+            else:
+                stack.pop()
+                context.discard(id(frame[0]))
+                frame[4].append(frame[1](frame[0], frame[3], frame[5]))
+                continue
+            break
+        else:
+            return root[0]
 
 class _Missing(object):
 
@@ -170,33 +266,16 @@ class cached_property(object):
             obj.__dict__[self.__name__] = value
         return value
 
-def get_versions(module_list=[]):
-    # TODO:
-    ext_module_list = set()
-    for m in module_list:
-        parts = m.split('.')
-        ext_module_list.update('.'.join(parts[:idx]) for idx in xrange(1, len(parts)+1))
+def get_versions(module_list=()):
+    """
+    Returns the version of every installed distribution and imported module,
+    after importing those in ``module_list``.
+    """
+    from sentry.utils.versions import registry
 
-    versions = {}
-    for module_name in ext_module_list:
+    for module_name in module_list:
         __import__(module_name)
-        app = sys.modules[module_name]
-        if hasattr(app, 'get_version'):
-            get_version = app.get_version
-            if callable(get_version):
-                version = get_version()
-            else:
-                version = get_version
-        elif hasattr(app, 'VERSION'):
-            version = app.VERSION
-        elif hasattr(app, '__version__'):
-            version = app.__version__
-        else:
-            continue
-        if isinstance(version, (list, tuple)):
-            version = '.'.join(str(o) for o in version)
-        versions[module_name] = version
-    return versions
+    return registry.get_versions()
 
 def shorten(var):
     var = transform(var)
@@ -209,6 +288,81 @@ def shorten(var):
         var = list(var)[:sentry.app.config['MAX_LENGTH_LIST']] + ['...', '(%d more elements)' % (len(var) - sentry.app.config['MAX_LENGTH_LIST'],)]
     return var
 
+def serialize_vars(value):
+    """
+    Serializes the variables of a frame, like ``transform``, within a fixed
+    budget.
+
+    Containers are walked at most ``MAX_VARS_DEPTH`` levels deep, and only
+    their first ``MAX_LENGTH_LIST`` items are visited. Strings are cut to
+    ``MAX_LENGTH_STRING`` characters before they are decoded. Walking stops
+    altogether once roughly ``MAX_VARS_SIZE`` bytes have been produced.
+    """
+    config = sentry.app.config
+    state = {
+        'size': config['MAX_VARS_SIZE'],
+        'max_length_list': config['MAX_LENGTH_LIST'],
+        'max_length_string': config['MAX_LENGTH_STRING'],
+    }
+    return _serialize_var(value, config['MAX_VARS_DEPTH'], state, {})
+
+def _serialize_string(value, state):
+    max_length = state['max_length_string']
+    if isinstance(value, str):
+        ret = value[:max_length].decode('utf-8', 'replace')
+    else:
+        ret = value[:max_length]
+    if len(value) > max_length:
+        ret += '...'
+    state['size'] -= len(ret)
+    return ret
+
+def _serialize_var(value, depth, state, context):
+    if isinstance(value, (list, tuple, set, frozenset, dict)):
+        objid = id(value)
+        if objid in context:
+            return '<...>'
+        if depth <= 0:
+            ret = '<%s of %d items>' % (type(value).__name__, len(value))
+            state['size'] -= len(ret)
+            return ret
+
+        context[objid] = 1
+        state['size'] -= 2
+        if isinstance(value, dict):
+            ret = {}
+            for k, v in islice(value.iteritems(), state['max_length_list']):
+                if state['size'] <= 0:
+                    break
+                if isinstance(k, basestring):
+                    state['size'] -= len(k)
+                ret[k] = _serialize_var(v, depth - 1, state, context)
+            if len(ret) < len(value):
+                ret['...'] = '(%d more items)' % (len(value) - len(ret),)
+        else:
+            ret = []
+            for o in islice(value, state['max_length_list']):
+                if state['size'] <= 0:
+                    break
+                ret.append(_serialize_var(o, depth - 1, state, context))
+            if len(ret) < len(value):
+                ret.extend(['...', '(%d more elements)' % (len(value) - len(ret),)])
+            if not isinstance(value, list):
+                ret = tuple(ret)
+        del context[objid]
+        return ret
+    elif isinstance(value, basestring):
+        return _serialize_string(value, state)
+    elif not isinstance(value, (ClassType, TypeType)) and \
+            has_sentry_metadata(value):
+        return _serialize_var(value.__sentry__(), depth - 1, state, context)
+
+    ret = transform(value)
+    if isinstance(ret, basestring):
+        return _serialize_string(ret, state)
+    state['size'] -= 1
+    return ret
+
 def is_float(var):
     try:
         float(var)
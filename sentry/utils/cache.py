@@ -0,0 +1,144 @@
+"""
+sentry.utils.cache
+~~~~~~~~~~~~~~~~~~
+
+In-process caches shared by the client.
+
+:copyright: (c) 2010 by the Sentry Team, see AUTHORS for more details.
+:license: BSD, see LICENSE for more details.
+"""
+
+import time
+
+from threading import Lock
+
+class LRUCache(object):
+    """
+    A thread-safe mapping which evicts the least recently used keys once the
+    total size of its values exceeds ``max_size``.
+
+    Each value counts as 1 towards ``max_size`` unless ``get_size`` is given,
+    in which case it is called with the value to measure it. Values may also
+    be set to expire after a number of seconds.
+    """
+    def __init__(self, max_size=1000, get_size=None):
+        self.max_size = max_size
+        self.get_size = get_size
+        self.size = 0
+        # maps each key to its link in a circular doubly linked list, ordered
+        # from the least to the most recently used, each link being
+        # [prev, next, key, item]
+        self._data = {}
+        self._root = []
+        self._root[:] = [self._root, self._root, None, None]
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def get(self, key, default=None):
+        self._lock.acquire()
+        try:
+            item = self._pop(key)
+            if item is None:
+                return default
+            if item[2] is not None and item[2] <= time.time():
+                return default
+            self._push(key, item)
+            return item[0]
+        finally:
+            self._lock.release()
+
+    def set(self, key, value, timeout=None):
+        if self.get_size is None:
+            size = 1
+        else:
+            size = self.get_size(value)
+
+        if timeout is None:
+            expires = None
+        else:
+            expires = time.time() + timeout
+
+        self._lock.acquire()
+        try:
+            self._pop(key)
+            self._push(key, (value, size, expires))
+            self._evict()
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            self._data.clear()
+            self._root[:] = [self._root, self._root, None, None]
+            self.size = 0
+        finally:
+            self._lock.release()
+
+    def _push(self, key, item):
+        last = self._root[0]
+        link = [last, self._root, key, item]
+        last[1] = self._root[0] = self._data[key] = link
+        self.size += item[1]
+
+    def _pop(self, key):
+        link = self._data.pop(key, None)
+        if link is None:
+            return None
+        prev, next, key, item = link
+        prev[1] = next
+        next[0] = prev
+        self.size -= item[1]
+        return item
+
+    def _evict(self):
+        while self._data and self.size > self.max_size:
+            self._pop(self._root[1][2])
+
+class ThrashingCache(LRUCache):
+    """
+    Counts occurrences of each key within a window of ``timeout`` seconds,
+    suppressing any occurrence past ``limit``.
+
+    A key's count resets once its window has passed, and the least recently
+    seen keys are evicted once ``max_size`` is reached.
+    """
+    def check(self, key, limit, timeout):
+        """
+        Records an occurrence of ``key``.
+
+        Returns a tuple of (allowed, suppressed), where ``suppressed`` is the
+        number of occurrences dropped since the last allowed one.
+        """
+        now = time.time()
+
+        self._lock.acquire()
+        try:
+            item = self._pop(key)
+            if item is None:
+                # [window start, occurrences in window, suppressed]
+                entry = [now, 0, 0]
+            else:
+                entry = item[0]
+                if entry[0] + timeout <= now:
+                    entry[0], entry[1] = now, 0
+
+            entry[1] += 1
+            if entry[1] > limit:
+                entry[2] += 1
+                allowed, suppressed = False, 0
+            else:
+                allowed, suppressed = True, entry[2]
+                entry[2] = 0
+
+            self._push(key, (entry, 1, None))
+            self._evict()
+        finally:
+            self._lock.release()
+
+        return allowed, suppressed
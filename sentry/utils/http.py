@@ -0,0 +1,116 @@
+"""
+sentry.utils.http
+~~~~~~~~~~~~~~~~~
+
+:copyright: (c) 2010 by the Sentry Team, see AUTHORS for more details.
+:license: BSD, see LICENSE for more details.
+"""
+
+import httplib
+import socket
+import urllib2
+import urlparse
+
+from Queue import LifoQueue, Empty, Full
+from StringIO import StringIO
+
+class ConnectionPool(object):
+    """
+    Keeps up to ``size`` keep-alive connections to the server of ``url``,
+    which is also the number of requests made to it at once.
+
+    Connecting, sending and reading each time out after ``timeout`` seconds,
+    as does waiting for a connection while all of them are in use. A
+    request on a connection which the server has since closed is retried
+    once on a new connection.
+
+    Errors are raised as ``urllib2.URLError``, and responses with an error
+    status as ``urllib2.HTTPError``.
+    """
+    def __init__(self, url, size=4, timeout=5):
+        parts = urlparse.urlsplit(url)
+        if parts.scheme == 'https':
+            self.connection_class = httplib.HTTPSConnection
+        else:
+            self.connection_class = httplib.HTTPConnection
+        self.host = parts.hostname
+        self.port = parts.port
+        self.size = size
+        self.timeout = timeout
+        # idle connections, or None in place of each connection which is
+        # yet to be opened, the most recently used first
+        self._pool = LifoQueue(size)
+        for n in xrange(size):
+            self._pool.put(None)
+
+    def _get_connection(self):
+        try:
+            return self._pool.get(timeout=self.timeout)
+        except Empty:
+            raise urllib2.URLError('all %d connections to %s are in use' % (self.size, self.host))
+
+    def _put_connection(self, conn):
+        try:
+            self._pool.put_nowait(conn)
+        except Full:
+            if conn is not None:
+                conn.close()
+
+    def urlopen(self, url, data=None, headers=None):
+        """
+        Sends a request for ``url``, as a POST of ``data`` if given, and
+        returns the body of the response.
+        """
+        parts = urlparse.urlsplit(url)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        method = data is None and 'GET' or 'POST'
+
+        conn = self._get_connection()
+        try:
+            try:
+                if conn is None:
+                    # only a reused connection may have gone stale
+                    raise httplib.NotConnected
+                response = self._request(conn, method, path, data, headers or {})
+            except socket.timeout:
+                raise
+            except (httplib.HTTPException, socket.error):
+                if conn is not None:
+                    conn.close()
+                conn = self.connection_class(self.host, self.port, timeout=self.timeout)
+                response = self._request(conn, method, path, data, headers or {})
+            body = response.read()
+        except (httplib.HTTPException, socket.error), e:
+            if conn is not None:
+                conn.close()
+            self._put_connection(None)
+            raise urllib2.URLError(e)
+        except:
+            if conn is not None:
+                conn.close()
+            self._put_connection(None)
+            raise
+
+        if response.will_close:
+            conn.close()
+            conn = None
+        self._put_connection(conn)
+
+        if response.status >= 400:
+            raise urllib2.HTTPError(url, response.status, response.reason, response.msg, StringIO(body))
+        return body
+
+    def _request(self, conn, method, path, data, headers):
+        conn.request(method, path, data, headers)
+        return conn.getresponse()
+
+    def close(self):
+        while True:
+            try:
+                conn = self._pool.get_nowait()
+            except Empty:
+                return
+            if conn is not None:
+                conn.close()
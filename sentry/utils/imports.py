@@ -0,0 +1,97 @@
+"""
+sentry.utils.imports
+~~~~~~~~~~~~~~~~~~~~
+
+:copyright: (c) 2010 by the Sentry Team, see AUTHORS for more details.
+:license: BSD, see LICENSE for more details.
+"""
+
+import threading
+
+class ModuleProxyCache(dict):
+    """
+    Maps the dotted path of a class to the class, which is imported the first
+    time it is looked up, and only once across threads.
+
+    ``get_instance`` also keeps a single instance of each class, for classes
+    which keep no state (such as event types and processors).
+
+    The number of lookups found in the cache (``hits``) and of imports
+    (``misses``) are kept for ``get_stats``. Hits are counted without a lock,
+    so may be slightly undercounted.
+    """
+    def __init__(self):
+        super(ModuleProxyCache, self).__init__()
+        self.hits = 0
+        self.misses = 0
+        self._instances = {}
+        self._lock = threading.Lock()
+
+    def __getitem__(self, key):
+        try:
+            value = dict.__getitem__(self, key)
+        except KeyError:
+            return self._load(key)
+        self.hits += 1
+        return value
+
+    def __missing__(self, key):
+        # dict.__getitem__ would call this rather than raising KeyError
+        raise KeyError(key)
+
+    def _load(self, key):
+        self._lock.acquire()
+        try:
+            if dict.__contains__(self, key):
+                self.hits += 1
+                return dict.__getitem__(self, key)
+
+            module, class_name = key.rsplit('.', 1)
+            handler = getattr(__import__(module, {}, {}, [class_name]), class_name)
+
+            self[key] = handler
+            self.misses += 1
+            return handler
+        finally:
+            self._lock.release()
+
+    def get_instance(self, key):
+        """
+        Returns the instance of the class at ``key``, which is created the
+        first time it is looked up.
+        """
+        try:
+            instance = self._instances[key]
+        except KeyError:
+            pass
+        else:
+            self.hits += 1
+            return instance
+
+        cls = self[key]
+        self._lock.acquire()
+        try:
+            if key not in self._instances:
+                self._instances[key] = cls()
+            return self._instances[key]
+        finally:
+            self._lock.release()
+
+    def warm(self, keys):
+        """
+        Imports each class in ``keys``, e.g. at startup, so that the first
+        events to use them do not.
+        """
+        for key in keys:
+            self[key]
+
+    def get_stats(self):
+        return {
+            'classes': len(self),
+            'hits': self.hits,
+            'misses': self.misses,
+        }
+
+# the classes of events, interfaces and processors, shared by the client,
+# the collector, models and views
+class_cache = ModuleProxyCache()
@@ -0,0 +1,135 @@
+"""
+sentry.utils.versions
+~~~~~~~~~~~~~~~~~~~~~
+
+:copyright: (c) 2010 by the Sentry Team, see AUTHORS for more details.
+:license: BSD, see LICENSE for more details.
+"""
+
+import hashlib
+import simplejson
+import sys
+import threading
+
+def get_manifest_hash(versions):
+    """
+    Returns a hash of the contents of a dictionary of module versions.
+    """
+    return hashlib.md5(simplejson.dumps(versions, sort_keys=True)).hexdigest()
+
+def get_module_version(module):
+    """
+    Returns the version a module declares with ``get_version``, ``VERSION``
+    or ``__version__``, as a string, or ``None``.
+    """
+    for attr in ('get_version', 'VERSION', '__version__'):
+        version = getattr(module, attr, None)
+        if version is None:
+            continue
+        if callable(version):
+            try:
+                version = version()
+            except Exception:
+                continue
+        if isinstance(version, (list, tuple)):
+            version = '.'.join(str(o) for o in version)
+        if isinstance(version, basestring):
+            return version
+    return None
+
+def get_distribution_versions():
+    """
+    Returns the version of each top level module of the distributions
+    installed with setuptools.
+    """
+    try:
+        import pkg_resources
+    except ImportError:
+        return {}
+
+    versions = {}
+    for dist in pkg_resources.working_set:
+        try:
+            if not dist.has_metadata('top_level.txt'):
+                continue
+            for module_name in dist.get_metadata_lines('top_level.txt'):
+                versions[module_name.strip().replace('/', '.')] = dist.version
+        except Exception:
+            continue
+    return versions
+
+class VersionRegistry(object):
+    """
+    Keeps the version of every installed distribution and imported module,
+    looking at modules again only once more have been imported.
+
+    Module versions take precedence over those of distributions.
+    """
+    def __init__(self):
+        # (hash, versions), replaced as a whole so that the two agree
+        self._manifest = None
+        self._seen = set()
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def _refresh(self):
+        if self._manifest is not None and len(sys.modules) == self._count:
+            return
+
+        self._lock.acquire()
+        try:
+            if self._manifest is None:
+                versions = get_distribution_versions()
+            else:
+                versions = self._manifest[1].copy()
+
+            # getting a version may import further modules, which are left to
+            # the next refresh
+            self._count = len(sys.modules)
+            for module_name, module in sys.modules.items():
+                if module_name in self._seen:
+                    continue
+                self._seen.add(module_name)
+                if module is None:
+                    continue
+                try:
+                    version = get_module_version(module)
+                except Exception:
+                    continue
+                if version is not None:
+                    versions[module_name] = version
+
+            if self._manifest is None or versions != self._manifest[1]:
+                self._manifest = (get_manifest_hash(versions), versions)
+        finally:
+            self._lock.release()
+
+    def get_versions(self):
+        """
+        Returns a dictionary of module name to version, which must not be
+        changed.
+        """
+        return self.get_manifest()[1]
+
+    def get_manifest(self):
+        """
+        Returns a tuple of (hash, versions), where ``hash`` identifies the
+        contents of ``versions``.
+        """
+        self._refresh()
+        return self._manifest
+
+    def get_version(self, culprit):
+        """
+        Returns the (module, version) of the innermost module with a known
+        version which ``culprit`` is within, or ``None``.
+        """
+        versions = self.get_versions()
+        parts = culprit.split('.')
+        for idx in xrange(len(parts), 0, -1):
+            module_name = '.'.join(parts[:idx])
+            if module_name in versions:
+                return module_name, versions[module_name]
+        return None
+
+registry = VersionRegistry()
@@ -15,6 +15,7 @@ from flask import request
 from jinja2 import Markup, escape
 from sentry import app
 from sentry.models import Tag
+from sentry.utils.imports import class_cache
 
 _CACHE = None
 def all(from_cache=True):
@@ -23,10 +24,8 @@ def all(from_cache=True):
     if _CACHE is None or not from_cache:
         modules = []
         for key, path in app.config['FILTERS']:
-            module_name, class_name = path.rsplit('.', 1)
             try:
-                module = __import__(module_name, {}, {}, class_name)
-                handler = getattr(module, class_name)
+                handler = class_cache[path]
             except Exception:
                 logger = logging.getLogger(__name__)
                 logger.exception('Unable to import %s' % (path,))
@@ -116,11 +115,7 @@ class Filter(object):
         return [(t.value, t.value) for t in Tag.objects.filter(key=self.tag)]
     
     def get_query_set(self, queryset):
-        from sentry.models import MessageIndex
-        kwargs = {self.tag: self.get_value()}
-        if self.tag.startswith('data__'):
-            return MessageIndex.objects.get_for_queryset(queryset, **kwargs)
-        return queryset.filter(**kwargs)
+        return queryset.filter_tags(**{self.tag: self.get_value()})
     
     def process(self, data):
         return data
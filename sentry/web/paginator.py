@@ -0,0 +1,70 @@
+"""
+sentry.web.paginator
+~~~~~~~~~~~~~~~~~~~~
+
+:copyright: (c) 2010 by the Sentry Team, see AUTHORS for more details.
+:license: BSD, see LICENSE for more details.
+"""
+
+from sentry.utils import cached_property
+
+class Paginator(object):
+    """
+    Pages through a QuerySet, as expected by the ``sentry/partial/pager.html``
+    template. Only the requested page is fetched, and the total comes from
+    ``QuerySet.count``.
+    """
+    # number of pages linked to on either side of the current page
+    window = 5
+
+    def __init__(self, queryset, page, per_page):
+        self.queryset = queryset
+        self.page = max(1, page)
+        self.per_page = per_page
+
+    @cached_property
+    def count(self):
+        return self.queryset.count()
+
+    @cached_property
+    def object_list(self):
+        offset = (self.page - 1) * self.per_page
+        return self.queryset[offset:offset + self.per_page]
+
+    @cached_property
+    def num_pages(self):
+        return max(1, (self.count + self.per_page - 1) // self.per_page)
+
+    @property
+    def has_pages(self):
+        return self.num_pages > 1
+
+    @property
+    def is_first(self):
+        return self.page == 1
+
+    @property
+    def is_last(self):
+        return self.page >= self.num_pages
+
+    @property
+    def has_previous(self):
+        return not self.is_first
+
+    @property
+    def has_next(self):
+        return not self.is_last
+
+    @property
+    def previous_page(self):
+        return self.page - 1
+
+    @property
+    def next_page(self):
+        return self.page + 1
+
+    @property
+    def page_range(self):
+        start = max(1, self.page - self.window)
+        end = min(self.num_pages, self.page + self.window)
+        return range(start, end + 1)
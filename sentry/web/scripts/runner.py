@@ -18,7 +18,9 @@ from eventlet import wsgi
 from optparse import OptionParser
 
 from sentry import VERSION, app
+from sentry.core.scripts.cleaner import add_cleanup_options, run_cleanup
 from sentry.middleware import WSGIErrorMiddleware
+from sentry.utils.imports import class_cache
 
 class SentryWeb(DaemonRunner):
     pidfile_timeout = 10
@@ -66,6 +68,8 @@ class SentryWeb(DaemonRunner):
         import sentry.web.templatetags
         import sentry.web.views
 
+        class_cache.warm(app.config['PRELOAD_CLASSES'])
+
         upgrade()
         app.wsgi_app = WSGIErrorMiddleware(app.wsgi_app)
 
@@ -74,31 +78,10 @@ class SentryWeb(DaemonRunner):
         else:
             wsgi.server(eventlet.listen((self.host, self.port)), app)
 
-def cleanup(days=30, tags=None):
-    from sentry.models import Group, Event
-    import datetime
-    
-    ts = datetime.datetime.now() - datetime.timedelta(days=days)
-    
-    for event in Event.objects.order_by('date'):
-        if event.date > ts:
-            break
-        event.delete()
-    
-    for group in Group.objects.order_by('last_seen'):
-        if group.last_seen > ts:
-            break
-        event.delete()
-
-
 def upgrade():
-    pass
-    # from sentry.conf import settings
-    # 
-    # call_command('syncdb', database=settings.DATABASE_USING or 'default', interactive=False)
-    # 
-    # if 'south' in django_settings.INSTALLED_APPS:
-    #     call_command('migrate', database=settings.DATABASE_USING or 'default', interactive=False)
+    # data migrations, e.g. indexing groups stored by earlier versions
+    from sentry.core.upgrade import upgrade
+    upgrade()
 
 def main():
     command_list = ('start', 'stop', 'restart', 'cleanup', 'upgrade')
@@ -125,10 +108,7 @@ def main():
         parser.add_option('--pidfile', dest='pidfile')
         parser.add_option('--logfile', dest='logfile')
     elif args[1] == 'cleanup':
-        parser.add_option('--days', default='30', type=int,
-                          help='Numbers of days to truncate on.')
-        parser.add_option('--tags',
-                          help='Limit truncation to only entries tagged with key:value.')
+        add_cleanup_options(parser)
 
     (options, args) = parser.parse_args()
 
@@ -157,7 +137,7 @@ def main():
         web.execute(args[0])
 
     elif args[0] == 'cleanup':
-        cleanup(days=options.days, tags=options.tags)
+        run_cleanup(options)
 
     sys.exit(0)
 
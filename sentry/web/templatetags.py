@@ -7,6 +7,7 @@ sentry.web.templatetags
 """
 
 from sentry import app
+from sentry.models import Group
 #from sentry.plugins import GroupActionProvider
 
 from flaskext.babel import ngettext, gettext
@@ -60,36 +61,29 @@ def num_digits(value):
 
 @app.template_filter()
 def chart_data(group, max_days=90):
-    return {}
-    hours = max_days*24
+    """
+    Returns the number of events seen each hour over the last ``max_days``
+    days, for a group or (given ``None``) across all groups.
+    """
+    hours = max_days * 24
 
     today = datetime.datetime.now().replace(microsecond=0, second=0, minute=0)
     min_date = today - datetime.timedelta(hours=hours)
 
-    if get_db_engine(getattr(conn, 'alias', 'default')).startswith('oracle'):
-        method = conn.ops.date_trunc_sql('hh24', 'datetime')
-    else:
-        method = conn.ops.date_trunc_sql('hour', 'datetime')
+    rows = app.db.get_counts(Group, group and group.pk, 60 * 60, min_date, today)
 
-    chart_qs = list(group.message_set.all()\
-                      .filter(datetime__gte=min_date)\
-                      .extra(select={'grouper': method}).values('grouper')\
-                      .annotate(num=Count('id')).values_list('grouper', 'num')\
-                      .order_by('grouper'))
+    # just skip zeroes, showing at least the last day
+    first_seen = 0
+    while first_seen < len(rows) - 25 and not rows[first_seen][1]:
+        first_seen += 1
+    rows = rows[first_seen:]
 
-    if not chart_qs:
+    if not any(count for date, count in rows):
         return {}
 
-    rows = dict(chart_qs)
-
-    #just skip zeroes
-    first_seen = hours
-    while not rows.get(today - datetime.timedelta(hours=first_seen)) and first_seen > 24:
-        first_seen -= 1
-
     return {
-        'points': [rows.get(today-datetime.timedelta(hours=d), 0) for d in xrange(first_seen, -1, -1)],
-        'categories': [str(today-datetime.timedelta(hours=d)) for d in xrange(first_seen, -1, -1)],
+        'points': [count for date, count in rows],
+        'categories': [str(date) for date, count in rows],
     }
 
 @app.template_filter()
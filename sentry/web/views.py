@@ -15,12 +15,14 @@ import simplejson
 from jinja2 import Markup
 from flask import render_template, redirect, request, url_for, \
                   abort, Response
+from werkzeug.urls import url_encode
 
 from sentry import app
 from sentry.core.plugins import GroupActionProvider
 from sentry.models import Group, Event, EventType
 from sentry.web import filters
 from sentry.web.templatetags import with_priority
+from sentry.web.paginator import Paginator
 from sentry.utils.shortcuts import get_object_or_404
 
 uuid_re = re.compile(r'^[a-z0-9]{32}$')
@@ -132,19 +134,26 @@ def index():
         event_list = event_list.order_by('-score')
 
     any_filter = False
-    # for filter_ in filters:
-    #     if not filter_.is_set():
-    #         continue
-    #     any_filter = True
-        # event_list = filter_.get_query_set(event_list)
+    for filter_ in filter_list:
+        if not filter_.is_set():
+            continue
+        any_filter = True
+        event_list = filter_.get_query_set(event_list)
 
     today = datetime.datetime.now()
 
     has_realtime = page == 1
-    
+
+    paginator = Paginator(event_list, page, app.config['MESSAGES_PER_PAGE'])
+
+    query_args = request.args.copy()
+    query_args.pop('p', None)
+
     return render_template('sentry/index.html', **{
         'has_realtime': has_realtime,
-        'event_list': event_list,
+        'event_list': paginator.object_list,
+        'paginator': paginator,
+        'query_string': url_encode(query_args),
         'today': today,
         'sort': sort,
         'any_filter': any_filter,
@@ -158,9 +167,7 @@ def ajax_handler():
     op = request.form.get('op')
 
     if op == 'poll':
-        filters = []
-        for filter_ in filters.all():
-            filters.append(filter_(request))
+        filter_list = list(filters.all())
 
         event_list = Group.objects
 
@@ -175,10 +182,10 @@ def ajax_handler():
             sort = 'priority'
             event_list = event_list.order_by('-score')
 
-        # for filter_ in filters:
-        #     if not filter_.is_set():
-        #         continue
-        #     event_list = filter_.get_query_set(event_list)
+        for filter_ in filter_list:
+            if not filter_.is_set():
+                continue
+            event_list = filter_.get_query_set(event_list)
 
         data = [
             (m.pk, {
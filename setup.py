@@ -19,7 +19,8 @@ except ImportError:
 install_requires = [
     'Flask',
     'Flask-Babel',
-    'redis',
+    # redis>=2.7 is required for Lua script support
+    'redis>=2.7',
     # python-daemon and eventlet are required to run the Sentry indepenent webserver
     'python-daemon>=1.6',
     'eventlet>=0.9.15',
@@ -37,6 +38,7 @@ tests_require = [
     'django-celery',
     'logbook',
     'nose',
+    'SQLAlchemy',
     'unittest2',
 ]
 
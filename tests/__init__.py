@@ -1,8 +1,29 @@
 import functools
+import os
 import unittest2
 
 from sentry import app
 from sentry.db import get_backend
+from sentry.db.models import count_cache
+from sentry.models import manifest_cache
+
+# the suite runs against Redis unless e.g. SENTRY_TEST_DATASTORE=memory is set
+DATASTORES = {
+    'redis': {
+        'ENGINE': 'sentry.db.backends.redis.RedisBackend',
+        'OPTIONS': {
+            'db': 9
+        }
+    },
+    'memory': {
+        'ENGINE': 'sentry.db.backends.memory.MemoryBackend',
+    },
+}
+
+TEST_DATASTORE = os.environ.get('SENTRY_TEST_DATASTORE', 'redis')
+
+def requires_redis(cls):
+    return unittest2.skipUnless(TEST_DATASTORE == 'redis', 'requires redis-server')(cls)
 
 def with_settings(**settings):
     def wrapped(func):
@@ -23,16 +44,14 @@ def with_settings(**settings):
 class BaseTest(unittest2.TestCase):
     def setUp(self):
         # XXX: might be a better way to do do this
-        app.config['DATASTORE'] = {
-            'ENGINE': 'sentry.db.backends.redis.RedisBackend',
-            'OPTIONS': {
-                'db': 9
-            }
-        }
+        app.config['DATASTORE'] = DATASTORES[TEST_DATASTORE]
         app.config['CLIENT'] = 'sentry.client.base.SentryClient'
         app.db = get_backend(app)
         
         # Flush the Redis instance
-        app.db.conn.flushdb()
+        if TEST_DATASTORE == 'redis':
+            app.db.conn.flushdb()
+        count_cache.clear()
+        manifest_cache.clear()
         
         self.client = app.test_client()
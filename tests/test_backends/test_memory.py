@@ -0,0 +1,142 @@
+from .. import BaseTest, test_cleaner, test_orm
+
+import datetime
+import os
+import shutil
+import tempfile
+import threading
+import unittest2
+
+from sentry import app
+from sentry.db.backends.memory import MemoryBackend, SortedIndex
+from sentry.models import Event, Group
+
+class SortedIndexTest(unittest2.TestCase):
+    def test_range(self):
+        index = SortedIndex()
+        for n in (3, 1, 4, 0, 2):
+            index.add('m%d' % n, n)
+
+        self.assertEquals(index.range(), ['m0', 'm1', 'm2', 'm3', 'm4'])
+        self.assertEquals(index.range(1, 2), ['m1', 'm2'])
+        self.assertEquals(index.range(1, 2, desc=True), ['m3', 'm2'])
+        self.assertEquals(index.range(4, 10, desc=True), ['m0'])
+        self.assertEquals(index.range(5, 10), [])
+
+    def test_update(self):
+        index = SortedIndex()
+        index.add('a', 1)
+        index.add('b', 2)
+        index.add('a', 3)
+
+        self.assertEquals(index.range(), ['b', 'a'])
+        self.assertEquals(len(index), 2)
+
+        index.remove('a')
+        index.remove('missing')
+
+        self.assertEquals(index.range(), ['b'])
+        self.assertFalse('a' in index)
+
+    def test_ties(self):
+        # like Redis, equal scores are ordered by member
+        index = SortedIndex()
+        for member in ('c', 'a', 'b'):
+            index.add(member, 1)
+
+        self.assertEquals(index.range(), ['a', 'b', 'c'])
+        self.assertEquals(index.range(desc=True), ['c', 'b', 'a'])
+
+class MemoryBackendTest(BaseTest):
+    def setUp(self):
+        super(MemoryBackendTest, self).setUp()
+        self.backend = app.db = MemoryBackend()
+
+    def store(self, message, tags, seconds):
+        return app.client.store(
+            'sentry.events.Message',
+            tags=tags,
+            date=datetime.datetime(2011, 6, 18, 22, 31, seconds),
+            time_spent=0,
+            data={
+                'sentry.interfaces.Message': {
+                    'message': message,
+                }
+            },
+            event_id='%s-%s' % (message, seconds),
+        )
+
+    def test_list(self):
+        for n in xrange(5):
+            pk = self.backend.add(Group, hash=str(n))
+            self.backend.add_to_index(Group, pk, 'count', n)
+
+        result = self.backend.list(Group, 'count', offset=1, limit=2)
+        self.assertEquals([d for pk, d in result], [{'hash': '1'}, {'hash': '2'}])
+
+        result = self.backend.list(Group, 'count', limit=2, desc=True)
+        self.assertEquals([d for pk, d in result], [{'hash': '4'}, {'hash': '3'}])
+
+        self.assertEquals(self.backend.count(Group, 'count'), 5)
+
+    def test_store_event(self):
+        self.store('foo', [('server', 'a'), ('level', 'error')], 1)
+        self.store('bar', [('server', 'b'), ('level', 'error')], 2)
+        event, group = self.store('foo', [('server', 'a')], 3)
+
+        self.assertEquals(group.count, 2)
+        self.assertEquals([e.pk for e in group.get_relations(Event)], ['foo-3', 'foo-1'])
+        self.assertEquals([g.message for g in Group.objects.order_by('-last_seen').filter_tags(level='error')], ['foo', 'bar'])
+        self.assertEquals(Group.objects.filter_tags(server='a', level='error').count(), 1)
+        self.assertEquals(Group.objects.filter_tags(server='b', level='info').count(), 0)
+
+    def test_store_concurrent_events(self):
+        threads = [threading.Thread(target=self.store, args=('foo', [], n)) for n in xrange(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEquals(Group.objects.count(), 1)
+        self.assertEquals(Group.objects.all()[0].count, 10)
+
+    def test_snapshot(self):
+        path = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(path, 'sentry.db')
+            app.db = MemoryBackend(filename)
+            event, group = self.store('foo', [('server', 'a')], 1)
+            app.db.snapshot()
+
+            app.db = MemoryBackend(filename)
+            self.assertEquals(Group.objects.get(group.pk).message, 'foo')
+            self.assertEquals(Group.objects.filter_tags(server='a').count(), 1)
+            self.assertEquals(Event.objects.get(event.pk).data, event.data)
+        finally:
+            shutil.rmtree(path)
+
+    def test_snapshot_interval(self):
+        path = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(path, 'sentry.db')
+            app.db = MemoryBackend(filename, snapshot_interval=0)
+            event, group = self.store('foo', [], 1)
+
+            self.assertEquals(MemoryBackend(filename).get(Group, group.pk), app.db.get(Group, group.pk))
+        finally:
+            shutil.rmtree(path)
+
+class MemoryORMTest(test_orm.ORMTest):
+    def setUp(self):
+        super(MemoryORMTest, self).setUp()
+        app.db = MemoryBackend()
+
+class MemoryCleanerTest(test_cleaner.CleanerTest):
+    def setUp(self):
+        super(MemoryCleanerTest, self).setUp()
+        app.db = MemoryBackend()
+
+class MemoryBulkPurgeTest(test_cleaner.BulkPurgeTest):
+    def setUp(self):
+        super(MemoryBulkPurgeTest, self).setUp()
+        app.db = MemoryBackend()
@@ -1,4 +1,4 @@
-from .. import BaseTest
+from .. import BaseTest, requires_redis
 
 
 from sentry.db.backends.redis import RedisBackend
@@ -6,11 +6,13 @@ from sentry.db.backends.redis import RedisBackend
 class MockModel(object):
     __name__ = 'test'
 
+@requires_redis
 class RedisBackendTest(BaseTest):
     def setUp(self):
         self.backend = RedisBackend(db=9)
         self.schema = MockModel()
         self.redis = self.backend.conn
+        self.redis.flushdb()
         
     def test_add(self):
         pk1 = self.backend.add(self.schema, **{'foo': 'bar'})
@@ -46,4 +48,40 @@ class RedisBackendTest(BaseTest):
         key = self.backend._get_data_key(self.schema, pk)
         self.backend.set(self.schema, pk, **{'foo': 'bar'})
         self.assertEquals(len(self.redis.hgetall(key)), 1)
-        self.assertEquals(self.redis.hget(key, 'foo'), 'bar')
\ No newline at end of file
+        self.assertEquals(self.redis.hget(key, 'foo'), 'bar')
+
+    def test_get_many(self):
+        pk1 = self.backend.add(self.schema, **{'foo': 'bar'})
+        pk2 = self.backend.add(self.schema, **{'foo': 'baz'})
+
+        result = self.backend.get_many(self.schema, [pk2, 'missing', pk1])
+        self.assertEquals(len(result), 3)
+        self.assertEquals(result[0], (pk2, {'foo': 'baz'}))
+        self.assertEquals(result[1], ('missing', {}))
+        self.assertEquals(result[2], (pk1, {'foo': 'bar'}))
+
+        self.assertEquals(self.backend.get_many(self.schema, []), [])
+
+    def test_list(self):
+        for n in xrange(5):
+            pk = self.backend.add(self.schema, **{'foo': n})
+            self.backend.add_to_index(self.schema, pk, 'default', n)
+
+        result = self.backend.list(self.schema, offset=1, limit=2)
+        self.assertEquals(len(result), 2)
+        self.assertEquals(result[0][1], {'foo': '1'})
+        self.assertEquals(result[1][1], {'foo': '2'})
+
+        result = self.backend.list(self.schema, limit=2, desc=True)
+        self.assertEquals([d for pk, d in result], [{'foo': '4'}, {'foo': '3'}])
+
+        self.assertEquals(len(self.backend.list(self.schema)), 5)
+
+    def test_list_relations(self):
+        parent = MockModel()
+        for n in xrange(3):
+            pk = self.backend.add(self.schema, **{'foo': n})
+            self.backend.add_relation(parent, 'bar', self.schema, pk, n)
+
+        result = self.backend.list_relations(parent, 'bar', self.schema, limit=2, desc=True)
+        self.assertEquals([d for pk, d in result], [{'foo': '2'}, {'foo': '1'}])
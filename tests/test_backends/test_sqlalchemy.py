@@ -0,0 +1,213 @@
+from .. import BaseTest, test_cleaner, test_orm
+
+import datetime
+import unittest2
+
+from sentry import app
+from sentry.db import models
+from sentry.models import Event, Group, Tag
+
+try:
+    from sentry.db.backends.sqlalchemy import SQLAlchemyBackend
+    from sqlalchemy import event as sqlalchemy_event
+except ImportError:
+    SQLAlchemyBackend = None
+
+class SQLAlchemyTestMixin(object):
+    def setUp(self):
+        super(SQLAlchemyTestMixin, self).setUp()
+        self.backend = app.db = SQLAlchemyBackend('sqlite://')
+
+@unittest2.skipIf(SQLAlchemyBackend is None, 'SQLAlchemy is not installed')
+class SQLAlchemyBackendTest(SQLAlchemyTestMixin, BaseTest):
+    def create(self, n, **kwargs):
+        return Group.objects.create(type='foo', hash=str(n), count=n + 1,
+                                    last_seen=datetime.datetime(2011, 6, 18, 22, 31, n), **kwargs)
+
+    def test_add(self):
+        pk = self.backend.add(Group, type='foo', count=1)
+
+        self.assertEquals(self.backend.get(Group, pk), {'type': u'foo', 'count': 1})
+        self.assertEquals(self.backend.get(Group, 'missing'), {})
+
+    def test_get_many(self):
+        pk1 = self.backend.add(Group, type='foo')
+        pk2 = self.backend.add(Group, type='bar')
+
+        result = self.backend.get_many(Group, [pk2, 'missing', pk1])
+        self.assertEquals(result, [(pk2, {'type': u'bar'}), ('missing', {}), (pk1, {'type': u'foo'})])
+
+        self.assertEquals(self.backend.get_many(Group, []), [])
+
+    def test_incr(self):
+        group = self.create(0)
+
+        self.assertEquals(group.incr('count', 2), 3)
+        self.assertEquals(group.decr('count'), 2)
+        self.assertEquals(Group.objects.get(group.pk).count, 2)
+
+    def test_meta(self):
+        group = self.create(0)
+        group.set_meta(foo='bar', baz=[1])
+        group.set_meta(foo='qux')
+
+        self.assertEquals(group.get_meta(), {'foo': 'qux', 'baz': [1]})
+
+    def test_list(self):
+        for n in xrange(5):
+            self.create(n)
+
+        self.assertEquals([g.hash for g in Group.objects.all()[1:3]], ['1', '2'])
+        self.assertEquals([g.hash for g in Group.objects.order_by('-count')[0:2]], ['4', '3'])
+        self.assertEquals(Group.objects.count(), 5)
+
+    def test_cindex(self):
+        group = self.create(0)
+
+        self.assertEquals(Group.objects.get_or_create(type='foo', hash='0'), (group, False))
+        self.assertEquals([g.pk for g in Group.objects.filter(type='foo')], [group.pk])
+
+    def test_unique_cindex(self):
+        self.create(0)
+
+        self.assertRaises(Group.DuplicateKeyError, self.create, 0)
+        self.assertEquals(Group.objects.count(), 1)
+
+    def test_get_or_create_race(self):
+        group = self.create(0)
+        list_by_cindex = self.backend.list_by_cindex
+        missed = []
+
+        def racing_list_by_cindex(schema, **kwargs):
+            # the group is created by another process after the first lookup
+            if schema is Group and not missed:
+                missed.append(kwargs)
+                return []
+            return list_by_cindex(schema, **kwargs)
+        self.backend.list_by_cindex = racing_list_by_cindex
+
+        self.assertEquals(Group.objects.get_or_create(type='foo', hash='0', defaults={'count': 1}), (group, False))
+        self.assertEquals(len(missed), 1)
+        self.assertEquals(Group.objects.count(), 1)
+
+    def test_incr_counts_race(self):
+        date = datetime.datetime(2011, 6, 18, 22, 31)
+        raced = []
+
+        def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            # another process creates the first bucket between the update
+            # and the insert
+            if statement.startswith('UPDATE sentry_counts') and not raced:
+                raced.append(statement)
+                conn.connection.cursor().execute('INSERT INTO sentry_counts VALUES (?, ?, ?, ?, ?)',
+                                                 ('group', '', 60, self.backend._get_bucket(date, 60), 1))
+        sqlalchemy_event.listen(self.backend.engine, 'after_cursor_execute', after_cursor_execute)
+
+        self.backend.incr_counts(Group, [(None, date, 1)])
+
+        self.assertEquals(len(raced), 1)
+        self.assertEquals(self.backend.get_counts(Group, None, 60, date, date), [(date, 2)])
+        self.assertEquals(self.backend.get_counts(Group, None, 3600, date, date),
+                          [(datetime.datetime(2011, 6, 18, 22), 1)])
+
+    def test_relations(self):
+        group = self.create(0)
+        events = [Event.objects.create(type='foo') for n in xrange(3)]
+        for n, event in enumerate(events):
+            group.add_relation(event, n)
+        group.add_relation(events[0], 5)
+
+        result = group.get_relations(Event, limit=2)
+        self.assertEquals(result, [events[0], events[2]])
+
+        self.backend.remove_relation(Group, group.pk, Event, events[0].pk)
+        result = group.get_relations(Event, desc=False)
+        self.assertEquals(result, [events[1], events[2]])
+
+    def test_delete(self):
+        group = self.create(0)
+        group.set_meta(foo='bar')
+        self.backend.add_tags(Group, group.pk, [('server', 'a')])
+
+        # only the instance itself, as Group.delete also updates counters
+        models.Model.delete(group)
+
+        self.assertEquals(Group.objects.count(), 0)
+        self.assertEquals(self.backend.get_meta(Group, group.pk), {})
+        self.assertEquals(Group.objects.filter_tags(server='a').count(), 0)
+
+    def test_filter_tags(self):
+        self.backend.add_tags(Group, self.create(0).pk, [('server', 'a'), ('level', 'error')])
+        self.backend.add_tags(Group, self.create(1).pk, [('server', 'b'), ('level', 'error')])
+        pk = self.create(2).pk
+        self.backend.add_tags(Group, pk, [('server', 'a')])
+        self.backend.add_tags(Group, pk, [('server', 'a')])
+
+        self.assertEquals([g.hash for g in Group.objects.order_by('-last_seen').filter_tags(server='a')], ['2', '0'])
+        self.assertEquals([g.hash for g in Group.objects.filter_tags(server='a', level='error')], ['0'])
+        self.assertEquals(Group.objects.filter_tags(level='error').count(), 2)
+        self.assertEquals(Group.objects.filter_tags(server='c').count(), 0)
+
+    def test_store_event(self):
+        for n in xrange(3):
+            event, group = app.client.store(
+                'sentry.events.Message',
+                tags=[('server', 'a')],
+                date=datetime.datetime(2011, 6, 18, 22, 31, n),
+                time_spent=10,
+                data={
+                    'sentry.interfaces.Message': {
+                        'message': 'foo',
+                    }
+                },
+                event_id=str(n),
+            )
+
+        self.assertEquals(group.count, 3)
+        self.assertEquals(group.time_spent, 30)
+        self.assertEquals(Group.objects.filter_tags(server='a').count(), 1)
+        self.assertEquals([e.pk for e in group.get_relations(Event)], ['2', '1', '0'])
+        self.assertEquals(Tag.objects.get_or_create(hash=Tag.get_hash('server', 'a'))[0].count, 1)
+
+    def test_store_event_counts(self):
+        def incr_counts(schema, counts):
+            raise ValueError('counts are unavailable')
+        self.backend.incr_counts = incr_counts
+
+        self.assertRaises(ValueError, app.client.store, 'sentry.events.Message', tags=[],
+                          date=datetime.datetime(2011, 6, 18, 22, 31), time_spent=10,
+                          data={'sentry.interfaces.Message': {'message': 'foo'}}, event_id='0')
+
+        # the event is stored along with its counts or not at all
+        self.assertEquals(Group.objects.count(), 0)
+        self.assertRaises(Event.DoesNotExist, Event.objects.get, '0')
+
+    def test_store_event_race(self):
+        kwargs = dict(tags=[('server', 'a')], date=datetime.datetime(2011, 6, 18, 22, 31), time_spent=10,
+                      data={'sentry.interfaces.Message': {'message': 'foo'}})
+        event, group = app.client.store('sentry.events.Message', event_id='0', **kwargs)
+        list_by_cindex = self.backend.list_by_cindex
+        missed = []
+
+        def racing_list_by_cindex(schema, **kwargs):
+            if schema is Group and not missed:
+                missed.append(kwargs)
+                return []
+            return list_by_cindex(schema, **kwargs)
+        self.backend.list_by_cindex = racing_list_by_cindex
+
+        event, group = app.client.store('sentry.events.Message', event_id='1', **kwargs)
+
+        self.assertEquals(len(missed), 1)
+        self.assertEquals(group.count, 2)
+        self.assertEquals(Group.objects.count(), 1)
+        self.assertEquals([e.pk for e in group.get_relations(Event)], ['1', '0'])
+        self.assertEquals(Tag.objects.get_or_create(hash=Tag.get_hash('server', 'a'))[0].count, 1)
+
+@unittest2.skipIf(SQLAlchemyBackend is None, 'SQLAlchemy is not installed')
+class SQLAlchemyORMTest(SQLAlchemyTestMixin, test_orm.ORMTest):
+    pass
+
+@unittest2.skipIf(SQLAlchemyBackend is None, 'SQLAlchemy is not installed')
+class SQLAlchemyCleanerTest(SQLAlchemyTestMixin, test_cleaner.CleanerTest):
+    pass
@@ -0,0 +1,105 @@
+from .. import BaseTest, test_cleaner, test_orm
+
+import datetime
+import os
+import shutil
+import tempfile
+import threading
+import unittest2
+
+from sentry import app
+from sentry.models import Event, EventType, Group, Tag
+
+try:
+    from sentry.db.backends.sqlite import SQLiteBackend
+except ImportError:
+    SQLiteBackend = None
+
+class SQLiteTestMixin(object):
+    def setUp(self):
+        super(SQLiteTestMixin, self).setUp()
+        self.path = tempfile.mkdtemp()
+        self.filename = os.path.join(self.path, 'sentry.db')
+        self.backend = app.db = SQLiteBackend(self.filename)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+        super(SQLiteTestMixin, self).tearDown()
+
+@unittest2.skipIf(SQLiteBackend is None, 'SQLAlchemy is not installed')
+class SQLiteBackendTest(SQLiteTestMixin, BaseTest):
+    def get_store_params(self, message, tags, seconds):
+        return dict(
+            event_type='sentry.events.Message',
+            tags=tags,
+            date=datetime.datetime(2011, 6, 18, 22, 31, seconds),
+            time_spent=10,
+            data={
+                'sentry.interfaces.Message': {
+                    'message': message,
+                }
+            },
+            event_id='%s-%s' % (message, seconds),
+        )
+
+    def store(self, message, tags, seconds):
+        return app.client.store(**self.get_store_params(message, tags, seconds))
+
+    def test_pragmas(self):
+        self.assertEquals(self.backend.engine.execute('PRAGMA journal_mode').scalar(), 'wal')
+
+    def test_store_event(self):
+        self.store('foo', [('server', 'a'), ('level', 'error')], 1)
+        self.store('bar', [('server', 'b'), ('level', 'error')], 2)
+        event, group = self.store('foo', [('server', 'a')], 3)
+
+        self.assertEquals(group.count, 2)
+        self.assertEquals(group.time_spent, 20)
+        self.assertEquals(group.last_seen, datetime.datetime(2011, 6, 18, 22, 31, 3))
+        self.assertEquals(Group.objects.get(group.pk).__dict__, group.__dict__)
+        self.assertEquals(Event.objects.get(event.pk).data, event.data)
+        self.assertEquals([e.pk for e in group.get_relations(Event)], ['foo-3', 'foo-1'])
+        self.assertEquals([g.message for g in Group.objects.order_by('-last_seen').filter_tags(level='error')], ['foo', 'bar'])
+        self.assertEquals(Group.objects.filter_tags(server='a', level='error').count(), 1)
+
+        self.assertEquals(EventType.objects.get_or_create(path=group.type)[0].count, 2)
+        self.assertEquals(Tag.objects.get_or_create(hash=Tag.get_hash('level', 'error'))[0].count, 2)
+
+    def test_store_many(self):
+        result = app.client.store_many([self.get_store_params('foo', [('server', 'a')], n) for n in xrange(3)])
+
+        self.assertEquals(len(result), 3)
+        self.assertEquals(result[-1][1].count, 3)
+        self.assertEquals(Group.objects.count(), 1)
+
+    def test_store_concurrent_events(self):
+        threads = [threading.Thread(target=self.store, args=('foo', [], n)) for n in xrange(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEquals(Group.objects.count(), 1)
+        self.assertEquals(Group.objects.all()[0].count, 10)
+
+    def test_restart(self):
+        event, group = self.store('foo', [('server', 'a')], 1)
+        self.backend.engine.dispose()
+
+        app.db = SQLiteBackend(self.filename)
+
+        self.assertEquals(Group.objects.get(group.pk).count, 1)
+        self.assertEquals(Group.objects.filter_tags(server='a').count(), 1)
+        self.assertEquals(Event.objects.get(event.pk).data, event.data)
+
+@unittest2.skipIf(SQLiteBackend is None, 'SQLAlchemy is not installed')
+class SQLiteORMTest(SQLiteTestMixin, test_orm.ORMTest):
+    pass
+
+@unittest2.skipIf(SQLiteBackend is None, 'SQLAlchemy is not installed')
+class SQLiteCleanerTest(SQLiteTestMixin, test_cleaner.CleanerTest):
+    pass
+
+@unittest2.skipIf(SQLiteBackend is None, 'SQLAlchemy is not installed')
+class SQLiteBulkPurgeTest(SQLiteTestMixin, test_cleaner.BulkPurgeTest):
+    pass
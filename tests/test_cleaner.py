@@ -0,0 +1,194 @@
+from . import BaseTest, with_settings
+
+import datetime
+import time
+
+from StringIO import StringIO
+
+from sentry import app
+from sentry.core.cleaner import BulkPurge, Cleaner, LOCK_NAME
+from sentry.models import Event, EventType, Group, Tag
+
+class CleanerTest(BaseTest):
+    def setUp(self):
+        super(CleanerTest, self).setUp()
+        self.cleaner = Cleaner(app)
+        self.now = datetime.datetime.now().replace(microsecond=0)
+
+    def store(self, message, tags, days, seconds=0):
+        return app.client.store(
+            'sentry.events.Message',
+            tags=tags,
+            date=self.now - datetime.timedelta(days=days, seconds=seconds),
+            time_spent=0,
+            data={
+                'sentry.interfaces.Message': {
+                    'message': message,
+                }
+            },
+            event_id='%s-%s-%s' % (message, days, seconds),
+        )
+
+    def test_clean(self):
+        old_event, old_group = self.store('foo', [('server', 'a')], 60)
+        self.store('foo', [('server', 'a')], 50)
+        self.store('bar', [('server', 'a')], 40)
+        new_event, new_group = self.store('bar', [('server', 'b')], 1)
+
+        self.assertEquals(self.cleaner.clean(), 4)
+
+        self.assertEquals(self.cleaner.deleted, {Event: 3, Group: 1})
+        self.assertEquals(self.cleaner.backlog, {Event: 0, Group: 0})
+        self.assertRaises(Group.DoesNotExist, Group.objects.get, old_group.pk)
+        self.assertRaises(Event.DoesNotExist, Event.objects.get, old_event.pk)
+        self.assertEquals(old_event.get_meta(), {})
+        self.assertEquals(old_group.get_relations(Event), [])
+        self.assertEquals(Group.objects.count(), 1)
+        self.assertEquals(Group.objects.filter_tags(server='a').count(), 1)
+        self.assertEquals([e.pk for e in new_group.get_relations(Event)], [new_event.pk])
+        self.assertEquals(app.db.list_by_cindex(Group, type=old_group.type, hash=old_group.hash), [])
+
+        # the type and the server=a tag are left with the remaining group
+        self.assertEquals(EventType.objects.filter(path=old_group.type)[0].count, 1)
+        self.assertEquals(Tag.objects.filter(hash=Tag.get_hash('server', 'a'))[0].count, 1)
+
+    @with_settings(CLEANER_MIN_BATCH_SIZE=2)
+    def test_batches(self):
+        for n in xrange(5):
+            self.store('foo', [], 60, n)
+
+        self.cleaner.batch_size = 2
+        self.assertEquals(self.cleaner.clean(), 6)
+        self.assertEquals(Event.objects.count(), 0)
+        self.assertEquals(Group.objects.count(), 0)
+        self.assertEquals(EventType.objects.count(), 0)
+
+    @with_settings(CLEANER_TIME_BUDGET=0)
+    def test_budget(self):
+        self.store('foo', [], 60)
+
+        self.assertEquals(self.cleaner.clean(), 0)
+        self.assertEquals(self.cleaner.backlog, {Event: 1, Group: 1})
+
+    @with_settings(CLEANER_MIN_BATCH_SIZE=10, CLEANER_MAX_BATCH_SIZE=40)
+    def test_adapt_batch_size(self):
+        self.cleaner.batch_size = 10
+        self.cleaner._adapt_batch_size(10, 0.01, 1.0)
+        self.assertEquals(self.cleaner.batch_size, 20)
+        self.cleaner._adapt_batch_size(20, 0.01, 1.0)
+        self.cleaner._adapt_batch_size(40, 0.01, 1.0)
+        self.assertEquals(self.cleaner.batch_size, 40)
+
+        # a partial batch says nothing about a larger one
+        self.cleaner._adapt_batch_size(5, 0.3, 1.0)
+        self.assertEquals(self.cleaner.batch_size, 20)
+        self.cleaner._adapt_batch_size(5, 0.01, 1.0)
+        self.assertEquals(self.cleaner.batch_size, 20)
+
+    def test_lock(self):
+        self.assertTrue(app.db.acquire_lock('test', 'a', 60))
+        self.assertFalse(app.db.acquire_lock('test', 'b', 60))
+        # the owner extends its lock
+        self.assertTrue(app.db.acquire_lock('test', 'a', 60))
+
+        app.db.release_lock('test', 'b')
+        self.assertFalse(app.db.acquire_lock('test', 'b', 60))
+        app.db.release_lock('test', 'a')
+        self.assertTrue(app.db.acquire_lock('test', 'b', 60))
+
+    def test_lock_expires(self):
+        self.assertTrue(app.db.acquire_lock('test', 'a', 0.01))
+        time.sleep(0.05)
+        self.assertTrue(app.db.acquire_lock('test', 'b', 60))
+
+    def test_tick(self):
+        self.store('foo', [], 60)
+        other = Cleaner(app)
+
+        self.assertEquals(self.cleaner.tick(), 2)
+        self.assertTrue(self.cleaner.is_leader)
+
+        # only one cleaner runs at a time
+        self.store('foo', [], 60, 1)
+        self.assertEquals(other.tick(), None)
+        self.assertFalse(other.is_leader)
+        self.assertEquals(Event.objects.count(), 1)
+
+        app.db.release_lock(LOCK_NAME, self.cleaner.owner)
+        self.assertEquals(other.tick(), 2)
+        self.assertTrue(other.is_leader)
+
+    @with_settings(TRUNCATE_AFTER=None)
+    def test_tick_disabled(self):
+        self.store('foo', [], 60)
+
+        self.assertEquals(self.cleaner.tick(), None)
+        self.assertEquals(Event.objects.count(), 1)
+
+class BulkPurgeTest(BaseTest):
+    def setUp(self):
+        super(BulkPurgeTest, self).setUp()
+        self.now = datetime.datetime.now().replace(microsecond=0)
+        self.stream = StringIO()
+
+    def store(self, message, tags, days):
+        return app.client.store(
+            'sentry.events.Message',
+            tags=tags,
+            date=self.now - datetime.timedelta(days=days),
+            time_spent=0,
+            data={
+                'sentry.interfaces.Message': {
+                    'message': message,
+                }
+            },
+            event_id='%s-%s' % (message, days),
+        )
+
+    def purge(self, days, **kwargs):
+        kwargs.setdefault('batch_size', 1)
+        kwargs.setdefault('workers', 2)
+        return BulkPurge(self.now - datetime.timedelta(days=days), stream=self.stream, **kwargs).run()
+
+    def test_purge(self):
+        for days in (60, 50, 40):
+            self.store('foo', [('server', 'a')], days)
+        self.store('bar', [('server', 'a')], 40)
+        new_event, new_group = self.store('bar', [('server', 'b')], 1)
+
+        self.assertEquals(self.purge(30), 5)
+
+        self.assertEquals([e.pk for e in Event.objects.all()], [new_event.pk])
+        self.assertEquals([g.pk for g in Group.objects.all()], [new_group.pk])
+        self.assertEquals(Tag.objects.filter(hash=Tag.get_hash('server', 'a'))[0].count, 1)
+        self.assertTrue('events: 4 of 4 deleted' in self.stream.getvalue())
+        self.assertTrue('groups: 1 of 1 deleted' in self.stream.getvalue())
+
+        # running it again finds nothing left
+        self.assertEquals(self.purge(30), 0)
+
+    def test_purge_since(self):
+        old_event, old_group = self.store('foo', [], 60)
+        self.store('foo', [], 50)
+        self.store('bar', [], 45)
+
+        self.assertEquals(self.purge(30, since=self.now - datetime.timedelta(days=55)), 3)
+
+        # foo still has an event before the range, so it is kept
+        self.assertEquals([e.pk for e in Event.objects.all()], [old_event.pk])
+        self.assertEquals([g.pk for g in Group.objects.all()], [old_group.pk])
+
+    def test_purge_tags(self):
+        self.store('foo', [('server', 'a')], 60)
+        self.store('foo', [('server', 'a')], 50)
+        self.store('bar', [('server', 'a'), ('site', 'x')], 50)
+        event, group = self.store('baz', [('server', 'b')], 60)
+
+        self.assertEquals(self.purge(30, tags=[('server', 'a'), ('site', 'x')]), 2)
+        self.assertEquals(Group.objects.count(), 2)
+        self.assertEquals(Event.objects.count(), 3)
+
+        self.assertEquals(self.purge(30, tags=[('server', 'a')]), 3)
+        self.assertEquals([e.pk for e in Event.objects.all()], [event.pk])
+        self.assertEquals([g.pk for g in Group.objects.all()], [group.pk])
+        self.assertEquals(group.get_relations(Event), [event])
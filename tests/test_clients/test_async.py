@@ -0,0 +1,164 @@
+from .. import BaseTest, with_settings
+
+import os
+import shutil
+import tempfile
+import threading
+import urllib2
+
+from sentry.client.async import AsyncSentryClient
+
+class RecordingAsyncSentryClient(AsyncSentryClient):
+    def __init__(self, *args, **kwargs):
+        self.batches = []
+        super(RecordingAsyncSentryClient, self).__init__(*args, **kwargs)
+
+    def send_many(self, event_list):
+        self.batches.append([e['event_id'] for e in event_list])
+
+    def send_sync(self, **kwargs):
+        self.batches.append([kwargs['event_id']])
+
+class StoppedAsyncSentryClient(RecordingAsyncSentryClient):
+    # never starts the worker thread so that the queue can fill up
+    def start(self):
+        pass
+
+class BlockingAsyncSentryClient(RecordingAsyncSentryClient):
+    # keeps the worker thread busy with the first event until released
+    def __init__(self, *args, **kwargs):
+        self.busy = threading.Event()
+        self.release = threading.Event()
+        super(BlockingAsyncSentryClient, self).__init__(*args, **kwargs)
+
+    def send_sync(self, **kwargs):
+        self.busy.set()
+        self.release.wait()
+        super(BlockingAsyncSentryClient, self).send_sync(**kwargs)
+
+class FailingRemoteAsyncSentryClient(AsyncSentryClient):
+    def send_remote(self, url, data, headers=None):
+        raise urllib2.URLError('down')
+
+    def log_failed(self, data):
+        pass
+
+SPOOL_DIR = os.path.join(tempfile.gettempdir(), 'sentry-test-async-spool')
+
+class AsyncClientTest(BaseTest):
+    def tearDown(self):
+        shutil.rmtree(SPOOL_DIR, ignore_errors=True)
+        super(AsyncClientTest, self).tearDown()
+
+    @with_settings(ASYNC_BATCH_SIZE=3, ASYNC_BATCH_INTERVAL=0.5)
+    def test_batches(self):
+        client = RecordingAsyncSentryClient()
+        for n in xrange(7):
+            client.send(event_id=n)
+        client.stop()
+
+        self.assertEquals(sum(client.batches, []), range(7))
+        self.assertTrue(all(len(b) <= 3 for b in client.batches))
+        self.assertTrue(len(client.batches) < 7)
+
+        stats = client.get_stats()
+        self.assertEquals(stats['queued'], 7)
+        self.assertEquals(stats['sent'], 7)
+        self.assertEquals(stats['dropped'], 0)
+        self.assertEquals(stats['pending'], 0)
+
+    @with_settings(ASYNC_QUEUE_SIZE=2, ASYNC_OVERFLOW='drop_oldest')
+    def test_drop_oldest(self):
+        client = StoppedAsyncSentryClient()
+        for n in xrange(5):
+            client.send(event_id=n)
+
+        self.assertEquals([client.queue.get_nowait()['event_id'] for n in xrange(2)], [3, 4])
+        self.assertEquals(client.get_stats()['dropped'], 3)
+
+    @with_settings(ASYNC_QUEUE_SIZE=2, ASYNC_OVERFLOW='drop_oldest', ASYNC_BATCH_SIZE=1)
+    def test_stop_drop_oldest(self):
+        client = BlockingAsyncSentryClient()
+        client.send(event_id=0)
+        client.busy.wait()
+        client.send(event_id=1)
+
+        stopper = threading.Thread(target=client.stop)
+        stopper.start()
+        while not client._stopping.isSet():
+            pass
+        # pushes the terminator out of the full queue
+        client.send(event_id=2)
+        client.send(event_id=3)
+        client.release.set()
+        stopper.join(5)
+
+        self.assertFalse(stopper.isAlive())
+        self.assertEquals(sum(client.batches, []), [0, 2, 3])
+        stats = client.get_stats()
+        self.assertEquals(stats['dropped'], 1)
+        self.assertEquals(stats['sent'], 3)
+
+    @with_settings(ASYNC_BATCH_SIZE=1)
+    def test_stop_timeout(self):
+        client = BlockingAsyncSentryClient()
+        client.send(event_id=0)
+        client.busy.wait()
+
+        self.assertFalse(client.stop(timeout=0.01))
+        client.release.set()
+        self.assertTrue(client.stop())
+        self.assertEquals(client.batches, [[0]])
+
+    @with_settings(ASYNC_QUEUE_SIZE=1, ASYNC_OVERFLOW='drop_oldest')
+    def test_drop_oldest_modules(self):
+        client = StoppedAsyncSentryClient()
+        client.capture('Message', message='foo')
+        # drops the only event with the modules
+        client.capture('Message', message='bar')
+        client.capture('Message', message='baz')
+
+        data = client.queue.get_nowait()['data']
+        self.assertTrue('modules' in data)
+
+    @with_settings(ASYNC_QUEUE_SIZE=2, ASYNC_OVERFLOW='drop_newest')
+    def test_drop_newest(self):
+        client = StoppedAsyncSentryClient()
+        for n in xrange(5):
+            client.send(event_id=n)
+
+        self.assertEquals([client.queue.get_nowait()['event_id'] for n in xrange(2)], [0, 1])
+        self.assertEquals(client.get_stats()['dropped'], 3)
+
+    @with_settings(ASYNC_QUEUE_SIZE=2, ASYNC_OVERFLOW='block', ASYNC_BLOCK_TIMEOUT=0.01)
+    def test_block(self):
+        client = StoppedAsyncSentryClient()
+        for n in xrange(3):
+            client.send(event_id=n)
+
+        self.assertEquals([client.queue.get_nowait()['event_id'] for n in xrange(2)], [0, 1])
+        stats = client.get_stats()
+        self.assertEquals(stats['queued'], 2)
+        self.assertEquals(stats['dropped'], 1)
+
+    @with_settings(REMOTES=['http://a/'])
+    def test_remote_failed(self):
+        client = FailingRemoteAsyncSentryClient()
+        client.send(message='foo')
+        client.stop()
+
+        stats = client.get_stats()
+        self.assertEquals(stats['sent'], 0)
+        self.assertEquals(stats['spooled'], 0)
+        self.assertEquals(stats['dropped'], 1)
+
+    @with_settings(REMOTES=['http://a/'], SPOOL_DIR=SPOOL_DIR, SPOOL_RETRY_INTERVAL=60)
+    def test_remote_spooled(self):
+        client = FailingRemoteAsyncSentryClient()
+        client.send(message='foo')
+        client.stop()
+
+        stats = client.get_stats()
+        self.assertEquals(stats['sent'], 0)
+        self.assertEquals(stats['spooled'], 1)
+        self.assertEquals(stats['dropped'], 0)
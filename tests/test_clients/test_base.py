@@ -1,8 +1,13 @@
-from .. import BaseTest
+from .. import BaseTest, with_settings
+
+import time
+import unittest2
 
 from sentry import app
 from sentry.client import ClientProxy
+from sentry.client.base import SentryClient
 from sentry.client.logging import LoggingSentryClient
+from sentry.utils.cache import ThrashingCache
 
 class ClientTest(BaseTest):
     def test_client_proxy(self):
@@ -17,3 +22,109 @@ class ClientTest(BaseTest):
         
         self.assertFalse(isinstance(proxy._ClientProxy__get_client(), LoggingSentryClient))
         self.assertEquals(proxy._ClientProxy__get_client(), proxy._ClientProxy__get_client())
+
+class RecordingSentryClient(SentryClient):
+    def __init__(self, *args, **kwargs):
+        super(RecordingSentryClient, self).__init__(*args, **kwargs)
+        self.events = []
+
+    def send(self, **kwargs):
+        self.events.append(kwargs)
+
+class ThrashingTest(BaseTest):
+    @with_settings(THRASHING_LIMIT=3, THRASHING_TIMEOUT=60)
+    def test_suppresses_repeats(self):
+        client = RecordingSentryClient()
+        for n in xrange(10):
+            client.capture('Message', message='foo %s', params=['bar'])
+        client.capture('Message', message='foo %s', params=['baz'])
+
+        self.assertEquals(len(client.events), 4)
+
+    @with_settings(THRASHING_LIMIT=3, THRASHING_TIMEOUT=60)
+    def test_suppresses_exceptions_before_capture(self):
+        client = RecordingSentryClient()
+        for n in xrange(10):
+            try:
+                raise ValueError('foo')
+            except ValueError:
+                event_id = client.capture('Exception')
+            if n < 3:
+                self.assertTrue(event_id)
+            else:
+                self.assertEquals(event_id, None)
+
+        self.assertEquals(len(client.events), 3)
+
+    @with_settings(THRASHING_LIMIT=1, THRASHING_TIMEOUT=60)
+    def test_keeps_exceptions_with_distinct_values(self):
+        client = RecordingSentryClient()
+        for key in ('a', 'b', 'a'):
+            try:
+                {}[key]
+            except KeyError:
+                client.capture('Exception')
+
+        self.assertEquals(len(client.events), 2)
+        values = [e['data']['sentry.interfaces.Exception']['value'] for e in client.events]
+        self.assertEquals(values, ["'a'", "'b'"])
+
+    @with_settings(THRASHING_LIMIT=2, THRASHING_TIMEOUT=0.01)
+    def test_reports_suppressed_count(self):
+        client = RecordingSentryClient()
+        for n in xrange(5):
+            client.capture('Message', message='foo')
+
+        time.sleep(0.02)
+        client.capture('Message', message='foo')
+
+        self.assertEquals(len(client.events), 3)
+        self.assertFalse('suppressed' in client.events[1]['data'])
+        self.assertEquals(client.events[2]['data']['suppressed'], 3)
+
+    @with_settings(THRASHING_LIMIT=0)
+    def test_disabled(self):
+        client = RecordingSentryClient()
+        for n in xrange(20):
+            client.capture('Message', message='foo')
+
+        self.assertEquals(len(client.events), 20)
+
+class VersionsTest(BaseTest):
+    def test_modules_sent_once(self):
+        client = RecordingSentryClient()
+        client.capture('Message', message='foo')
+        client.capture('Message', message='bar')
+
+        first, second = [e['data'] for e in client.events]
+        self.assertEquals(first['modules_hash'], second['modules_hash'])
+        self.assertTrue('sentry' in first['modules'])
+        self.assertFalse('modules' in second)
+
+    @with_settings(MODULES_INTERVAL=0)
+    def test_modules_resent(self):
+        client = RecordingSentryClient()
+        client.capture('Message', message='foo')
+        client.capture('Message', message='bar')
+
+        self.assertTrue(all('modules' in e['data'] for e in client.events))
+
+    def test_culprit_version(self):
+        client = RecordingSentryClient()
+        client.capture('Message', message='foo', culprit='sentry.client.base.capture')
+
+        data = client.events[0]['data']
+        self.assertEquals(data['version'], ('sentry', data['modules']['sentry']))
+
+class ThrashingCacheTest(unittest2.TestCase):
+    def test_evicts_least_recently_seen(self):
+        cache = ThrashingCache(max_size=2)
+        cache.check('a', 1, 60)
+        cache.check('b', 1, 60)
+        cache.check('a', 1, 60)
+        cache.check('c', 1, 60)
+
+        self.assertEquals(len(cache), 2)
+        self.assertTrue('a' in cache)
+        self.assertFalse('b' in cache)
+        self.assertEquals(cache.check('b', 1, 60), (True, 0))
@@ -0,0 +1,215 @@
+from .. import BaseTest, with_settings
+
+import base64
+import fcntl
+import os
+import shutil
+import simplejson
+import tempfile
+import time
+import urllib2
+
+from StringIO import StringIO
+
+from sentry.client.base import SentryClient
+from sentry.client.spool import Spool
+
+class SpoolTest(BaseTest):
+    def setUp(self):
+        super(SpoolTest, self).setUp()
+        self.path = tempfile.mkdtemp()
+        self.sent = []
+        self.fail_on = None
+        # replayed by hand rather than from the thread
+        self.spool = Spool(self.path, self.send, retry_interval=60)
+
+    def tearDown(self):
+        self.spool.stop()
+        self.spool.close()
+        shutil.rmtree(self.path)
+        super(SpoolTest, self).tearDown()
+
+    def send(self, url, payload):
+        if payload == self.fail_on:
+            raise urllib2.URLError('down')
+        self.sent.append((url, payload))
+
+    def test_replay(self):
+        for n in xrange(3):
+            self.assertTrue(self.spool.write('http://a/', 'event%d' % n))
+        self.spool.write('http://b/', 'event3')
+
+        self.assertEquals(self.spool.replay(), 4)
+        self.assertEquals(self.sent, [('http://a/', 'event0'), ('http://a/', 'event1'),
+                                      ('http://a/', 'event2'), ('http://b/', 'event3')])
+        self.assertEquals(os.listdir(self.path), [])
+
+    def test_replay_failure(self):
+        for n in xrange(3):
+            self.spool.write('http://a/', 'event%d' % n)
+
+        self.fail_on = 'event1'
+        self.assertRaises(urllib2.URLError, self.spool.replay)
+        self.assertEquals(self.sent, [('http://a/', 'event0')])
+
+        # the remote is back, and delivered events are not sent again
+        self.fail_on = None
+        self.spool.write('http://a/', 'event3')
+        self.assertEquals(self.spool.replay(), 3)
+        self.assertEquals([p for u, p in self.sent], ['event0', 'event1', 'event2', 'event3'])
+
+    def test_segments(self):
+        self.spool.segment_size = 10
+        for n in xrange(3):
+            self.spool.write('http://a/', 'event%d' % n)
+        self.assertEquals(len(os.listdir(self.path)), 3)
+
+        self.assertEquals(self.spool.replay(), 3)
+        self.assertEquals([p for u, p in self.sent], ['event0', 'event1', 'event2'])
+
+    def test_max_size(self):
+        self.spool.max_size = 50
+        self.assertTrue(self.spool.write('http://a/', 'event0'))
+        self.assertTrue(self.spool.write('http://a/', 'event1'))
+        self.assertFalse(self.spool.write('http://a/', 'event2'))
+
+        self.spool.replay()
+        self.assertTrue(self.spool.write('http://a/', 'event3'))
+
+    def test_corrupt(self):
+        self.spool.write('http://a/', 'event0')
+        self.spool.write('http://a/', 'event1')
+        self.spool.rotate()
+        path = os.path.join(self.path, os.listdir(self.path)[0])
+        # a crash while writing the last record
+        os.ftruncate(os.open(path, os.O_RDWR), os.path.getsize(path) - 2)
+
+        self.assertEquals(self.spool.replay(), 1)
+        self.assertEquals(self.sent, [('http://a/', 'event0')])
+        self.assertEquals(os.listdir(self.path), [])
+
+    def test_locked_segment(self):
+        self.spool.write('http://a/', 'event0')
+        self.spool.rotate()
+
+        # another process is writing (or replaying) the segment
+        fp = open(os.path.join(self.path, os.listdir(self.path)[0]))
+        fcntl.flock(fp.fileno(), fcntl.LOCK_EX)
+        other = Spool(self.path, self.send, retry_interval=60)
+        self.assertEquals(other.replay(), 0)
+
+        fp.close()
+        self.assertEquals(other.replay(), 1)
+
+    def test_replay_open_segment(self):
+        self.spool.write('http://a/', 'event0')
+
+        # a replay in another process while the segment is being written
+        other = Spool(self.path, self.send, retry_interval=60)
+        self.assertEquals(other.replay(), 0)
+        self.assertEquals(len(os.listdir(self.path)), 1)
+
+        self.spool.write('http://a/', 'event1')
+        self.assertEquals(self.spool.replay(), 2)
+        self.assertEquals([p for u, p in self.sent], ['event0', 'event1'])
+
+    def test_replay_new_segment(self):
+        # a segment which has been created but not locked yet
+        fp = open(os.path.join(self.path, '1-1.tmp'), 'ab')
+        other = Spool(self.path, self.send, retry_interval=60)
+        self.assertEquals(other.replay(), 0)
+        self.assertEquals(os.listdir(self.path), ['1-1.tmp'])
+        fp.close()
+
+    def test_stop(self):
+        self.spool.write('http://a/', 'event0')
+        thread = self.spool._thread
+
+        # waiting out retry_interval
+        self.spool.stop()
+        self.assertFalse(thread.isAlive())
+        self.assertEquals(self.sent, [])
+
+class FailingRemoteSentryClient(SentryClient):
+    def __init__(self, *args, **kwargs):
+        super(FailingRemoteSentryClient, self).__init__(*args, **kwargs)
+        self.error = None
+        self.sent = []
+        self.failed = []
+
+    def send_remote(self, url, data, headers=None):
+        if self.error:
+            raise self.error
+        self.sent.append(simplejson.loads(base64.b64decode(data).decode('zlib')))
+        return 'ok'
+
+    def log_failed(self, data):
+        self.failed.append(data)
+
+SPOOL_DIR = os.path.join(tempfile.gettempdir(), 'sentry-test-spool')
+
+class SpoolingClientTest(BaseTest):
+    def setUp(self):
+        super(SpoolingClientTest, self).setUp()
+        self.client = FailingRemoteSentryClient()
+
+    def tearDown(self):
+        if self.client._spool is not None:
+            self.client._spool.stop()
+        shutil.rmtree(SPOOL_DIR, ignore_errors=True)
+        super(SpoolingClientTest, self).tearDown()
+
+    @with_settings(REMOTES=['http://a/'], SPOOL_DIR=SPOOL_DIR, SPOOL_RETRY_INTERVAL=60)
+    def test_spool(self):
+        self.client.error = urllib2.URLError('down')
+        self.client.send(message='foo')
+        self.client.send(message='bar')
+        self.assertEquals(self.client.sent, [])
+        self.assertEquals(self.client.failed, [])
+
+        self.client.error = None
+        self.assertEquals(self.client.get_spool().replay(), 2)
+        self.assertEquals(self.client.sent, [{'message': 'foo'}, {'message': 'bar'}])
+
+    @with_settings(REMOTES=['http://a/'], SPOOL_DIR=SPOOL_DIR, SPOOL_RETRY_INTERVAL=60)
+    def test_rejected(self):
+        self.client.error = urllib2.HTTPError('http://a/', 400, 'Bad Request', {}, StringIO(''))
+        self.client.send(message='foo')
+
+        # the server will never accept it, so it is not spooled
+        self.assertEquals(self.client.failed, [{'message': 'foo'}])
+        self.assertEquals(self.client.get_spool().replay(), 0)
+
+    @with_settings(REMOTES=['http://a/'])
+    def test_rejected_modules(self):
+        self.client.error = urllib2.HTTPError('http://a/', 400, 'Bad Request', {}, StringIO(''))
+        self.client.capture('Message', message='foo')
+        self.client.error = None
+        self.client.capture('Message', message='bar')
+
+        # the server never got the modules of the first event
+        self.assertTrue('modules' in self.client.failed[0]['data'])
+        self.assertTrue('modules' in self.client.sent[0]['data'])
+
+    @with_settings(REMOTES=['http://a/'])
+    def test_no_spool(self):
+        self.client.error = urllib2.URLError('down')
+        self.client.send(message='foo')
+
+        self.assertEquals(self.client.get_spool(), None)
+        self.assertEquals(self.client.failed, [{'message': 'foo'}])
+
+    @with_settings(REMOTES=['http://a/'], SPOOL_DIR=SPOOL_DIR, SPOOL_RETRY_INTERVAL=0.01)
+    def test_replay_on_start(self):
+        # left by a process which has since exited
+        spool = Spool(SPOOL_DIR, None, retry_interval=60)
+        spool.write('http://a/', simplejson.dumps({'message': 'foo'}))
+        spool.stop()
+        spool.rotate()
+
+        self.client = FailingRemoteSentryClient()
+        deadline = time.time() + 5
+        while not self.client.sent and time.time() < deadline:
+            time.sleep(0.01)
+
+        self.assertEquals(self.client.sent, [{'message': 'foo'}])
@@ -0,0 +1,144 @@
+from . import BaseTest, requires_redis, with_settings
+
+import base64
+import os
+import signal
+import simplejson
+import socket
+import time
+import urllib2
+
+import sentry.collector.server
+import sentry.collector.views
+from sentry import app
+from sentry.collector.server import PreforkServer, get_rss
+from sentry.models import Event
+
+class RSSTest(BaseTest):
+    def test_get_rss(self):
+        if not os.path.exists('/proc/self/statm'):
+            self.assertEquals(get_rss(), None)
+            return
+        self.assertTrue(get_rss() > 0)
+
+class ExitingWorker(object):
+    def __init__(self, *args):
+        pass
+
+    def run(self):
+        raise SystemExit(0)
+
+class SpawnWorkerTest(BaseTest):
+    def setUp(self):
+        super(SpawnWorkerTest, self).setUp()
+        self.worker_cls = sentry.collector.server.Worker
+        sentry.collector.server.Worker = ExitingWorker
+
+    def tearDown(self):
+        sentry.collector.server.Worker = self.worker_cls
+        super(SpawnWorkerTest, self).tearDown()
+
+    def test_worker_never_returns(self):
+        server = PreforkServer(app, '127.0.0.1', 0)
+        server.spawn_worker()
+        # only the master gets here, a worker returning would run on as well
+        pid = server.workers.keys()[0]
+        os.close(server.workers[pid].fd)
+        pid, status = os.waitpid(pid, 0)
+        self.assertTrue(os.WIFEXITED(status))
+        self.assertEquals(os.WEXITSTATUS(status), 1)
+
+@requires_redis
+class PreforkServerTest(BaseTest):
+    def setUp(self):
+        super(PreforkServerTest, self).setUp()
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        self.port = sock.getsockname()[1]
+        sock.close()
+        self.pid = None
+
+    def tearDown(self):
+        if self.pid:
+            os.kill(self.pid, signal.SIGKILL)
+            os.waitpid(self.pid, 0)
+        super(PreforkServerTest, self).tearDown()
+
+    def start(self, **kwargs):
+        self.pid = os.fork()
+        if not self.pid:
+            status = 0
+            try:
+                PreforkServer(app, '127.0.0.1', self.port, **kwargs).run()
+            except BaseException:
+                status = 1
+            os._exit(status)
+
+        for n in xrange(50):
+            try:
+                socket.create_connection(('127.0.0.1', self.port)).close()
+                return
+            except socket.error:
+                time.sleep(0.1)
+        self.fail('The server did not start')
+
+    def stop(self):
+        os.kill(self.pid, signal.SIGTERM)
+        pid, status = os.waitpid(self.pid, 0)
+        self.pid = None
+        return status
+
+    def post(self, message):
+        data = base64.b64encode(simplejson.dumps({
+            'event_type': 'sentry.events.Message',
+            'tags': [['server', 'sentry.local']],
+            'date': '2010-06-18T22:31:45',
+            'time_spent': 0.0,
+            'event_id': message,
+            'data': {
+                'sentry.interfaces.Message': {
+                    'message': message,
+                },
+            },
+        }).encode('zlib'))
+        request = urllib2.Request('http://127.0.0.1:%d/api/store/' % self.port, data,
+                                  {'Content-Type': 'application/octet-stream'})
+        return urllib2.urlopen(request).read()
+
+    def get_workers(self, count):
+        # waits for the server to have ``count`` workers
+        for n in xrange(50):
+            workers = set(os.popen('pgrep -P %d' % self.pid).read().split())
+            if len(workers) == count:
+                return workers
+            time.sleep(0.1)
+        self.fail('The server has %d workers rather than %d' % (len(workers), count))
+
+    @with_settings(PUBLIC_WRITES=True)
+    def test_serve(self):
+        self.start(workers=2, health_interval=0.1)
+        workers = self.get_workers(2)
+
+        for n in xrange(4):
+            self.assertEquals(self.post('event%d' % n), 'event%d' % n)
+        self.assertEquals(Event.objects.count(), 4)
+
+        # workers are replaced on SIGHUP, without closing the socket
+        os.kill(self.pid, signal.SIGHUP)
+        self.assertEquals(self.post('event4'), 'event4')
+        time.sleep(0.5)
+        self.assertFalse(workers & self.get_workers(2))
+
+        self.assertEquals(self.stop(), 0)
+
+    @with_settings(PUBLIC_WRITES=True)
+    def test_replace_worker(self):
+        self.start(workers=1, health_interval=0.1)
+        worker = self.get_workers(1).pop()
+
+        os.kill(int(worker), signal.SIGKILL)
+        time.sleep(1.5)
+        self.assertNotEquals(self.get_workers(1), set([worker]))
+        self.assertEquals(self.post('event'), 'event')
+
+        self.assertEquals(self.stop(), 0)
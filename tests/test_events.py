@@ -1,10 +1,17 @@
-from . import BaseTest
+from . import BaseTest, with_settings
 
 import datetime
+import os
 import sys
+import tempfile
+import threading
+import uuid
 
-from sentry import app, capture
-from sentry.models import Event, Tag, Group
+from sentry import app, capture, events
+from sentry.client.base import SentryClient
+from sentry.db import models
+from sentry.db.backends.base import SentryBackend
+from sentry.models import Event, Tag, Group, ModuleManifest, manifest_cache
 
 class SentryTest(BaseTest):
     # Some quick ugly high level tests to get shit working fast
@@ -182,6 +189,46 @@ class SentryTest(BaseTest):
 
         self.assertEquals(len(groups), 2)
 
+    def test_store_concurrent_groups(self):
+        now = datetime.datetime.now()
+
+        def store(n):
+            app.client.store(
+                'sentry.events.Message',
+                tags=(
+                    ('server', 'foo.bar'),
+                ),
+                date=now + datetime.timedelta(seconds=n),
+                time_spent=10,
+                data={
+                    'sentry.interfaces.Message': {
+                        'message': 'hello world'
+                    }
+                },
+                event_id='foobar%d' % n,
+            )
+
+        threads = [threading.Thread(target=store, args=(n,)) for n in xrange(10)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        groups = Group.objects.all()
+
+        self.assertEquals(len(groups), 1)
+
+        group = groups[0]
+
+        self.assertEquals(group.count, 10)
+        self.assertEquals(group.time_spent, 100)
+        self.assertEquals(len(group.get_relations(Event)), 10)
+
+        tags = Tag.objects.all()
+
+        self.assertEquals(len(tags), 1)
+        self.assertEquals(tags[0].count, 1)
+
     def test_tags(self):
         event_id = capture('Message', message='foo', tags=[('level', 'info')])
 
@@ -326,3 +373,164 @@ class SentryTest(BaseTest):
         event_data = event.data['sentry.interfaces.Stacktrace']
         frame = event_data['frames'][0]
         self.assertEquals(frame['vars']['password'], '****************')
+
+class ModuleManifestTest(BaseTest):
+    def store(self, event_id, modules=None):
+        data = {
+            'sentry.interfaces.Message': {
+                'message': 'foo',
+            },
+        }
+        if modules is not None:
+            data['modules'] = modules
+        return app.client.store('sentry.events.Message', tags=[], data=data, date=datetime.datetime.now(),
+                                time_spent=0, event_id=event_id)[0]
+
+    def test_modules_stored_once(self):
+        modules = {'foo': '1.0', 'bar': '2.0'}
+        event = self.store('a', modules)
+        other = self.store('b', dict(modules))
+
+        data = Event.objects.get_meta(event.pk)
+        self.assertFalse('modules' in data)
+        self.assertEquals(data['modules_hash'], Event.objects.get_meta(other.pk)['modules_hash'])
+        self.assertEquals(ModuleManifest.objects.get_meta(data['modules_hash'])['modules'], modules)
+
+        manifest_cache.clear()
+        self.assertEquals(Event.objects.get(event.pk).get_modules(), modules)
+        self.assertTrue(data['modules_hash'] in manifest_cache)
+
+    def test_client_sends_modules_once(self):
+        client = SentryClient()
+        first = Event.objects.get(client.capture('Message', message='foo'))
+        second = Event.objects.get(client.capture('Message', message='bar'))
+
+        self.assertTrue('sentry' in first.get_modules())
+        self.assertEquals(second.get_modules(), first.get_modules())
+
+    def test_legacy_modules(self):
+        event = self.store('a')
+        event.set_meta(modules={'foo': '1.0'})
+        self.assertEquals(event.get_modules(), {'foo': '1.0'})
+
+        self.assertEquals(self.store('b').get_modules(), {})
+
+class SourceCacheTest(BaseTest):
+    def setUp(self):
+        super(SourceCacheTest, self).setUp()
+        events.source_cache.clear()
+        fd, self.filename = tempfile.mkstemp(suffix='.py')
+        os.write(fd, '# -*- coding: utf-8 -*-\nfoo = 1\nbar = 2\nbaz = "\xc3\xa9"\n')
+        os.close(fd)
+
+    def tearDown(self):
+        os.unlink(self.filename)
+        super(SourceCacheTest, self).tearDown()
+
+    def get_lines(self, lineno=2):
+        return events.Exception()._get_lines_from_file(self.filename, lineno, 1)
+
+    def test_reads_file_once(self):
+        calls = []
+        read_source = events.read_source
+        def counted(*args, **kwargs):
+            calls.append(args)
+            return read_source(*args, **kwargs)
+
+        events.read_source = counted
+        try:
+            self.assertEquals(self.get_lines(), (1, [u'foo = 1'], u'bar = 2', []))
+            self.assertEquals(self.get_lines(3), (2, [u'bar = 2'], u'baz = "\xe9"', []))
+        finally:
+            events.read_source = read_source
+
+        self.assertEquals(len(calls), 1)
+
+    def test_modified_file(self):
+        self.get_lines()
+
+        f = open(self.filename, 'w')
+        f.write('foo = 1\nbar = 3\n')
+        f.close()
+        mtime = os.stat(self.filename).st_mtime + 1
+        os.utime(self.filename, (mtime, mtime))
+
+        self.assertEquals(self.get_lines(1), (0, [u'foo = 1'], u'bar = 3', []))
+
+    @with_settings(SOURCE_CACHE_SIZE=10)
+    def test_evicts_by_size(self):
+        self.get_lines()
+
+        self.assertEquals(len(events.source_cache), 0)
+
+    @with_settings(SOURCE_CACHE_LINECACHE=True)
+    def test_linecache(self):
+        self.assertEquals(self.get_lines(3), (2, [u'bar = 2'], u'baz = "\xe9"', []))
+        self.assertEquals(len(events.source_cache), 0)
+
+class TagFilterTest(BaseTest):
+    def store(self, message, tags, seconds):
+        return app.client.store(
+            'sentry.events.Message',
+            tags=tags,
+            date=datetime.datetime(2011, 6, 18, 22, 31, seconds),
+            time_spent=0,
+            data={
+                'sentry.interfaces.Message': {
+                    'message': message,
+                }
+            },
+            event_id=uuid.uuid4().hex,
+        )
+
+    def assertMessages(self, queryset, messages):
+        self.assertEquals([g.message for g in queryset], messages)
+
+    def test_filter_tags(self):
+        self.store('foo', [('server', 'a'), ('level', 'error')], 1)
+        self.store('bar', [('server', 'b'), ('level', 'error')], 2)
+        self.store('baz', [('server', 'a'), ('level', 'info')], 3)
+        self.store('foo', [('server', 'c')], 4)
+
+        self.assertMessages(Group.objects.order_by('-last_seen').filter_tags(server='a'), ['foo', 'baz'])
+        self.assertMessages(Group.objects.order_by('-last_seen').filter_tags(server='c'), ['foo'])
+        self.assertMessages(Group.objects.order_by('-last_seen').filter_tags(level='error'), ['foo', 'bar'])
+        self.assertMessages(Group.objects.order_by('first_seen').filter_tags(level='error'), ['foo', 'bar'])
+        self.assertMessages(Group.objects.order_by('-count').filter_tags(level='error'), ['foo', 'bar'])
+        self.assertMessages(Group.objects.order_by('-last_seen').filter_tags(server='a', level='error'), ['foo'])
+        self.assertMessages(Group.objects.order_by('-last_seen').filter_tags(server='b', level='info'), [])
+        self.assertMessages(Group.objects.order_by('-last_seen').filter_tags(server='d'), [])
+
+        self.assertEquals(Group.objects.count(), 3)
+        self.assertEquals(Group.objects.filter_tags(server='a').count(), 2)
+        self.assertEquals(Group.objects.filter_tags(server='a', level='error').count(), 1)
+        self.assertEquals(Group.objects.filter_tags(server='d').count(), 0)
+
+    def test_filter_tags_without_script(self):
+        store_event = app.db.store_event
+        app.db.store_event = lambda *args: SentryBackend.store_event(app.db, *args)
+        try:
+            self.test_filter_tags()
+        finally:
+            app.db.store_event = store_event
+
+    def test_delete(self):
+        event, group = self.store('foo', [('server', 'a')], 1)
+        # only the instance itself, as Group.delete also updates counters
+        models.Model.delete(group)
+
+        self.assertMessages(Group.objects.filter_tags(server='a'), [])
+        self.assertEquals(Group.objects.filter_tags(server='a').count(), 0)
+
+    def test_count_is_cached(self):
+        self.store('foo', [('server', 'a')], 1)
+        self.assertEquals(Group.objects.filter_tags(server='a').count(), 1)
+
+        app.db.count = lambda *args, **kwargs: 0
+        try:
+            self.assertEquals(Group.objects.filter_tags(server='a').count(), 1)
+        finally:
+            del app.db.count
+
+        self.store('bar', [('server', 'a')], 2)
+        self.assertEquals(Group.objects.filter_tags(server='a').count(), 2)
@@ -1,6 +1,14 @@
 from . import BaseTest
 
+import cPickle as pickle
+import datetime
+import simplejson
+import unittest2
+
+from sentry import app
 from sentry.db import models
+from sentry.db.encoding import encode, decode, LazyData, MARSHAL, MARSHAL_ZLIB, \
+                               MARSHAL_ZLIB_DICT
 
 class TestModel(models.Model):
     str_ = models.String()
@@ -134,4 +142,108 @@ class ORMTest(BaseTest):
         self.assertEquals(inst.str_, '')
         self.assertEquals(inst.int_, 0)
         self.assertEquals(inst.float_, 1.0)
-        self.assertEquals(len(inst.list_), 0)
\ No newline at end of file
+        self.assertEquals(len(inst.list_), 0)
+
+    def test_meta(self):
+        inst = TestModel.objects.create(str_='foo')
+        frames = [{'filename': 'foo.py', 'lineno': n, 'context_line': 'raise ValueError()'} for n in xrange(50)]
+        inst.set_meta(frames=frames, params=('foo', 1))
+
+        meta = inst.get_meta()
+        self.assertEquals(meta['frames'], frames)
+        # values read back as they would from JSON
+        self.assertEquals(meta['params'], ['foo', 1])
+
+        raw = app.db.get_meta(TestModel, inst.pk)
+        self.assertEquals(raw['frames'][:1], MARSHAL_ZLIB_DICT)
+        self.assertTrue(len(raw['frames']) < len(simplejson.dumps(frames)) / 4)
+
+    def test_legacy_values(self):
+        inst = TestModel.objects.create(str_='foo')
+        app.db.set_meta(TestModel, inst.pk, foo=simplejson.dumps({'bar': [1, 2]}))
+        app.db.set(TestModel, inst.pk, list_=pickle.dumps([('a', 'b')]))
+
+        self.assertEquals(inst.get_meta(), {'foo': {'bar': [1, 2]}})
+        self.assertEquals(TestModel.objects.get(inst.pk).list_, [('a', 'b')])
+
+    def test_data_is_cached(self):
+        inst = TestModel.objects.create(str_='foo')
+        inst.set_meta(foo=1)
+        self.assertEquals(inst.data['foo'], 1)
+
+        TestModel.objects.set_meta(inst.pk, foo=2)
+        self.assertEquals(inst.data['foo'], 1)
+        self.assertEquals(TestModel.objects.get(inst.pk).data['foo'], 2)
+
+        inst.set_meta(foo=3)
+        self.assertEquals(inst.data['foo'], 3)
+
+    def test_prefetch_meta(self):
+        for n in xrange(3):
+            TestModel.objects.create(str_=str(n), int_=n).set_meta(foo=n)
+        instances = list(TestModel.objects.order_by('int_'))
+
+        TestModel.objects.prefetch_meta(instances)
+        app.db.get_meta = None
+        try:
+            self.assertEquals([i.data['foo'] for i in instances], [0, 1, 2])
+        finally:
+            del app.db.get_meta
+
+    def test_counts(self):
+        date = datetime.datetime(2011, 6, 18, 22, 31)
+        app.db.incr_counts(TestModel, [
+            ('foo', date.replace(second=5), 1),
+            ('foo', date.replace(second=50), 2),
+            ('foo', date.replace(hour=23), 1),
+            (None, date, 1),
+        ])
+
+        self.assertEquals(app.db.get_counts(TestModel, 'foo', 60, date.replace(minute=30), date.replace(minute=32)), [
+            (date.replace(minute=30), 0),
+            (date, 3),
+            (date.replace(minute=32), 0),
+        ])
+        self.assertEquals(app.db.get_counts(TestModel, 'foo', 3600, date, date.replace(hour=23)), [
+            (date.replace(minute=0), 3),
+            (date.replace(hour=23, minute=0), 1),
+        ])
+        self.assertEquals(app.db.get_counts(TestModel, None, 3600, date, date), [(date.replace(minute=0), 1)])
+        self.assertRaises(ValueError, app.db.get_counts, TestModel, 'foo', 10, date, date)
+
+class EncodingTest(unittest2.TestCase):
+    def test_formats(self):
+        small = {'foo': 'bar'}
+        large = ['foo %d' % n for n in xrange(100)]
+
+        self.assertEquals(encode(small)[:1], MARSHAL)
+        self.assertEquals(encode(large, 'zlib')[:1], MARSHAL_ZLIB)
+        self.assertEquals(encode(large)[:1], MARSHAL_ZLIB_DICT)
+        self.assertEquals(encode(large, None)[:1], MARSHAL)
+        for compression in (None, 'zlib', 'dictionary'):
+            self.assertEquals(decode(encode(small, compression)), small)
+            self.assertEquals(decode(encode(large, compression)), large)
+
+    def test_fallback(self):
+        value = [object()]
+        self.assertEquals(encode(value, fallback=lambda v: 'fallback'), 'fallback')
+        self.assertEquals(decode(u'[1]'), [1])
+
+    def test_lazy_data(self):
+        decoded = []
+        def decode(value):
+            decoded.append(value)
+            return int(value)
+
+        data = LazyData({'a': '1', 'b': '2'}, decode=decode)
+        self.assertEquals(sorted(data), ['a', 'b'])
+        self.assertTrue('a' in data)
+        self.assertEquals(decoded, [])
+
+        self.assertEquals(data['a'], 1)
+        self.assertEquals(data['a'], 1)
+        self.assertEquals(decoded, ['1'])
+
+        data['c'] = 3
+        self.assertEquals(data, {'a': 1, 'b': 2, 'c': 3})
+        self.assertEquals(decoded, ['1', '2'])
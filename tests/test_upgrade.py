@@ -0,0 +1,62 @@
+from . import BaseTest
+
+import datetime
+
+from sentry import app
+from sentry.core.upgrade import index_groups, upgrade
+from sentry.models import Group, Migration
+
+class UpgradeTest(BaseTest):
+    def create(self, n, tags, first_seen=None):
+        # as stored by a version which did not index tags or counts
+        date = datetime.datetime(2011, 6, 18, 22, 31, n)
+        group = Group.objects.create(type='foo', hash=str(n), count=n + 1, tags=tags,
+                                     first_seen=first_seen or date, last_seen=date)
+        Group.objects.remove_from_index(group.pk, 'count')
+        return group
+
+    def test_index_groups(self):
+        for n in xrange(3):
+            self.create(n, [('server', 'a')])
+        self.create(3, [('server', 'b')])
+        self.assertEquals(Group.objects.filter_tags(server='a').count(), 0)
+
+        upgrade()
+
+        self.assertEquals([g.hash for g in Group.objects.order_by('-count')], ['3', '2', '1', '0'])
+        self.assertEquals([g.hash for g in Group.objects.order_by('-last_seen').filter_tags(server='a')], ['2', '1', '0'])
+        self.assertEquals([g.hash for g in Group.objects.order_by('-count').filter_tags(server='b')], ['3'])
+        self.assertTrue(Migration.is_applied('index_groups'))
+
+    def test_runs_once(self):
+        upgrade()
+        self.create(0, [('server', 'a')])
+
+        upgrade()
+
+        self.assertEquals(Group.objects.filter_tags(server='a').count(), 0)
+
+    def test_pages_share_first_seen(self):
+        first_seen = datetime.datetime(2011, 6, 18, 22, 31)
+        for n in xrange(5):
+            self.create(n, [('server', 'a')], first_seen)
+
+        self.assertEquals(index_groups(batch_size=2), 5)
+        self.assertEquals(Group.objects.filter_tags(server='a').count(), 5)
+
+    def test_groups_purged_meanwhile(self):
+        groups = [self.create(n, [('server', 'a')]) for n in xrange(5)]
+
+        add_tags = app.db.add_tags
+        def purging_add_tags(schema, pk, tags):
+            # the cleaner purges the first group once it is indexed
+            add_tags(schema, pk, tags)
+            if pk == groups[0].pk:
+                app.db.purge(Group, [pk])
+        app.db.add_tags = purging_add_tags
+        try:
+            index_groups(batch_size=2)
+        finally:
+            app.db.add_tags = add_tags
+
+        self.assertEquals(sorted(g.hash for g in Group.objects.filter_tags(server='a')), ['1', '2', '3', '4'])
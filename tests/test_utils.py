@@ -0,0 +1,281 @@
+from . import BaseTest, with_settings
+
+import datetime
+import sys
+import threading
+import urllib2
+import uuid
+from BaseHTTPServer import BaseHTTPRequestHandler
+from collections import namedtuple
+from SocketServer import ThreadingTCPServer
+
+from sentry.utils import serialize_vars, transform
+from sentry.utils.cache import LRUCache
+from sentry.utils.http import ConnectionPool
+from sentry.utils.imports import ModuleProxyCache
+from sentry.utils.versions import VersionRegistry
+
+class SentryMetadata(object):
+    def __sentry__(self):
+        return {'foo': ['bar']}
+
+class SerializeVarsTest(BaseTest):
+    @with_settings(MAX_LENGTH_STRING=5)
+    def test_strings(self):
+        result = serialize_vars({'foo': 'foo', 'bar': 'x' * 100, 'baz': u'\xe9' * 100})
+
+        self.assertEquals(result['foo'], u'foo')
+        self.assertEquals(result['bar'], u'xxxxx...')
+        self.assertEquals(result['baz'], u'\xe9' * 5 + '...')
+
+    @with_settings(MAX_LENGTH_LIST=3)
+    def test_containers(self):
+        self.assertEquals(serialize_vars(range(100)), [0, 1, 2, '...', '(97 more elements)'])
+        self.assertEquals(serialize_vars(tuple(range(100))), (0, 1, 2, '...', '(97 more elements)'))
+        self.assertEquals(serialize_vars([1, 2]), [1, 2])
+
+        result = serialize_vars(dict((str(n), n) for n in xrange(100)))
+
+        self.assertEquals(len(result), 4)
+        self.assertEquals(result['...'], '(97 more items)')
+
+    @with_settings(MAX_VARS_DEPTH=3)
+    def test_depth(self):
+        result = serialize_vars({'a': {'b': {'c': {'d': 1}}, 'e': [[1, 2]]}})
+
+        self.assertEquals(result, {'a': {'b': {'c': '<dict of 1 items>'}, 'e': ['<list of 2 items>']}})
+
+    @with_settings(MAX_VARS_SIZE=100, MAX_LENGTH_LIST=1000)
+    def test_size(self):
+        result = serialize_vars({'foo': ['x' * 10] * 1000})
+
+        self.assertTrue(len(result['foo']) < 15, len(result['foo']))
+        self.assertEquals(result['foo'][-2], '...')
+
+    def test_cycles(self):
+        value = {}
+        value['self'] = value
+
+        self.assertEquals(serialize_vars(value), {'self': '<...>'})
+
+    def test_values(self):
+        value = uuid.uuid4()
+        result = serialize_vars({'uuid': value, 'int': 1, 'none': None, 'obj': SentryMetadata()})
+
+        self.assertEquals(result, {'uuid': repr(value), 'int': 1, 'none': None, 'obj': {'foo': ['bar']}})
+
+class TransformTest(BaseTest):
+    def test_builtins(self):
+        self.assertEquals(transform(['foo', u'bar', 1, True, None]), ['foo', u'bar', 1, True, None])
+        self.assertEquals(transform((1, 2)), (1, 2))
+        self.assertEquals(transform({'foo': {'bar': [1]}}), {'foo': {'bar': [1]}})
+        self.assertEquals(transform(1.5), u'1.5')
+
+    def test_sets(self):
+        self.assertEquals(transform(set([1])), (1,))
+        self.assertEquals(transform(frozenset([1])), (1,))
+
+    def test_namedtuple(self):
+        Point = namedtuple('Point', 'x y')
+
+        self.assertEquals(transform(Point(1, 2)), (1, 2))
+
+    def test_dates(self):
+        value = uuid.uuid4()
+
+        self.assertEquals(transform(value), repr(value))
+        self.assertEquals(transform(datetime.datetime(2011, 6, 18, 22, 31, 45)), '2011-06-18T22:31:45.000000')
+        self.assertEquals(transform(datetime.date(2011, 6, 18)), '2011-06-18')
+
+    def test_sentry_metadata(self):
+        self.assertEquals(transform([SentryMetadata()]), [{'foo': ['bar']}])
+        self.assertEquals(transform(SentryMetadata), unicode(SentryMetadata))
+
+    def test_cycles(self):
+        value = {'foo': []}
+        value['foo'].append(value)
+
+        self.assertEquals(transform(value), {'foo': ['<...>']})
+
+    def test_shared_references(self):
+        shared = [1]
+
+        self.assertEquals(transform([shared, shared]), [[1], [1]])
+
+    def test_deep_nesting(self):
+        value = leaf = []
+        for n in xrange(10000):
+            leaf.append([])
+            leaf = leaf[0]
+
+        result = transform(value)
+        for n in xrange(10000):
+            result = result[0]
+        self.assertEquals(result, [])
+
+class LRUCacheTest(BaseTest):
+    def test_evicts_least_recently_used(self):
+        cache = LRUCache(max_size=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+
+        self.assertEquals(cache.get('a'), 1)
+        self.assertEquals(cache.get('b'), None)
+        self.assertEquals(cache.get('c'), 3)
+
+    def test_timeout(self):
+        cache = LRUCache()
+        cache.set('a', 1, timeout=60)
+        cache.set('b', 2, timeout=0)
+
+        self.assertEquals(cache.get('a'), 1)
+        self.assertEquals(cache.get('b', 'missing'), 'missing')
+        self.assertEquals(len(cache), 1)
+
+class EchoHandler(BaseHTTPRequestHandler):
+    # answers with the request body, keeping the connection open
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        self.server.connections.add(self.client_address)
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        status = self.path == '/error/' and 500 or 200
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+class ConnectionPoolTest(BaseTest):
+    def setUp(self):
+        super(ConnectionPoolTest, self).setUp()
+        ThreadingTCPServer.allow_reuse_address = True
+        self.server = ThreadingTCPServer(('127.0.0.1', 0), EchoHandler)
+        self.server.daemon_threads = True
+        self.server.connections = set()
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.url = 'http://127.0.0.1:%d' % self.server.server_address[1]
+        self.pool = ConnectionPool(self.url, size=2, timeout=1)
+
+    def tearDown(self):
+        self.pool.close()
+        self.server.shutdown()
+        self.server.server_close()
+        super(ConnectionPoolTest, self).tearDown()
+
+    def test_keep_alive(self):
+        for n in xrange(5):
+            self.assertEquals(self.pool.urlopen(self.url + '/', 'foo%d' % n), 'foo%d' % n)
+        self.assertEquals(len(self.server.connections), 1)
+
+    def test_http_error(self):
+        try:
+            self.pool.urlopen(self.url + '/error/', 'foo')
+        except urllib2.HTTPError, e:
+            self.assertEquals(e.code, 500)
+            self.assertEquals(e.read(), 'foo')
+        else:
+            self.fail('HTTPError not raised')
+        # the connection is still usable
+        self.assertEquals(self.pool.urlopen(self.url + '/', 'bar'), 'bar')
+        self.assertEquals(len(self.server.connections), 1)
+
+    def test_stale_connection(self):
+        self.assertEquals(self.pool.urlopen(self.url + '/', 'foo'), 'foo')
+        # the server has since closed the connection
+        for conn in self.pool._pool.queue:
+            if conn is not None:
+                conn.sock.close()
+        self.assertEquals(self.pool.urlopen(self.url + '/', 'bar'), 'bar')
+
+    def test_exhausted(self):
+        self.pool.timeout = 0.01
+        conns = [self.pool._get_connection(), self.pool._get_connection()]
+        self.assertRaises(urllib2.URLError, self.pool.urlopen, self.url + '/', 'foo')
+        for conn in conns:
+            self.pool._put_connection(conn)
+        self.assertEquals(self.pool.urlopen(self.url + '/', 'foo'), 'foo')
+
+class FakeModule(object):
+    def __init__(self, **attrs):
+        self.__dict__.update(attrs)
+
+class VersionRegistryTest(BaseTest):
+    def setUp(self):
+        super(VersionRegistryTest, self).setUp()
+        self.registry = VersionRegistry()
+
+    def tearDown(self):
+        for name in ('sentry_test_app', 'sentry_test_app.sub', 'sentry_test_lib'):
+            sys.modules.pop(name, None)
+        super(VersionRegistryTest, self).tearDown()
+
+    def test_module_versions(self):
+        sys.modules['sentry_test_app'] = FakeModule(VERSION=(1, 2))
+        sys.modules['sentry_test_lib'] = FakeModule(get_version=lambda: '0.3', __version__='0.2')
+
+        versions = self.registry.get_versions()
+        self.assertEquals(versions['sentry_test_app'], '1.2')
+        self.assertEquals(versions['sentry_test_lib'], '0.3')
+        self.assertEquals(versions['sentry'], sys.modules['sentry'].VERSION)
+
+    def test_refresh(self):
+        modules_hash, versions = self.registry.get_manifest()
+        self.assertFalse('sentry_test_app' in versions)
+        self.assertEquals(self.registry.get_manifest(), (modules_hash, versions))
+
+        sys.modules['sentry_test_app'] = FakeModule(__version__='1.0')
+        new_hash, versions = self.registry.get_manifest()
+        self.assertEquals(versions['sentry_test_app'], '1.0')
+        self.assertNotEquals(new_hash, modules_hash)
+
+    def test_get_version(self):
+        sys.modules['sentry_test_app'] = FakeModule(__version__='1.0')
+        sys.modules['sentry_test_app.sub'] = FakeModule(__version__='2.0')
+
+        self.assertEquals(self.registry.get_version('sentry_test_app.sub.views.index'), ('sentry_test_app.sub', '2.0'))
+        self.assertEquals(self.registry.get_version('sentry_test_app.views'), ('sentry_test_app', '1.0'))
+        self.assertEquals(self.registry.get_version('/path/to/file.py'), None)
+
+class ModuleProxyCacheTest(BaseTest):
+    def test_classes(self):
+        cache = ModuleProxyCache()
+        from sentry.events import Message
+        self.assertTrue(cache['sentry.events.Message'] is Message)
+        self.assertTrue(cache['sentry.events.Message'] is Message)
+        self.assertRaises(ImportError, cache.__getitem__, 'sentry.nonexistent.Foo')
+        self.assertRaises(AttributeError, cache.__getitem__, 'sentry.events.Nonexistent')
+
+        self.assertEquals(cache.get_stats(), {'classes': 1, 'hits': 1, 'misses': 1})
+
+    def test_instances(self):
+        cache = ModuleProxyCache()
+        instance = cache.get_instance('sentry.events.Message')
+        self.assertEquals(type(instance), cache['sentry.events.Message'])
+        self.assertTrue(cache.get_instance('sentry.events.Message') is instance)
+
+    def test_warm(self):
+        cache = ModuleProxyCache()
+        cache.warm(['sentry.events.Message', 'sentry.interfaces.Message'])
+        cache['sentry.events.Message']
+
+        self.assertEquals(cache.get_stats(), {'classes': 2, 'hits': 1, 'misses': 2})
+
+    def test_concurrent_import(self):
+        cache = ModuleProxyCache()
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(cache.get_instance('sentry.events.Query')))
+                   for n in xrange(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEquals(len(set(id(r) for r in results)), 1)
+        self.assertEquals(cache.misses, 1)
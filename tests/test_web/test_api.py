@@ -2,16 +2,18 @@ from .. import BaseTest, with_settings
 
 import base64
 import simplejson
+import urllib2
+import sentry.collector.views
 from sentry import app
 from sentry.client.base import SentryClient
-from sentry.models import Event
+from sentry.models import Event, Group
 
 class InternalRemoteSentryClient(SentryClient):
     def send_remote(self, url, data, headers=None):
         if headers is None:
             headers = {}
         client = app.test_client()
-        return client.post(url, data=data, headers=headers)
+        return client.post(url, data=data, headers=headers, content_type=headers.get('Content-Type'))
 
 class StoreIntegrationTest(BaseTest):
     @with_settings(PUBLIC_WRITES=True, REMOTES=['/api/store/'])
@@ -30,6 +32,44 @@ class StoreIntegrationTest(BaseTest):
         self.assertTrue('params' in event_data)
         self.assertEquals(event_data['params'], [])
 
+    @with_settings(PUBLIC_WRITES=True, REMOTES=['/api/store/'], REMOTE_ENCODING='raw')
+    def test_client_raw(self):
+        client = InternalRemoteSentryClient()
+        message, headers = client.encode_request({'message': 'foo'})
+        self.assertEquals(headers['Content-Encoding'], 'deflate')
+        self.assertEquals(simplejson.loads(message.decode('zlib')), {'message': 'foo'})
+
+        event_id = client.capture('Message', message='foo')
+        self.assertEquals(Event.objects.get(event_id).data['sentry.interfaces.Message']['message'], 'foo')
+
+    @with_settings(PUBLIC_WRITES=True, REMOTES=['/api/store/'], REMOTE_ENCODING='raw', REMOTE_COMPRESSION_LEVEL=0)
+    def test_client_json(self):
+        client = InternalRemoteSentryClient()
+        message, headers = client.encode_request({'message': 'foo'})
+        self.assertEquals(headers['Content-Type'], 'application/json')
+        self.assertEquals(simplejson.loads(message), {'message': 'foo'})
+
+        event_id = client.capture('Message', message='foo')
+        self.assertEquals(Event.objects.get(event_id).data['sentry.interfaces.Message']['message'], 'foo')
+
+    @with_settings(REMOTES=['/a/', '/b/', '/c/'])
+    def test_send_to_all_remotes(self):
+        urls = []
+
+        class FailingRemoteSentryClient(SentryClient):
+            def send_remote(self, url, data, headers=None):
+                urls.append(url)
+                if url == '/a/':
+                    raise urllib2.URLError('down')
+                return url
+
+            def log_failed(self, data):
+                pass
+
+        # the first remote to accept the event answers for all of them
+        self.assertEquals(FailingRemoteSentryClient().send_to_remotes({'message': 'foo'}), '/b/')
+        self.assertEquals(sorted(urls), ['/a/', '/b/', '/c/'])
+
 class StoreTest(BaseTest):
     @with_settings(PUBLIC_WRITES=True)
     def test_simple(self):
@@ -91,4 +131,68 @@ class StoreTest(BaseTest):
         self.assertTrue('key' in result['data'])
         self.assertEquals(result['data']['key'], 'value')
         self.assertTrue('querystring' in result, result)
-        self.assertEquals(result['querystring'], 'baz=bar&foo=baz')
\ No newline at end of file
+        self.assertEquals(result['querystring'], 'baz=bar&foo=baz')
+
+    @with_settings(PUBLIC_WRITES=True)
+    def test_batch(self):
+        response = self.client.post('/api/store/', data=base64.b64encode(simplejson.dumps([{
+            "event_type": "sentry.events.Message",
+            "tags": [ ["level", "error"], ["server", "sentry.local"] ],
+            "date": "2010-06-18T22:31:%02d" % n,
+            "time_spent": 0,
+            "event_id": "452dfa92380f438f98159bb75b9469%02d" % n,
+            "data": {
+                "sentry.interfaces.Message": {
+                    "message": "foo %d" % (n % 2),
+                },
+            },
+        } for n in xrange(10)]).encode('zlib')))
+
+        self.assertEquals(response.status_code, 200)
+
+        event_ids = simplejson.loads(response.data)
+
+        self.assertEquals(len(event_ids), 10)
+        self.assertEquals(event_ids[0], '452dfa92380f438f98159bb75b946900')
+
+        for event_id in event_ids:
+            Event.objects.get(event_id)
+
+        self.assertEquals(len(Group.objects.all()), 2)
+
+    @with_settings(PUBLIC_WRITES=True, MAX_BATCH_SIZE=1)
+    def test_batch_too_large(self):
+        response = self.client.post('/api/store/', data=base64.b64encode(simplejson.dumps([{}, {}]).encode('zlib')))
+
+        self.assertEquals(response.status_code, 413)
+
+    @with_settings(PUBLIC_WRITES=True)
+    def test_batch_empty(self):
+        response = self.client.post('/api/store/', data=base64.b64encode(simplejson.dumps([]).encode('zlib')))
+
+        self.assertEquals(response.status_code, 400)
+
+    @with_settings(PUBLIC_WRITES=True)
+    def test_batch_invalid(self):
+        event = {
+            "event_type": "sentry.events.Message",
+            "tags": [],
+            "date": "2010-06-18T22:31:45",
+            "time_spent": 0,
+            "event_id": "452dfa92380f438f98159bb75b946900",
+            "data": {
+                "sentry.interfaces.Message": {
+                    "message": "foo",
+                },
+            },
+        }
+        missing = dict(event)
+        del missing['event_id']
+        bad_date = dict(event, date='yesterday')
+
+        for batch in ([1, "x"], [event, [event]], [event, missing], [event, bad_date]):
+            response = self.client.post('/api/store/', data=base64.b64encode(simplejson.dumps(batch).encode('zlib')))
+
+            self.assertEquals(response.status_code, 400)
+
+        self.assertEquals(len(Event.objects.all()), 0)
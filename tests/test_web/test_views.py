@@ -0,0 +1,119 @@
+from .. import BaseTest, with_settings
+
+import datetime
+import sys
+
+import sentry.web.views
+from sentry import app
+from sentry.models import Event, Group
+from sentry.web.paginator import Paginator
+from sentry.web.templatetags import chart_data
+
+class IndexTest(BaseTest):
+    def store(self, message, tags):
+        return app.client.store(
+            'sentry.events.Message',
+            tags=tags,
+            date=datetime.datetime.now(),
+            time_spent=0,
+            data={
+                'sentry.interfaces.Message': {
+                    'message': message,
+                }
+            },
+            event_id=message,
+        )
+
+    def test_filters(self):
+        event, foo = self.store('foo', [('server', 'a'), ('level', 'error')])
+        event, bar = self.store('bar', [('server', 'b'), ('level', 'error')])
+
+        resp = self.client.get('/')
+        self.assertEquals(resp.status_code, 200)
+        self.assertTrue('group_%s' % foo.pk in resp.data)
+        self.assertTrue('group_%s' % bar.pk in resp.data)
+
+        resp = self.client.get('/?server=b&sort=count')
+        self.assertEquals(resp.status_code, 200)
+        self.assertFalse('group_%s' % foo.pk in resp.data)
+        self.assertTrue('group_%s' % bar.pk in resp.data)
+
+        resp = self.client.get('/?server=a&level=error')
+        self.assertEquals(resp.status_code, 200)
+        self.assertTrue('group_%s' % foo.pk in resp.data)
+        self.assertFalse('group_%s' % bar.pk in resp.data)
+
+    @with_settings(MESSAGES_PER_PAGE=2)
+    def test_pagination(self):
+        groups = [self.store(message, [('server', 'a')])[1] for message in ('foo', 'bar', 'baz')]
+
+        resp = self.client.get('/?sort=date&server=a')
+        self.assertEquals(resp.status_code, 200)
+        self.assertEquals(sum('group_%s' % g.pk in resp.data for g in groups), 2)
+        self.assertTrue('sort=date&amp;server=a&amp;p=2' in resp.data or 'server=a&amp;sort=date&amp;p=2' in resp.data)
+
+        resp = self.client.get('/?sort=date&server=a&p=2')
+        self.assertEquals(resp.status_code, 200)
+        self.assertEquals(sum('group_%s' % g.pk in resp.data for g in groups), 1)
+
+class GroupTest(BaseTest):
+    def setUp(self):
+        super(GroupTest, self).setUp()
+        try:
+            raise ValueError('foo')
+        except ValueError:
+            event_id = app.client.capture('Exception', exc_info=sys.exc_info(), data={
+                'extra': {'foo': 'bar'},
+            })
+        self.event = Event.objects.get(event_id)
+        self.group = self.event.get_relations(Group)[0]
+
+    def count_get_meta(self, url):
+        calls = []
+        get_meta = app.db.get_meta
+        def counted(*args, **kwargs):
+            calls.append(args)
+            return get_meta(*args, **kwargs)
+        app.db.get_meta = counted
+        try:
+            resp = self.client.get(url)
+        finally:
+            del app.db.get_meta
+        self.assertEquals(resp.status_code, 200)
+        self.assertTrue('ValueError' in resp.data)
+        self.assertTrue('foo' in resp.data)
+        return len(calls)
+
+    def test_details_reads_metadata_once(self):
+        self.assertEquals(self.count_get_meta('/group/%s/' % self.group.pk), 1)
+
+    def test_event_reads_metadata_once(self):
+        self.assertEquals(self.count_get_meta('/group/%s/events/%s/' % (self.group.pk, self.event.pk)), 1)
+
+    def test_chart_data(self):
+        app.client.capture('Message', message='bar')
+
+        data = chart_data(self.group)
+        self.assertTrue(len(data['points']) >= 25)
+        self.assertEquals(len(data['points']), len(data['categories']))
+        self.assertEquals(sum(data['points']), 1)
+        self.assertEquals(sum(chart_data(None)['points']), 2)
+
+class PaginatorTest(BaseTest):
+    def test_pages(self):
+        for n in xrange(5):
+            Group.objects.create(type='foo', hash=str(n), count=1, last_seen=datetime.datetime(2011, 6, 18, 22, 31, n))
+
+        paginator = Paginator(Group.objects.order_by('-last_seen'), 2, 2)
+
+        self.assertEquals(paginator.count, 5)
+        self.assertEquals(paginator.num_pages, 3)
+        self.assertEquals(paginator.page_range, [1, 2, 3])
+        self.assertTrue(paginator.has_previous)
+        self.assertTrue(paginator.has_next)
+        self.assertEquals([g.hash for g in paginator.object_list], ['2', '1'])
+
+        paginator = Paginator(Group.objects.order_by('-last_seen'), 3, 2)
+
+        self.assertTrue(paginator.is_last)
+        self.assertEquals([g.hash for g in paginator.object_list], ['0'])